@@ -1,4 +1,5 @@
 import ast
+import re
 
 import simpleeval
 import operator
@@ -89,9 +90,122 @@ for x in range(16):
     functions["LT{}".format(x)] = lambda kc, layer=x: (r("QK_LAYER_TAP") | (((layer)&0xF) << 8) | ((kc)&0xFF))
 
 
+NUMBER = r"0[xX][0-9a-fA-F]+|0[bB][01]+|0[oO][0-7]+|[1-9][0-9]*|0+"
+NAME = r"[A-Za-z_][A-Za-z0-9_]*"
+TOKEN_RE = re.compile(r"\s*(?:({})(?![A-Za-z0-9_])|({})|(<<|>>|//|[-|^&+*%~(),]))".format(NUMBER, NAME))
+# NAME(NAME) and NAME(number), which is what nearly every keycode expression looks like
+CALL_RE = re.compile(r"\s*({name})\s*\(\s*(?:({name})|({number}))\s*\)\s*$".format(name=NAME, number=NUMBER))
+
+BINARY_OPERATORS = {"|": operator.or_, "^": operator.xor, "&": operator.and_, "<<": operator.lshift,
+                    ">>": operator.rshift, "+": operator.add, "-": operator.sub, "*": operator.mul,
+                    "//": operator.floordiv, "%": operator.mod}
+# from lowest to highest precedence, same as in Python
+PRECEDENCE = [{"|"}, {"^"}, {"&"}, {"<<", ">>"}, {"+", "-"}, {"*", "//", "%"}]
+UNARY_OPERATORS = {"-": operator.neg, "+": operator.pos, "~": operator.invert}
+
+
+def parse_number(s):
+    if len(s) > 1 and s[1] in "xXbBoO":
+        return int(s, 0)
+    return int(s, 10)
+
+
+class ExpressionParser:
+
+    """
+    Evaluates the integer expressions keycodes are written in: numbers, names, calls of `functions`
+    and arithmetic/bitwise operators. Raises on anything else, which is then left to simpleeval.
+    """
+
+    def __init__(self, s, names):
+        self.tokens = self.tokenize(s)
+        self.pos = 0
+        self.names = names
+
+    @staticmethod
+    def tokenize(s):
+        tokens = []
+        s = s.rstrip()
+        pos = 0
+        while pos < len(s):
+            m = TOKEN_RE.match(s, pos)
+            if m is None:
+                raise ValueError("unexpected input at {}".format(pos))
+            number, name, op = m.groups()
+            if number is not None:
+                tokens.append(("number", parse_number(number)))
+            elif name is not None:
+                tokens.append(("name", name))
+            else:
+                tokens.append(("op", op))
+            pos = m.end()
+        return tokens
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return None, None
+
+    def take(self, op=None):
+        kind, value = self.peek()
+        if kind is None or (op is not None and (kind, value) != ("op", op)):
+            raise ValueError("unexpected token {}".format(value))
+        self.pos += 1
+        return kind, value
+
+    def evaluate(self):
+        value = self.binary(0)
+        if self.pos != len(self.tokens):
+            raise ValueError("trailing input")
+        return value
+
+    def binary(self, level):
+        if level == len(PRECEDENCE):
+            return self.unary()
+        value = self.binary(level + 1)
+        while True:
+            kind, op = self.peek()
+            if kind != "op" or op not in PRECEDENCE[level]:
+                return value
+            self.take()
+            value = BINARY_OPERATORS[op](value, self.binary(level + 1))
+
+    def unary(self):
+        kind, op = self.peek()
+        if kind == "op" and op in UNARY_OPERATORS:
+            self.take()
+            return UNARY_OPERATORS[op](self.unary())
+        return self.atom()
+
+    def atom(self):
+        kind, value = self.take()
+        if kind == "number":
+            return value
+        if kind == "op" and value == "(":
+            value = self.binary(0)
+            self.take(")")
+            return value
+        if kind == "name":
+            if self.peek() != ("op", "("):
+                return self.names[value]
+            self.take("(")
+            args = []
+            while self.peek() != ("op", ")"):
+                if args:
+                    self.take(",")
+                args.append(self.binary(0))
+            self.take(")")
+            return functions[value](*args)
+        raise ValueError("unexpected token {}".format(value))
+
+
 class AnyKeycode:
 
+    instance = None
+
     def __init__(self):
+        # keycodes and protocol the names were built from
+        self.generation = (Keycode.generation, Keycode.protocol)
         self.ops = simpleeval.DEFAULT_OPERATORS.copy()
         self.ops.update({
             ast.BitOr: operator.or_,
@@ -101,6 +215,13 @@ class AnyKeycode:
         self.names = dict()
         self.prepare_names()
 
+    @classmethod
+    def get(cls):
+        """ Returns a shared instance, rebuilding its names when keycodes have changed since it was made """
+        if cls.instance is None or cls.instance.generation != (Keycode.generation, Keycode.protocol):
+            cls.instance = AnyKeycode()
+        return cls.instance
+
     def prepare_names(self):
         for kc in KEYCODES_SPECIAL + KEYCODES_BASIC + KEYCODES_SHIFTED + KEYCODES_ISO + KEYCODES_BACKLIGHT + \
                   KEYCODES_MEDIA + KEYCODES_USER:
@@ -113,4 +234,16 @@ class AnyKeycode:
         self.names.update(macros)
 
     def decode(self, s):
-        return simpleeval.simple_eval(s, names=self.names, functions=functions, operators=self.ops)
+        # results are memoized by Keycode.deserialize_cached, which is cleared along with this instance
+        if s in self.names:
+            return self.names[s]
+        try:
+            m = CALL_RE.match(s)
+            if m is not None:
+                fn, name, number = m.groups()
+                return functions[fn](self.names[name] if name is not None else parse_number(number))
+            return ExpressionParser(s, self.names).evaluate()
+        except Exception:
+            # anything outside of the keycode grammar, as well as errors, goes to the general evaluator,
+            # which also gives proper error messages
+            return simpleeval.simple_eval(s, names=self.names, functions=functions, operators=self.ops)
@@ -1,7 +1,10 @@
 import sys
+from functools import partial
 
 from PyQt5.QtCore import QObject, pyqtSignal
 
+from autorefresh.device_loader import DeviceLoader
+
 
 class AutorefreshLocker:
 
@@ -25,6 +28,9 @@ class Autorefresh(QObject):
 
         self.devices = []
         self.current_device = None
+        # loader of current_device, and loaders which were cancelled but are still winding down
+        self.loader = None
+        self.cancelled_loaders = set()
 
         Autorefresh.instance = self
 
@@ -36,6 +42,10 @@ class Autorefresh(QObject):
             from autorefresh.autorefresh_thread_win import AutorefreshThreadWin
 
             self.thread = AutorefreshThreadWin()
+        elif sys.platform.startswith("linux"):
+            from autorefresh.autorefresh_thread_linux import AutorefreshThreadLinux
+
+            self.thread = AutorefreshThreadLinux()
         else:
             from autorefresh.autorefresh_thread import AutorefreshThread
 
@@ -64,21 +74,45 @@ class Autorefresh(QObject):
         self.thread.load_via_stack(data)
 
     def select_device(self, idx):
-        if self.current_device is not None:
+        """
+        Closes the current device and selects a new one; returns a DeviceLoader which has to be started
+        to actually open it, or None if no device is selected
+
+        A device which is still being opened is closed by its loader once that stops, without waiting for it.
+        """
+
+        if self.loader is not None and self.loader.cancel():
+            # keep the thread referenced until it finished
+            self.cancelled_loaders.add(self.loader)
+            self.loader.finished.connect(partial(self.cancelled_loaders.discard, self.loader))
+        elif self.current_device is not None:
             self.current_device.close()
+        self.loader = None
         self.current_device = None
         if idx >= 0:
             self.current_device = self.devices[idx]
-
-        if self.current_device is not None:
-            if self.current_device.sideload:
-                self.current_device.open(self.thread.sideload_json)
-            elif self.current_device.via_stack:
-                self.current_device.open(self.thread.via_stack_json["definitions"][self.current_device.via_id])
-            else:
-                self.current_device.open(None)
         self.thread.set_device(self.current_device)
 
+        if self.current_device is None:
+            return None
+        if self.current_device.sideload:
+            override_json = self.thread.sideload_json
+        elif self.current_device.via_stack:
+            override_json = self.thread.via_stack_json["definitions"][self.current_device.via_id]
+        else:
+            override_json = None
+        self.loader = DeviceLoader(self.current_device, override_json, self.thread.device_mutex)
+        return self.loader
+
+    def stop_loading(self):
+        """ Cancels loading of the current device and waits for all loaders to stop, when the application quits """
+
+        if self.loader is not None:
+            self.loader.cancel()
+            self.loader.wait()
+        for loader in list(self.cancelled_loaders):
+            loader.wait()
+
     def on_devices_updated(self, devices, changed):
         self.devices = devices
         self.devices_updated.emit(devices, changed)
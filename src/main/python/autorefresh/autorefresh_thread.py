@@ -26,7 +26,12 @@ class AutorefreshThread(QThread):
         self.current_device = None
         self.devices = []
         self.locked = False
+        # an update was skipped because of lock(), devices have to be enumerated once unlocked
+        self.dirty = False
         self.mutex = RLock()
+        # held while enumerating devices, and by DeviceLoader while opening a device,
+        # so that probing devices never overlaps with talking to the one being loaded
+        self.device_mutex = RLock()
 
         self.sideload_json = None
         self.sideload_vid = self.sideload_pid = -1
@@ -48,10 +53,12 @@ class AutorefreshThread(QThread):
 
     # note that this method is called from both inside and outside of this thread
     def update(self, quiet=True, hard=False):
-        # if lock()ed then just do nothing
+        # if lock()ed then just do nothing, but remember to catch up once unlocked
         with self.mutex:
             if self.locked:
+                self.dirty = True
                 return
+            self.dirty = False
             # can be modified out of mutex so create local copies here
             via_stack_json = self.via_stack_json
             sideload_vid = self.sideload_vid
@@ -59,11 +66,13 @@ class AutorefreshThread(QThread):
 
         # this can take a long (~seconds) time on Windows, so run outside of mutex
         # to make sure calling lock() and unlock() is instant
-        new_devices = find_vial_devices(via_stack_json, sideload_vid, sideload_pid, quiet=quiet)
+        with self.device_mutex:
+            new_devices = find_vial_devices(via_stack_json, sideload_vid, sideload_pid, quiet=quiet)
 
         # this is fast again but discard results if we got lock()ed in between
         with self.mutex:
             if self.locked:
+                self.dirty = True
                 return
 
             # if the set of the devices didn't change at all, don't need to update the combobox
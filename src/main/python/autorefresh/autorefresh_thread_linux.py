@@ -0,0 +1,101 @@
+import logging
+import os
+import select
+import socket
+import struct
+import time
+
+from autorefresh.autorefresh_thread import AutorefreshThread
+from util import RawHidProbes
+
+# not exported by the socket module
+NETLINK_KOBJECT_UEVENT = 15
+# multicast groups of uevents sent by the kernel, and of the ones udev sends once it applied its rules,
+# e.g. hidraw permissions for users
+UEVENT_GROUP_KERNEL = 1
+UEVENT_GROUP_UDEV = 2
+UEVENT_BUFFER_SIZE = 8192
+# udev events start with this, followed by a binary header with the offset and length of the properties
+UDEV_MONITOR_PREFIX = b"libudev\x00"
+
+# a plug produces a burst of events (kernel, then udev), enumerate once they stopped for this long, in seconds
+HOTPLUG_SETTLE = 0.25
+# how often to retry an enumeration which was skipped while the thread was locked, in seconds
+LOCKED_RETRY = 1.0
+
+
+def parse_uevent(data):
+    """ Properties of a kernel or udev uevent as a dict, None if data isn't a uevent """
+
+    if data.startswith(UDEV_MONITOR_PREFIX):
+        if len(data) < 24:
+            return None
+        offset, length = struct.unpack_from("=II", data, 16)
+        payload = data[offset:offset + length]
+    else:
+        # kernel uevents start with "action@devpath"
+        header, _, payload = data.partition(b"\x00")
+        if b"@" not in header:
+            return None
+
+    properties = dict()
+    for field in payload.split(b"\x00"):
+        key, sep, value = field.partition(b"=")
+        if sep:
+            properties[key.decode("utf-8", "replace")] = value.decode("utf-8", "replace")
+    return properties
+
+
+class AutorefreshThreadLinux(AutorefreshThread):
+
+    """
+    Enumerates devices when the kernel or udev report a hidraw node being added or removed, rather than every
+    second. Falls back to polling when uevents can't be received, e.g. in a sandbox without netlink.
+    """
+
+    @staticmethod
+    def open_monitor():
+        monitor = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_KOBJECT_UEVENT)
+        try:
+            monitor.bind((0, UEVENT_GROUP_KERNEL | UEVENT_GROUP_UDEV))
+        except OSError:
+            monitor.close()
+            raise
+        return monitor
+
+    def run(self):
+        try:
+            monitor = self.open_monitor()
+        except OSError as e:
+            logging.warning("Cannot listen for hotplug events, polling for devices instead: %s", e)
+            return super().run()
+
+        self.update()
+
+        # when to enumerate, once events stopped arriving
+        deadline = time.monotonic() + LOCKED_RETRY if self.dirty else None
+        while True:
+            timeout = None if deadline is None else max(0, deadline - time.monotonic())
+            ready, _, _ = select.select([monitor], [], [], timeout)
+            if not ready:
+                deadline = None
+                self.update()
+                # a plug while loading a device or flashing firmware must not leave the device list stale
+                if self.dirty:
+                    deadline = time.monotonic() + LOCKED_RETRY
+                continue
+
+            try:
+                data = monitor.recv(UEVENT_BUFFER_SIZE)
+            except OSError:
+                # receive buffer overran and events were lost, enumerate to catch up
+                deadline = time.monotonic() + HOTPLUG_SETTLE
+                continue
+
+            properties = parse_uevent(data)
+            # other subsystems of the same device (usb, hid, input) don't change what can be opened
+            if properties is not None and properties.get("SUBSYSTEM") == "hidraw":
+                # the node may be reused by another device or come back with other permissions, probe it again;
+                # devices at other nodes keep their probe results
+                RawHidProbes.get().forget("/dev/" + os.path.basename(properties.get("DEVNAME", "")))
+                deadline = time.monotonic() + HOTPLUG_SETTLE
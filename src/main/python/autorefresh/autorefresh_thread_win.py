@@ -43,6 +43,7 @@ class AutorefreshThreadWin(AutorefreshThread):
                 win32gui.PumpWaitingMessages()
                 time.sleep(0.01)
 
-            if g_device_changes > 0:
+            # also catch up on changes which arrived while lock()ed
+            if g_device_changes > 0 or self.dirty:
                 g_device_changes = 0
                 self.update()
@@ -0,0 +1,102 @@
+import sys
+import threading
+
+from PyQt5.QtCore import pyqtSignal, QThread
+
+from keycodes.keycodes import recreate_keyboard_keycodes
+
+
+class LoadCancelled(Exception):
+    pass
+
+
+class DeviceLoader(QThread):
+
+    """
+    Opens a device and loads everything from it in background, so that the GUI stays responsive
+    while a large keyboard is being read.
+
+    progress is emitted as each part of the keyboard becomes available (see Keyboard.reload),
+    loaded once the device is fully open, with the exception that occurred or None.
+
+    cancel stops loading before the next part, without waiting for the part which is being read.
+
+    keycodes is emitted with the keyboard once the global keycode lists have to be regenerated for it. Editors
+    paint from these lists, so a receiver on the GUI thread does that and calls keycodes_done; loading waits
+    for it, as later parts convert keycodes using the lists.
+    """
+
+    progress = pyqtSignal(object, str, int, int)
+    keycodes = pyqtSignal(object)
+    loaded = pyqtSignal(object, object)
+
+    def __init__(self, device, override_json, device_mutex):
+        super().__init__()
+        self.device = device
+        self.override_json = override_json
+        self.device_mutex = device_mutex
+        # guards cancelled and done, which decide whether the loader or its owner closes the device
+        self.lock = threading.Lock()
+        self.cancelled = False
+        self.done = False
+        self.keycodes_ready = threading.Event()
+
+    def start(self):
+        # no threads in the browser, load in place
+        if sys.platform == "emscripten":
+            self.run()
+        else:
+            super().start()
+
+    def cancel(self):
+        """
+        Stops loading, the loader then closes the device itself. Returns False if loading already finished,
+        in which case the device stays open and the caller has to close it.
+        """
+
+        with self.lock:
+            if self.done:
+                return False
+            self.cancelled = True
+        # don't leave loading stuck waiting for keycodes nobody is going to regenerate anymore
+        self.keycodes_ready.set()
+        return True
+
+    def on_progress(self, part, done, total):
+        if self.cancelled:
+            raise LoadCancelled()
+        self.progress.emit(self.device, part, done, total)
+
+    def recreate_keycodes(self, keyboard):
+        if not self.receivers(self.keycodes):
+            recreate_keyboard_keycodes(keyboard)
+            return
+
+        self.keycodes_ready.clear()
+        # cancelled before the event was cleared
+        if self.cancelled:
+            raise LoadCancelled()
+        self.keycodes.emit(keyboard)
+        self.keycodes_ready.wait()
+        if self.cancelled:
+            raise LoadCancelled()
+
+    def keycodes_done(self):
+        self.keycodes_ready.set()
+
+    def run(self):
+        error = None
+        # wait for device enumeration which might be in progress to finish
+        with self.device_mutex:
+            try:
+                self.device.open(self.override_json, progress=self.on_progress, keycodes=self.recreate_keycodes)
+            except Exception as e:
+                error = e
+
+            with self.lock:
+                self.done = True
+                cancelled = self.cancelled
+            # still under the mutex, so that the device can't be opened again before it's closed here
+            if cancelled:
+                self.device.close()
+        self.loaded.emit(self.device, error)
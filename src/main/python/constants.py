@@ -16,3 +16,6 @@ KEYBOARD_WIDGET_NONMASK_PADDING = 0.02
 SHADOW_SIDE_PADDING = 0.1
 SHADOW_TOP_PADDING = 0.05
 SHADOW_BOTTOM_PADDING = 0.15
+
+# most combos, tap dances, key overrides and alt repeat keys editors show
+DYNAMIC_ENTRIES_MAX = 128
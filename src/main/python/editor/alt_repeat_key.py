@@ -3,6 +3,7 @@ from PyQt5 import QtCore
 from PyQt5.QtCore import Qt, pyqtSignal, QObject
 from PyQt5.QtWidgets import QWidget, QSizePolicy, QGridLayout, QHBoxLayout, QVBoxLayout, QLabel, QCheckBox, QScrollArea, QFrame, QToolButton
 
+from constants import DYNAMIC_ENTRIES_MAX
 from protocol.constants import VIAL_PROTOCOL_DYNAMIC
 from util import make_scrollable, tr
 from widgets.key_widget import KeyWidget
@@ -184,17 +185,18 @@ class AltRepeatKey(BasicEditor):
         self.alt_repeat_key_entries = []
         self.alt_repeat_key_entries_available = []
         self.tabs = TabWidgetWithKeycodes()
-        for x in range(128):
-            entry = AltRepeatKeyEntryUI(x)
-            entry.changed.connect(self.on_change)
-            self.alt_repeat_key_entries_available.append(entry)
 
         self.addWidget(self.tabs)
 
     def rebuild_ui(self):
         while self.tabs.count() > 0:
             self.tabs.removeTab(0)
-        self.alt_repeat_key_entries = self.alt_repeat_key_entries_available[:self.keyboard.alt_repeat_key_count]
+        count = min(self.keyboard.alt_repeat_key_count, DYNAMIC_ENTRIES_MAX)
+        while len(self.alt_repeat_key_entries_available) < count:
+            entry = AltRepeatKeyEntryUI(len(self.alt_repeat_key_entries_available))
+            entry.changed.connect(self.on_change)
+            self.alt_repeat_key_entries_available.append(entry)
+        self.alt_repeat_key_entries = self.alt_repeat_key_entries_available[:count]
         for x, e in enumerate(self.alt_repeat_key_entries):
             self.tabs.addTab(e.widget(), str(x + 1))
         for x, e in enumerate(self.alt_repeat_key_entries):
@@ -206,10 +208,11 @@ class AltRepeatKey(BasicEditor):
             self.keyboard = device.keyboard
             self.rebuild_ui()
 
-    def valid(self):
-        return isinstance(self.device, VialKeyboard) and \
-               (self.device.keyboard and self.device.keyboard.vial_protocol >= VIAL_PROTOCOL_DYNAMIC
-                and self.device.keyboard.alt_repeat_key_count > 0)
+    @staticmethod
+    def valid_for(device):
+        return isinstance(device, VialKeyboard) and \
+               (device.keyboard and device.keyboard.vial_protocol >= VIAL_PROTOCOL_DYNAMIC
+                and device.keyboard.alt_repeat_key_count > 0)
 
     def on_change(self):
         for x, e in enumerate(self.alt_repeat_key_entries):
@@ -8,9 +8,13 @@ class BasicEditor(QVBoxLayout):
 
         self.device = None
 
-    def valid(self):
+    @staticmethod
+    def valid_for(device):
         raise NotImplementedError
 
+    def valid(self):
+        return self.valid_for(self.device)
+
     def rebuild(self, device):
         self.device = device
 
@@ -3,6 +3,7 @@ from PyQt5 import QtCore
 from PyQt5.QtCore import pyqtSignal, QObject
 from PyQt5.QtWidgets import QWidget, QSizePolicy, QGridLayout, QVBoxLayout, QLabel
 
+from constants import DYNAMIC_ENTRIES_MAX
 from protocol.constants import VIAL_PROTOCOL_DYNAMIC
 from widgets.key_widget import KeyWidget
 from vial_device import VialKeyboard
@@ -81,17 +82,19 @@ class Combos(BasicEditor):
         self.combo_entries = []
         self.combo_entries_available = []
         self.tabs = TabWidgetWithKeycodes()
-        for x in range(128):
-            entry = ComboEntryUI(x)
-            entry.key_changed.connect(self.on_key_changed)
-            self.combo_entries_available.append(entry)
 
         self.addWidget(self.tabs)
 
     def rebuild_ui(self):
         while self.tabs.count() > 0:
             self.tabs.removeTab(0)
-        self.combo_entries = self.combo_entries_available[:self.keyboard.combo_count]
+        # entries are created the first time a keyboard has that many combos, not upfront
+        count = min(self.keyboard.combo_count, DYNAMIC_ENTRIES_MAX)
+        while len(self.combo_entries_available) < count:
+            entry = ComboEntryUI(len(self.combo_entries_available))
+            entry.key_changed.connect(self.on_key_changed)
+            self.combo_entries_available.append(entry)
+        self.combo_entries = self.combo_entries_available[:count]
         for x, e in enumerate(self.combo_entries):
             self.tabs.addTab(e.widget(), str(x + 1))
         for x, e in enumerate(self.combo_entries):
@@ -103,10 +106,11 @@ class Combos(BasicEditor):
             self.keyboard = device.keyboard
             self.rebuild_ui()
 
-    def valid(self):
-        return isinstance(self.device, VialKeyboard) and \
-               (self.device.keyboard and self.device.keyboard.vial_protocol >= VIAL_PROTOCOL_DYNAMIC
-                and self.device.keyboard.combo_count > 0)
+    @staticmethod
+    def valid_for(device):
+        return isinstance(device, VialKeyboard) and \
+               (device.keyboard and device.keyboard.vial_protocol >= VIAL_PROTOCOL_DYNAMIC
+                and device.keyboard.combo_count > 0)
 
     def on_key_changed(self):
         for x, e in enumerate(self.combo_entries):
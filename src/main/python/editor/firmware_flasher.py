@@ -164,9 +164,10 @@ class FirmwareFlasher(BasicEditor):
             self.log("Vial keyboard detected")
             self.chk_restore_keymap.show()
 
-    def valid(self):
-        return (isinstance(self.device, VialBootloader) or \
-               (isinstance(self.device, VialKeyboard) and self.device.keyboard.vibl)) \
+    @staticmethod
+    def valid_for(device):
+        return (isinstance(device, VialBootloader) or \
+               (isinstance(device, VialKeyboard) and device.keyboard.vibl)) \
                and sys.platform != "emscripten"
 
     def find_device_with_uid(self, cls, uid):
@@ -272,9 +273,10 @@ class FirmwareFlasher(BasicEditor):
             self.log("Found Vial keyboard at {}".format(found.desc["path"].decode("utf-8")))
             found.open()
             self.device = found
-            self.log("Restoring saved layout...")
+            plan = found.keyboard.plan_restore_layout(self.layout_restore)
+            self.log("Restoring saved layout: {}".format(plan.describe()))
             QCoreApplication.processEvents()
-            found.keyboard.restore_layout(self.layout_restore)
+            plan.execute()
             found.keyboard.lock()
             found.close()
             self.log("Done!")
@@ -107,7 +107,7 @@ class KeymapEditor(BasicEditor):
             self.container.set_scale(self.container.get_scale() - 0.1)
         else:
             self.container.set_scale(self.container.get_scale() + 0.1)
-        self.refresh_layer_display()
+        self.refresh_layout()
 
     def rebuild(self, device):
         super().rebuild(device)
@@ -127,8 +127,9 @@ class KeymapEditor(BasicEditor):
             self.refresh_layer_display()
         self.container.setEnabled(self.valid())
 
-    def valid(self):
-        return isinstance(self.device, VialKeyboard)
+    @staticmethod
+    def valid_for(device):
+        return isinstance(device, VialKeyboard)
 
     def save_layout(self):
         return self.keyboard.save_layout()
@@ -141,7 +142,15 @@ class KeymapEditor(BasicEditor):
                                        QMessageBox.Yes | QMessageBox.No)
             if ret != QMessageBox.Yes:
                 return
-        self.keyboard.restore_layout(data)
+        plan = self.keyboard.plan_restore_layout(data)
+        if plan.packets() > 0:
+            ret = QMessageBox.question(self.widget(), "",
+                                       tr("KeymapEditor", "Restoring will write {} to the keyboard,"
+                                                          " continue?").format(plan.describe()),
+                                       QMessageBox.Yes | QMessageBox.No)
+            if ret != QMessageBox.Yes:
+                return
+        plan.execute()
         self.refresh_layer_display()
 
     def on_any_keycode(self):
@@ -168,10 +177,14 @@ class KeymapEditor(BasicEditor):
             return self.keyboard.encoder_layout[(self.current_layer, widget.desc.encoder_idx,
                                                  widget.desc.encoder_dir)]
 
-    def refresh_layer_display(self):
-        """ Refresh text on key widgets to display data corresponding to current layer """
+    def refresh_layout(self):
+        """ Recalculate key geometry after layout options or scale changed, then refresh text on key widgets """
 
         self.container.update_layout()
+        self.refresh_layer_display()
+
+    def refresh_layer_display(self):
+        """ Refresh text on key widgets to display data corresponding to current layer """
 
         for idx, btn in enumerate(self.layer_buttons):
             btn.setEnabled(idx != self.current_layer)
@@ -181,7 +194,12 @@ class KeymapEditor(BasicEditor):
             code = self.code_for_widget(widget)
             KeycodeDisplay.display_keycode(widget, code)
         self.container.update()
-        self.container.updateGeometry()
+
+    def refresh_key_display(self, widget):
+        """ Refresh text on a single key widget after its keycode changed """
+
+        KeycodeDisplay.display_keycode(widget, self.code_for_widget(widget))
+        self.container.update_key(widget)
 
     def switch_layer(self, idx):
         self.container.deselect()
@@ -215,7 +233,7 @@ class KeymapEditor(BasicEditor):
             keycode = kc.qmk_id.replace("(kc)", "({})".format(keycode))
 
         self.keyboard.set_encoder(l, i, d, keycode)
-        self.refresh_layer_display()
+        self.refresh_key_display(self.container.active_key)
 
     def set_key_matrix(self, keycode):
         l, r, c = self.current_layer, self.container.active_key.desc.row, self.container.active_key.desc.col
@@ -231,11 +249,10 @@ class KeymapEditor(BasicEditor):
                 keycode = kc.qmk_id.replace("(kc)", "({})".format(keycode))
 
             self.keyboard.set_key(l, r, c, keycode)
-            self.refresh_layer_display()
+            self.refresh_key_display(self.container.active_key)
 
     def on_key_clicked(self):
         """ Called when a key on the keyboard widget is clicked """
-        self.refresh_layer_display()
         if self.container.active_mask:
             self.tabbed_keycodes.set_keycode_filter(keycode_filter_masked)
         else:
@@ -248,7 +265,7 @@ class KeymapEditor(BasicEditor):
         if self.keyboard is None:
             return
 
-        self.refresh_layer_display()
+        self.refresh_layout()
         self.keyboard.set_layout_options(self.layout_editor.pack())
 
     def on_keymap_override(self):
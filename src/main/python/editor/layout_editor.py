@@ -141,8 +141,9 @@ class LayoutEditor(BasicEditor):
         self.blockSignals(False)
         self.update_preview()
 
-    def valid(self):
-        return isinstance(self.device, VialKeyboard) and self.device.keyboard.layout_labels
+    @staticmethod
+    def valid_for(device):
+        return isinstance(device, VialKeyboard) and device.keyboard.layout_labels
 
     def pack(self):
         if not self.choices:
@@ -63,8 +63,9 @@ class MacroRecorder(BasicEditor):
         self.addWidget(self.tabs)
         self.addLayout(buttons)
 
-    def valid(self):
-        return isinstance(self.device, VialKeyboard)
+    @staticmethod
+    def valid_for(device):
+        return isinstance(device, VialKeyboard)
 
     def rebuild(self, device):
         super().rebuild(device)
@@ -1,16 +1,26 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
-from PyQt5.QtWidgets import QVBoxLayout, QPushButton, QWidget, QHBoxLayout, QLabel
+from PyQt5.QtWidgets import QVBoxLayout, QPushButton, QWidget, QHBoxLayout, QLabel, QCheckBox, QSpinBox, \
+    QFileDialog, QDialog
 from PyQt5.QtCore import Qt, QTimer
 
-import math
+import time
+from collections import defaultdict
 
 from editor.basic_editor import BasicEditor
 from protocol.constants import VIAL_PROTOCOL_MATRIX_TESTER
+from protocol.matrix import MatrixState, MatrixRecorder, CHATTER_MS
 from widgets.keyboard_widget import KeyboardWidget
 from util import tr
 from vial_device import VialKeyboard
 from unlocker import Unlocker
 
+# interval between matrix polls; a poll is a single round trip so the effective rate is also bound by the device
+POLL_INTERVAL_MS = 4
+# how often the unlock status is checked while the keyboard is unlocked, in seconds
+UNLOCK_CHECK_INTERVAL = 0.5
+# how often the poll rate readout is refreshed, in seconds
+POLL_RATE_INTERVAL = 1.0
+
 
 class MatrixTest(BasicEditor):
 
@@ -31,7 +41,26 @@ class MatrixTest(BasicEditor):
 
         self.addLayout(layout)
 
+        analytics_layout = QHBoxLayout()
+        self.analytics_chk = QCheckBox(tr("MatrixTest", "Record switch analytics"))
+        analytics_layout.addWidget(self.analytics_chk)
+        analytics_layout.addWidget(QLabel(tr("MatrixTest", "Chatter under:")))
+        self.chatter_spin = QSpinBox()
+        self.chatter_spin.setRange(1, 1000)
+        self.chatter_spin.setSuffix(" ms")
+        self.chatter_spin.setValue(CHATTER_MS)
+        analytics_layout.addWidget(self.chatter_spin)
+        self.analytics_lbl = QLabel()
+        analytics_layout.addWidget(self.analytics_lbl)
+        analytics_layout.addStretch()
+        self.export_btn = QPushButton(tr("MatrixTest", "Export..."))
+        self.export_btn.setEnabled(False)
+        analytics_layout.addWidget(self.export_btn)
+        self.addLayout(analytics_layout)
+
         btn_layout = QHBoxLayout()
+        self.poll_rate_lbl = QLabel()
+        btn_layout.addWidget(self.poll_rate_lbl)
         btn_layout.addStretch()
         self.unlock_lbl = QLabel(tr("MatrixTest", "Unlock the keyboard before testing:"))
         btn_layout.addWidget(self.unlock_lbl)
@@ -42,12 +71,25 @@ class MatrixTest(BasicEditor):
         self.keyboard = None
         self.device = None
         self.polling = False
+        self.matrix = None
+        # per-key transition statistics, while analytics are recorded
+        self.recorder = None
+        # widgets by matrix position, several layout options can share one
+        self.matrix_widgets = defaultdict(list)
+        self.unlocked = False
+        self.unlock_checked = 0
+        self.poll_count = 0
+        self.poll_rate_started = 0
 
         self.timer = QTimer()
+        self.timer.setTimerType(Qt.PreciseTimer)
         self.timer.timeout.connect(self.matrix_poller)
 
         self.unlock_btn.clicked.connect(self.unlock)
         self.reset_btn.clicked.connect(self.reset_keyboard_widget)
+        self.analytics_chk.toggled.connect(self.on_analytics_toggled)
+        self.chatter_spin.valueChanged.connect(self.on_chatter_changed)
+        self.export_btn.clicked.connect(self.on_export)
 
         self.grabber = QWidget()
 
@@ -57,23 +99,96 @@ class MatrixTest(BasicEditor):
             self.keyboard = device.keyboard
 
             self.keyboardWidget.set_keys(self.keyboard.keys, self.keyboard.encoders)
+            self.matrix = MatrixState(self.keyboard.rows, self.keyboard.cols)
+            self.matrix_widgets.clear()
+            for w in self.keyboardWidget.widgets:
+                if w.desc.row is not None and w.desc.col is not None and \
+                        w.desc.row < self.keyboard.rows and w.desc.col < self.keyboard.cols:
+                    self.matrix_widgets[(w.desc.row, w.desc.col)].append(w)
+            self.on_analytics_toggled(self.analytics_chk.isChecked())
         self.keyboardWidget.setEnabled(self.valid())
 
-    def valid(self):
+    @staticmethod
+    def valid_for(device):
         # Check if vial protocol is v3 or later
-        return isinstance(self.device, VialKeyboard) and \
-               (self.device.keyboard and self.device.keyboard.vial_protocol >= VIAL_PROTOCOL_MATRIX_TESTER) and \
-               ((self.device.keyboard.cols // 8 + 1) * self.device.keyboard.rows <= 28)
+        return isinstance(device, VialKeyboard) and \
+               (device.keyboard and device.keyboard.vial_protocol >= VIAL_PROTOCOL_MATRIX_TESTER) and \
+               device.keyboard.matrix_state_readable()
 
     def reset_keyboard_widget(self):
-        # reset keyboard widget
+        # reset keyboard widget, keys which are still held stay pressed
         for w in self.keyboardWidget.widgets:
             w.setPressed(False)
             w.setOn(False)
+        if self.matrix is not None:
+            for (row, col), widgets in self.matrix_widgets.items():
+                if self.matrix.pressed(row, col):
+                    for w in widgets:
+                        w.setPressed(True)
+                        w.setOn(True)
 
-        self.keyboardWidget.update_layout()
         self.keyboardWidget.update()
-        self.keyboardWidget.updateGeometry()
+
+        # a new session, e.g. for the next board on the line
+        if self.recorder is not None:
+            self.recorder.clear()
+            self.update_analytics()
+
+    def on_analytics_toggled(self, checked):
+        self.recorder = None
+        if checked and self.matrix is not None:
+            self.recorder = MatrixRecorder(self.keyboard.rows, self.keyboard.cols, self.matrix_widgets.keys(),
+                                           chatter_ms=self.chatter_spin.value())
+        self.export_btn.setEnabled(self.recorder is not None)
+        self.update_analytics()
+
+    def on_chatter_changed(self, value):
+        if self.recorder is not None:
+            self.recorder.chatter_ms = value
+
+    def update_analytics(self):
+        if self.recorder is None:
+            self.analytics_lbl.setText("")
+            return
+        presses = sum(self.recorder.presses)
+        chatter = sum(self.recorder.chatter)
+        chattering = sum(1 for count in self.recorder.chatter if count)
+        self.analytics_lbl.setText(tr("MatrixTest", "{} presses, {} chatter on {} keys")
+                                   .format(presses, chatter, chattering))
+
+    def on_export(self):
+        if self.recorder is None:
+            return
+        dialog = QFileDialog()
+        dialog.setDefaultSuffix("csv")
+        dialog.setAcceptMode(QFileDialog.AcceptSave)
+        dialog.setNameFilters(["Switch analytics (*.csv)", "Switch analytics with transitions (*.json)"])
+        dialog.filterSelected.connect(lambda name: dialog.setDefaultSuffix("json" if "json" in name else "csv"))
+        if dialog.exec_() == QDialog.Accepted:
+            self.recorder.export(dialog.selectedFiles()[0])
+
+    def check_unlocked(self):
+        """ Asks the keyboard whether it is unlocked, at most every UNLOCK_CHECK_INTERVAL once it is """
+
+        now = time.monotonic()
+        if self.unlocked and now - self.unlock_checked < UNLOCK_CHECK_INTERVAL:
+            return True
+        self.unlock_checked = now
+        self.unlocked = bool(self.keyboard.get_unlock_status(3))
+
+        self.unlock_btn.setVisible(not self.unlocked)
+        self.unlock_lbl.setVisible(not self.unlocked)
+        return self.unlocked
+
+    def update_poll_rate(self):
+        self.poll_count += 1
+        now = time.monotonic()
+        elapsed = now - self.poll_rate_started
+        if elapsed >= POLL_RATE_INTERVAL:
+            self.poll_rate_lbl.setText(tr("MatrixTest", "Polling at {} Hz").format(round(self.poll_count / elapsed)))
+            self.poll_count = 0
+            self.poll_rate_started = now
+            self.update_analytics()
 
     def matrix_poller(self):
         if not self.valid():
@@ -81,74 +196,41 @@ class MatrixTest(BasicEditor):
             return
 
         try:
-            unlocked = self.keyboard.get_unlock_status(3)
+            unlocked = self.check_unlocked()
+            changes = self.matrix.update(self.keyboard.matrix_state()) if unlocked else []
         except (RuntimeError, ValueError):
             self.timer.stop()
-            return
-
+            unlocked = False
         if not unlocked:
-            self.unlock_btn.show()
-            self.unlock_lbl.show()
+            if self.recorder is not None:
+                self.recorder.pause()
             return
 
-        # we're unlocked, so hide unlock button and label
-        self.unlock_btn.hide()
-        self.unlock_lbl.hide()
+        if self.recorder is not None:
+            self.recorder.frame(changes)
+        self.update_poll_rate()
 
-        # Get size for matrix
-        rows = self.keyboard.rows
-        cols = self.keyboard.cols
-        # Generate 2d array of matrix
-        matrix = [[None] * cols for x in range(rows)]
-
-        # Get matrix data from keyboard
-        try:
-            data = self.keyboard.matrix_poll()
-        except (RuntimeError, ValueError):
-            self.timer.stop()
-            return
-
-        # Calculate the amount of bytes belong to 1 row, each bit is 1 key, so per 8 keys in a row,
-        # a byte is needed for the row.
-        row_size = math.ceil(cols / 8)
-
-        for row in range(rows):
-            # Make slice of bytes for the row (skip first 2 bytes, they're for VIAL)
-            row_data_start = 2 + (row * row_size)
-            row_data_end = row_data_start + row_size
-            row_data = data[row_data_start:row_data_end]
-
-            # Get each bit representing pressed state for col
-            for col in range(cols):
-                # row_data is array of bytes, calculate in which byte the col is located
-                col_byte = len(row_data) - 1 - math.floor(col / 8)
-                # since we select a single byte as slice of byte, mod 8 to get nth pos of byte
-                col_mod = (col % 8)
-                # write to matrix array
-                matrix[row][col] = (row_data[col_byte] >> col_mod) & 1
-
-        # write matrix state to keyboard widget
-        for w in self.keyboardWidget.widgets:
-            if w.desc.row is not None and w.desc.col is not None:
-                row = w.desc.row
-                col = w.desc.col
-
-                if row < len(matrix) and col < len(matrix[row]):
-                    w.setPressed(matrix[row][col])
-                    if matrix[row][col]:
-                        w.setOn(True)
-
-        self.keyboardWidget.update_layout()
-        self.keyboardWidget.update()
-        self.keyboardWidget.updateGeometry()
+        # geometry never changes while polling, only repaint keys which changed state
+        for row, col, pressed in changes:
+            for w in self.matrix_widgets.get((row, col), ()):
+                w.setPressed(pressed)
+                w.setOn(w.on or pressed)
+                self.keyboardWidget.update_key(w)
 
     def unlock(self):
         Unlocker.unlock(self.keyboard)
 
     def activate(self):
         self.grabber.grabKeyboard()
-        self.timer.start(20)
+        # switches which changed while inactive show up in the first poll, as the difference to the last one
+        self.unlocked = False
+        self.poll_count = 0
+        self.poll_rate_started = time.monotonic()
+        self.poll_rate_lbl.setText("")
+        self.timer.start(POLL_INTERVAL_MS)
 
     def deactivate(self):
         self.grabber.releaseKeyboard()
         self.timer.stop()
+        if self.recorder is not None:
+            self.recorder.pause()
@@ -96,6 +96,10 @@ class IntegerOption(GenericOption):
 
 class QmkSettings(BasicEditor):
 
+    appctx = None
+    settings_defs = None
+    qsid_fields = None
+
     def __init__(self):
         super().__init__()
         self.keyboard = None
@@ -149,7 +153,7 @@ class QmkSettings(BasicEditor):
             self.tabs_widget.removeTab(0)
 
         # create new GUI
-        for tab in self.settings_defs["tabs"]:
+        for tab in self.load()["tabs"]:
             # don't bother creating tabs that would be empty - i.e. at least one qsid in a tab should be supported
             use_tab = False
             for field in tab["fields"]:
@@ -227,28 +231,39 @@ class QmkSettings(BasicEditor):
             self.keyboard.qmk_settings_reset()
             self.reload_settings()
 
-    def valid(self):
-        return isinstance(self.device, VialKeyboard) and \
-               (self.device.keyboard and self.device.keyboard.vial_protocol >= VIAL_PROTOCOL_QMK_SETTINGS
-                and len(self.device.keyboard.supported_settings))
+    @staticmethod
+    def valid_for(device):
+        return isinstance(device, VialKeyboard) and \
+               (device.keyboard and device.keyboard.vial_protocol >= VIAL_PROTOCOL_QMK_SETTINGS
+                and len(device.keyboard.supported_settings))
 
     @classmethod
     def initialize(cls, appctx):
-        cls.qsid_fields = defaultdict(list)
-        with open(appctx.get_resource("qmk_settings.json"), "r") as inf:
-            cls.settings_defs = json.load(inf)
-        for tab in cls.settings_defs["tabs"]:
-            for field in tab["fields"]:
-                cls.qsid_fields[field["qsid"]].append(field)
+        cls.appctx = appctx
+
+    @classmethod
+    def load(cls):
+        """ Parse qmk_settings.json the first time settings are needed, rather than at startup """
+        if cls.settings_defs is None:
+            with open(cls.appctx.get_resource("qmk_settings.json"), "r") as inf:
+                settings_defs = json.load(inf)
+            cls.qsid_fields = defaultdict(list)
+            for tab in settings_defs["tabs"]:
+                for field in tab["fields"]:
+                    cls.qsid_fields[field["qsid"]].append(field)
+            cls.settings_defs = settings_defs
+        return cls.settings_defs
 
     @classmethod
     def is_qsid_supported(cls, qsid):
         """ Return whether this qsid is supported by the settings editor """
+        cls.load()
         return qsid in cls.qsid_fields
 
     @classmethod
     def qsid_serialize(cls, qsid, data):
         """ Serialize from internal representation into binary that can be sent to the firmware """
+        cls.load()
         fields = cls.qsid_fields[qsid]
         if fields[0]["type"] == "boolean":
             assert isinstance(data, int)
@@ -261,6 +276,7 @@ class QmkSettings(BasicEditor):
     @classmethod
     def qsid_deserialize(cls, qsid, data):
         """ Deserialize from binary received from firmware into internal representation """
+        cls.load()
         fields = cls.qsid_fields[qsid]
         if fields[0]["type"] == "boolean":
             return int.from_bytes(data[0:fields[0].get("width", 1)], byteorder="little")
@@ -412,10 +412,11 @@ class RGBConfigurator(BasicEditor):
     def on_save(self):
         self.device.keyboard.save_rgb()
 
-    def valid(self):
-        return isinstance(self.device, VialKeyboard) and \
-               (self.device.keyboard.lighting_qmk_rgblight or self.device.keyboard.lighting_qmk_backlight
-                or self.device.keyboard.lighting_vialrgb)
+    @staticmethod
+    def valid_for(device):
+        return isinstance(device, VialKeyboard) and \
+               (device.keyboard.lighting_qmk_rgblight or device.keyboard.lighting_qmk_backlight
+                or device.keyboard.lighting_vialrgb)
 
     def block_signals(self):
         for h in self.handlers:
@@ -4,6 +4,7 @@ from PyQt5.QtCore import pyqtSignal, QObject
 from PyQt5.QtWidgets import QTabWidget, QWidget, QSizePolicy, QGridLayout, QVBoxLayout, QLabel, QHBoxLayout, \
     QPushButton, QSpinBox
 
+from constants import DYNAMIC_ENTRIES_MAX
 from protocol.constants import VIAL_PROTOCOL_DYNAMIC
 from widgets.key_widget import KeyWidget
 from tabbed_keycodes import TabbedKeycodes
@@ -107,11 +108,6 @@ class TapDance(BasicEditor):
         self.tap_dance_entries = []
         self.tap_dance_entries_available = []
         self.tabs = TabWidgetWithKeycodes()
-        for x in range(128):
-            entry = TapDanceEntryUI(x)
-            entry.key_changed.connect(self.on_key_changed)
-            entry.timing_changed.connect(self.on_timing_changed)
-            self.tap_dance_entries_available.append(entry)
 
         self.addWidget(self.tabs)
         buttons = QHBoxLayout()
@@ -127,7 +123,13 @@ class TapDance(BasicEditor):
     def rebuild_ui(self):
         while self.tabs.count() > 0:
             self.tabs.removeTab(0)
-        self.tap_dance_entries = self.tap_dance_entries_available[:self.keyboard.tap_dance_count]
+        count = min(self.keyboard.tap_dance_count, DYNAMIC_ENTRIES_MAX)
+        while len(self.tap_dance_entries_available) < count:
+            entry = TapDanceEntryUI(len(self.tap_dance_entries_available))
+            entry.key_changed.connect(self.on_key_changed)
+            entry.timing_changed.connect(self.on_timing_changed)
+            self.tap_dance_entries_available.append(entry)
+        self.tap_dance_entries = self.tap_dance_entries_available[:count]
         for x, e in enumerate(self.tap_dance_entries):
             self.tabs.addTab(e.widget(), str(x))
         self.reload_ui()
@@ -152,10 +154,11 @@ class TapDance(BasicEditor):
             self.keyboard = device.keyboard
             self.rebuild_ui()
 
-    def valid(self):
-        return isinstance(self.device, VialKeyboard) and \
-               (self.device.keyboard and self.device.keyboard.vial_protocol >= VIAL_PROTOCOL_DYNAMIC
-                and self.device.keyboard.tap_dance_count > 0)
+    @staticmethod
+    def valid_for(device):
+        return isinstance(device, VialKeyboard) and \
+               (device.keyboard and device.keyboard.vial_protocol >= VIAL_PROTOCOL_DYNAMIC
+                and device.keyboard.tap_dance_count > 0)
 
     def on_key_changed(self):
         self.on_save()
@@ -3,10 +3,14 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
 
 import sys
+from functools import lru_cache
 
 from keycodes.keycodes_v5 import keycodes_v5
 from keycodes.keycodes_v6 import keycodes_v6
 
+# how many conversions Keycode.serialize and Keycode.deserialize remember, each
+KEYCODE_CACHE_SIZE = 16384
+
 
 class Keycode:
 
@@ -15,6 +19,8 @@ class Keycode:
     qmk_id_to_keycode = dict()
     protocol = 0
     hidden = False
+    # bumped whenever keycodes are regenerated, so that anything derived from them knows to rebuild
+    generation = 0
 
     def __init__(self, qmk_id, label, tooltip=None, masked=False, printable=None, recorder_alias=None, alias=None, requires_feature=None):
         self.qmk_id = qmk_id
@@ -107,12 +113,12 @@ class Keycode:
     @classmethod
     def serialize(cls, code):
         """ Converts integer keycode to string """
-        if cls.protocol == 6:
-            masked = keycodes_v6.masked
-        else:
-            masked = keycodes_v5.masked
+        return cls.serialize_cached(cls.protocol, code)
 
-        if (code & 0xFF00) not in masked:
+    @staticmethod
+    @lru_cache(maxsize=KEYCODE_CACHE_SIZE)
+    def serialize_cached(protocol, code):
+        if not KeycodeTable.get(protocol).masked[(code & 0xFF00) >> 8]:
             kc = RAWCODES_MAP.get(code)
             if kc is not None:
                 return kc.qmk_id
@@ -127,20 +133,33 @@ class Keycode:
     def deserialize(cls, val, reraise=False):
         """ Converts string keycode to integer """
 
-        from any_keycode import AnyKeycode
-
         if isinstance(val, int):
             return val
         if val in cls.qmk_id_to_keycode:
             return cls.resolve(cls.qmk_id_to_keycode[val].qmk_id)
-        anykc = AnyKeycode()
         try:
-            return anykc.decode(val)
+            return cls.deserialize_cached(cls.protocol, val)
         except Exception:
             if reraise:
                 raise
         return 0
 
+    @staticmethod
+    @lru_cache(maxsize=KEYCODE_CACHE_SIZE)
+    def deserialize_cached(protocol, val):
+        # invalid values raise, and exceptions are not cached
+        from any_keycode import AnyKeycode
+
+        return AnyKeycode.get().decode(val)
+
+    @classmethod
+    def invalidate_caches(cls):
+        """ Forgets memoized conversions, needs to be called whenever keycodes are regenerated """
+
+        cls.serialize_cached.cache_clear()
+        cls.deserialize_cached.cache_clear()
+        cls.generation += 1
+
     @classmethod
     def normalize(cls, code):
         """ Changes e.g. KC_PERC to LSFT(KC_5) """
@@ -799,21 +818,73 @@ KEYCODES = []
 KEYCODES_MAP = dict()
 RAWCODES_MAP = dict()
 
+# every keycode list in the order they make up KEYCODES, later lists win on conflicts in KEYCODES_MAP and
+# RAWCODES_MAP; True for lists which are generated per keyboard
+KEYCODE_LISTS = [
+    (KEYCODES_SPECIAL, False), (KEYCODES_BASIC, False), (KEYCODES_SHIFTED, False), (KEYCODES_ISO, False),
+    (KEYCODES_LAYERS, True), (KEYCODES_BOOT, False), (KEYCODES_MODIFIERS, False), (KEYCODES_QUANTUM, False),
+    (KEYCODES_BACKLIGHT, False), (KEYCODES_MEDIA, False), (KEYCODES_TAP_DANCE, True), (KEYCODES_MACRO, True),
+    (KEYCODES_USER, True), (KEYCODES_HIDDEN, False), (KEYCODES_MIDI, True),
+]
+
 K = None
 
 
+class KeycodeTable:
+
+    """
+    Lookups for one protocol version which don't depend on the keyboard: the fixed keycode lists by qmk_id
+    and by raw code, and which high bytes are masked keycodes. Built the first time a protocol is used,
+    every device open after that only adds its own keycodes on top.
+    """
+
+    tables = dict()
+
+    def __init__(self, protocol):
+        masked = keycodes_v6.masked if protocol == 6 else keycodes_v5.masked
+        self.masked = bytes(1 if (x << 8) in masked else 0 for x in range(256))
+
+        # indexed like KEYCODE_LISTS, None for lists which are generated per keyboard
+        self.by_qmk_id = []
+        self.by_code = []
+        kc = keycodes_v6.kc if protocol == 6 else keycodes_v5.kc
+        for keycodes, per_keyboard in KEYCODE_LISTS:
+            if per_keyboard:
+                self.by_qmk_id.append(None)
+                self.by_code.append(None)
+                continue
+            self.by_qmk_id.append({keycode.qmk_id.replace("(kc)", ""): keycode for keycode in keycodes})
+            by_code = dict()
+            for keycode in keycodes:
+                if keycode.qmk_id not in kc:
+                    raise RuntimeError("unable to resolve qmk_id={}".format(keycode.qmk_id))
+                by_code[kc[keycode.qmk_id]] = keycode
+            self.by_code.append(by_code)
+
+    @classmethod
+    def get(cls, protocol):
+        if protocol not in cls.tables:
+            cls.tables[protocol] = KeycodeTable(protocol)
+        return cls.tables[protocol]
+
+
 def recreate_keycodes():
     """ Regenerates global KEYCODES array """
 
+    table = KeycodeTable.get(Keycode.protocol)
     KEYCODES.clear()
-    KEYCODES.extend(KEYCODES_SPECIAL + KEYCODES_BASIC + KEYCODES_SHIFTED + KEYCODES_ISO + KEYCODES_LAYERS +
-                    KEYCODES_BOOT + KEYCODES_MODIFIERS + KEYCODES_QUANTUM + KEYCODES_BACKLIGHT + KEYCODES_MEDIA +
-                    KEYCODES_TAP_DANCE + KEYCODES_MACRO + KEYCODES_USER + KEYCODES_HIDDEN + KEYCODES_MIDI)
     KEYCODES_MAP.clear()
     RAWCODES_MAP.clear()
-    for keycode in KEYCODES:
-        KEYCODES_MAP[keycode.qmk_id.replace("(kc)", "")] = keycode
-        RAWCODES_MAP[Keycode.deserialize(keycode.qmk_id)] = keycode
+    for idx, (keycodes, per_keyboard) in enumerate(KEYCODE_LISTS):
+        KEYCODES.extend(keycodes)
+        if per_keyboard:
+            for keycode in keycodes:
+                KEYCODES_MAP[keycode.qmk_id.replace("(kc)", "")] = keycode
+                RAWCODES_MAP[Keycode.resolve(keycode.qmk_id)] = keycode
+        else:
+            KEYCODES_MAP.update(table.by_qmk_id[idx])
+            RAWCODES_MAP.update(table.by_code[idx])
+    Keycode.invalidate_caches()
 
 
 def create_user_keycodes():
@@ -1,4 +1,9 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
+import time
+
+# for --profile-startup
+started = time.perf_counter()
+
 import ssl
 import certifi
 import os
@@ -6,6 +11,9 @@ import os
 if ssl.get_default_verify_paths().cafile is None:
     os.environ['SSL_CERT_FILE'] = certifi.where()
 
+import cProfile
+import io
+import pstats
 import traceback
 
 from PyQt5 import QtWidgets, QtCore
@@ -22,6 +30,8 @@ from main_window import MainWindow
 # http://timlehr.com/python-exception-hooks-with-qt-message-box/
 from util import init_logger
 
+imported = time.perf_counter()
+
 
 def show_exception_box(log_msg):
     if QtWidgets.QApplication.instance() is not None:
@@ -55,6 +65,38 @@ class UncaughtHook(QtCore.QObject):
             self._exception_caught.emit(log_msg)
         sys._excepthook(exc_type, exc_value, exc_traceback)
 
+
+class StartupProfile:
+
+    """
+    Timings of application startup, printed to stderr once the main window is shown and the event loop runs.
+    Imports before main() are timed as a whole, run with python -X importtime for a per-module breakdown.
+    """
+
+    def __init__(self):
+        self.phases = [("imports", started, imported)]
+        self.last = time.perf_counter()
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+
+    def phase(self, name):
+        now = time.perf_counter()
+        self.phases.append((name, self.last, now))
+        self.last = now
+
+    def report(self):
+        self.phase("first event loop iteration")
+        self.profiler.disable()
+
+        out = io.StringIO()
+        out.write("Startup:\n")
+        for name, start, end in self.phases:
+            out.write("  {:<28} {:>8.1f}ms\n".format(name, (end - start) * 1000))
+        out.write("  {:<28} {:>8.1f}ms\n\n".format("total", (self.last - started) * 1000))
+        pstats.Stats(self.profiler, stream=out).sort_stats("cumulative").print_stats(30)
+        sys.stderr.write(out.getvalue())
+
+
 class VialApplicationContext(ApplicationContext):
     @cached_property
     def app(self):
@@ -76,10 +118,22 @@ if __name__ == '__main__':
 
         linux_keystroke_recorder()
     else:
+        profile = None
+        if "--profile-startup" in sys.argv:
+            sys.argv.remove("--profile-startup")
+            profile = StartupProfile()
+
         appctxt = VialApplicationContext()       # 1. Instantiate ApplicationContext
         init_logger()
         qt_exception_hook = UncaughtHook()
+        if profile:
+            profile.phase("application")
         window = MainWindow(appctxt)
+        if profile:
+            profile.phase("main window")
         window.show()
+        if profile:
+            profile.phase("show")
+            QtCore.QTimer.singleShot(0, profile.report)
         exit_code = appctxt.app.exec_()      # 2. Invoke appctxt.app.exec_()
         sys.exit(exit_code)
@@ -5,7 +5,7 @@ from json import JSONDecodeError
 
 from PyQt5.QtCore import Qt, QSettings, QStandardPaths, QTimer, QRect, QT_VERSION_STR
 from PyQt5.QtWidgets import QWidget, QComboBox, QToolButton, QHBoxLayout, QVBoxLayout, QMainWindow, QAction, qApp, \
-    QFileDialog, QDialog, QTabWidget, QActionGroup, QMessageBox, QLabel
+    QFileDialog, QDialog, QTabWidget, QActionGroup, QMessageBox, QLabel, QProgressBar
 
 import os
 import sys
@@ -15,12 +15,14 @@ from autorefresh.autorefresh import Autorefresh
 from editor.alt_repeat_key import AltRepeatKey
 from editor.combos import Combos
 from constants import WINDOW_WIDTH, WINDOW_HEIGHT
-from widgets.editor_container import EditorContainer
+from widgets.editor_container import EditorContainer, LazyEditor
 from editor.firmware_flasher import FirmwareFlasher
 from editor.key_override import KeyOverride
-from protocol.keyboard_comm import ProtocolError
+from protocol.keyboard_comm import ProtocolError, RELOAD_PARTS_USER
+from protocol.trace import PacketTrace
 from editor.keymap_editor import KeymapEditor
-from keymaps import KEYMAPS
+from keycodes.keycodes import recreate_keyboard_keycodes
+from keymaps import KEYMAPS, load_keymap
 from editor.layout_editor import LayoutEditor
 from editor.macro_recorder import MacroRecorder
 from editor.qmk_settings import QmkSettings
@@ -68,30 +70,54 @@ class MainWindow(QMainWindow):
         self.btn_refresh_devices.setText(tr("MainWindow", "Refresh"))
         self.btn_refresh_devices.clicked.connect(self.on_click_refresh)
 
+        self.progress_loading = QProgressBar()
+        self.progress_loading.setMaximumWidth(150)
+        self.progress_loading.setFormat(tr("MainWindow", "Loading..."))
+        self.progress_loading.hide()
+
         layout_combobox = QHBoxLayout()
         layout_combobox.addWidget(self.combobox_devices)
+        layout_combobox.addWidget(self.progress_loading)
         if sys.platform != "emscripten":
             layout_combobox.addWidget(self.btn_refresh_devices)
 
+        # layout and keymap editors are used outside of their tabs, every other editor is only constructed
+        # once its tab is first opened
         self.layout_editor = LayoutEditor()
         self.keymap_editor = KeymapEditor(self.layout_editor)
-        self.firmware_flasher = FirmwareFlasher(self)
-        self.macro_recorder = MacroRecorder()
-        self.tap_dance = TapDance()
-        self.combos = Combos()
-        self.key_override = KeyOverride()
-        self.alt_repeat_key = AltRepeatKey()
+        self.layout_editor_slot = LazyEditor.constructed(self.layout_editor)
+        self.keymap_editor_slot = LazyEditor.constructed(self.keymap_editor)
+        self.firmware_flasher = LazyEditor(FirmwareFlasher, self)
+        self.macro_recorder = LazyEditor(MacroRecorder)
+        self.tap_dance = LazyEditor(TapDance)
+        self.combos = LazyEditor(Combos)
+        self.key_override = LazyEditor(KeyOverride)
+        self.alt_repeat_key = LazyEditor(AltRepeatKey)
         QmkSettings.initialize(appctx)
-        self.qmk_settings = QmkSettings()
-        self.matrix_tester = MatrixTest(self.layout_editor)
-        self.rgb_configurator = RGBConfigurator()
+        self.qmk_settings = LazyEditor(QmkSettings)
+        self.matrix_tester = LazyEditor(MatrixTest, self.layout_editor)
+        self.rgb_configurator = LazyEditor(RGBConfigurator)
 
-        self.editors = [(self.keymap_editor, "Keymap"), (self.layout_editor, "Layout"), (self.macro_recorder, "Macros"),
-                        (self.rgb_configurator, "Lighting"), (self.tap_dance, "Tap Dance"), (self.combos, "Combos"),
+        self.editors = [(self.keymap_editor_slot, "Keymap"), (self.layout_editor_slot, "Layout"),
+                        (self.macro_recorder, "Macros"), (self.rgb_configurator, "Lighting"),
+                        (self.tap_dance, "Tap Dance"), (self.combos, "Combos"),
                         (self.key_override, "Key Overrides"), (self.alt_repeat_key, "Alt Repeat Key"),
                         (self.qmk_settings, "QMK Settings"), (self.matrix_tester, "Matrix tester"),
                         (self.firmware_flasher, "Firmware updater")]
 
+        # which part of Keyboard.reload each editor is built from, in the order editors are rebuilt in;
+        # the firmware updater saves the whole layout before flashing, so it waits for the last part
+        self.editor_parts = [(self.layout_editor_slot, "keymap"), (self.keymap_editor_slot, "keymap"),
+                             (self.firmware_flasher, "settings"), (self.macro_recorder, "macros"),
+                             (self.tap_dance, "tap_dance"), (self.combos, "combo"),
+                             (self.key_override, "key_override"), (self.alt_repeat_key, "alt_repeat_key"),
+                             (self.qmk_settings, "settings"), (self.matrix_tester, "keymap"),
+                             (self.rgb_configurator, "rgb")]
+
+        # while a device is loading in background, only editors in loaded_editors are shown
+        self.device_loader = None
+        self.loaded_editors = None
+
         Unlocker.global_layout_editor = self.layout_editor
         Unlocker.global_main_window = self
 
@@ -233,6 +259,23 @@ class MainWindow(QMainWindow):
             if theme_group.checkedAction() is None:
                 theme_group.actions()[0].setChecked(True)
 
+        if sys.platform != "emscripten":
+            trace_record_act = QAction(tr("MenuDebug", "Record protocol trace"), self)
+            trace_record_act.setCheckable(True)
+            trace_record_act.toggled.connect(self.on_trace_toggled)
+            trace_show_act = QAction(tr("MenuDebug", "Show protocol trace..."), self)
+            trace_show_act.triggered.connect(self.on_trace_show)
+            trace_export_act = QAction(tr("MenuDebug", "Export protocol trace..."), self)
+            trace_export_act.triggered.connect(self.on_trace_export)
+            trace_clear_act = QAction(tr("MenuDebug", "Clear protocol trace"), self)
+            trace_clear_act.triggered.connect(lambda: PacketTrace.get().clear())
+
+            self.debug_menu = self.menuBar().addMenu(tr("Menu", "Debug"))
+            self.debug_menu.addAction(trace_record_act)
+            self.debug_menu.addAction(trace_show_act)
+            self.debug_menu.addAction(trace_export_act)
+            self.debug_menu.addAction(trace_clear_act)
+
         about_vial_act = QAction(tr("MenuAbout", "About Vial..."), self)
         about_vial_act.triggered.connect(self.about_vial)
         self.about_keyboard_act = QAction("", self)
@@ -241,6 +284,10 @@ class MainWindow(QMainWindow):
         self.about_menu.addAction(self.about_keyboard_act)
         self.about_menu.addAction(about_vial_act)
 
+        # actions which read or write the whole keyboard, unavailable while it's locked or still loading
+        self.keyboard_actions = [layout_load_act, layout_save_act, self.security_menu.menuAction(),
+                                 self.about_keyboard_act]
+
     def on_layout_loaded(self, layout):
         """
         Receives a message from the JS bridge when a layout has
@@ -282,6 +329,27 @@ class MainWindow(QMainWindow):
                 with open(dialog.selectedFiles()[0], "wb") as outf:
                     outf.write(self.keymap_editor.save_layout())
 
+    def on_trace_toggled(self, checked):
+        PacketTrace.get().enabled = checked
+
+    def on_trace_show(self):
+        dump = PacketTrace.get().dump()
+        logging.info("Protocol trace:\n%s", dump)
+        msg = QMessageBox(self)
+        msg.setWindowTitle(tr("MenuDebug", "Protocol trace"))
+        msg.setText(tr("MenuDebug", "Time spent communicating with the keyboard, see details. "
+                                    "Reconnect the keyboard while recording to trace loading it."))
+        msg.setDetailedText(dump)
+        msg.exec_()
+
+    def on_trace_export(self):
+        dialog = QFileDialog()
+        dialog.setDefaultSuffix("json")
+        dialog.setAcceptMode(QFileDialog.AcceptSave)
+        dialog.setNameFilters(["Protocol trace (*.json)"])
+        if dialog.exec_() == QDialog.Accepted:
+            PacketTrace.get().export(dialog.selectedFiles()[0])
+
     def on_click_refresh(self):
         self.autorefresh.update(quiet=False, hard=True)
 
@@ -307,11 +375,69 @@ class MainWindow(QMainWindow):
             self.on_device_selected()
 
     def on_device_selected(self):
-        try:
-            self.autorefresh.select_device(self.combobox_devices.currentIndex())
-        except ProtocolError:
+        if self.device_loader is not None:
+            # previous device stops loading in background, its results are discarded
+            self.finish_loading()
+
+        loader = self.autorefresh.select_device(self.combobox_devices.currentIndex())
+        if loader is None:
+            self.rebuild()
+            self.refresh_tabs()
+            return
+
+        self.device_loader = loader
+        self.loaded_editors = set()
+        self.refresh_tabs()
+        # device list and actions reading the whole keyboard stay locked until loading is done, editors become
+        # usable as soon as their data arrives
+        self.lock_ui()
+        self.tabs.setEnabled(True)
+        self.progress_loading.setValue(0)
+        self.progress_loading.show()
+        loader.keycodes.connect(self.on_device_keycodes)
+        loader.progress.connect(self.on_device_progress)
+        loader.loaded.connect(self.on_device_loaded)
+        loader.start()
+
+    def on_device_keycodes(self, keyboard):
+        # editors paint from the global keycode lists, so they are only regenerated on this thread
+        loader = self.sender()
+        if loader is self.device_loader:
+            recreate_keyboard_keycodes(keyboard)
+        loader.keycodes_done()
+
+    def on_device_progress(self, device, part, done, total):
+        if self.sender() is not self.device_loader:
+            return
+
+        self.progress_loading.setMaximum(total)
+        self.progress_loading.setValue(done)
+
+        editors = [e for e, e_part in self.editor_parts if e_part == part]
+        if editors:
+            for e in editors:
+                e.rebuild(device)
+            self.loaded_editors.update(editors)
+            self.refresh_tabs()
+
+    def finish_loading(self):
+        self.device_loader = None
+        self.loaded_editors = None
+        self.progress_loading.hide()
+        self.unlock_ui()
+
+    def on_device_loaded(self, device, error):
+        if self.sender() is not self.device_loader:
+            return
+
+        loaded = self.loaded_editors
+        self.finish_loading()
+
+        if isinstance(error, ProtocolError):
             QMessageBox.warning(self, "", "Unsupported protocol version!\n"
                                           "Please download latest Vial from https://get.vial.today/")
+        elif error is not None:
+            raise error
 
         if isinstance(self.autorefresh.current_device, VialKeyboard):
             keyboard_id = self.autorefresh.current_device.keyboard.keyboard_id
@@ -319,10 +445,10 @@ class MainWindow(QMainWindow):
                 QMessageBox.warning(self, "", "An example keyboard UID was detected.\n"
                                               "Please change your keyboard UID to be unique before you ship!")
 
-        self.rebuild()
+        self.rebuild([e for e, part in self.editor_parts if e not in loaded])
         self.refresh_tabs()
 
-    def rebuild(self):
+    def rebuild(self, editors=None):
         # don't show "Security" menu for bootloader mode, as the bootloader is inherently insecure
         self.security_menu.menuAction().setVisible(isinstance(self.autorefresh.current_device, VialKeyboard))
 
@@ -334,21 +460,36 @@ class MainWindow(QMainWindow):
         # if unlock process was interrupted, we must finish it first
         if isinstance(self.autorefresh.current_device, VialKeyboard) and self.autorefresh.current_device.keyboard.get_unlock_in_progress():
             Unlocker.unlock(self.autorefresh.current_device.keyboard)
-            self.autorefresh.current_device.keyboard.reload()
+            # layout and keyboard capabilities can't change by unlocking, only refetch what user could've edited
+            self.autorefresh.current_device.keyboard.reload(parts=RELOAD_PARTS_USER)
+            # which means every editor has to pick up the new data
+            editors = None
 
-        for e in [self.layout_editor, self.keymap_editor, self.firmware_flasher, self.macro_recorder,
-                  self.tap_dance, self.combos, self.key_override, self.alt_repeat_key,
-                  self.qmk_settings, self.matrix_tester, self.rgb_configurator]:
-            e.rebuild(self.autorefresh.current_device)
+        for e, part in self.editor_parts:
+            if editors is None or e in editors:
+                e.rebuild(self.autorefresh.current_device)
 
     def refresh_tabs(self):
+        current = self.tabs.currentWidget()
+        current = current.slot if current is not None else None
+
+        # clearing walks through every remaining tab, which would open (and construct) each editor in turn
+        self.tabs.blockSignals(True)
         self.tabs.clear()
         for container, lbl in self.editors:
             if not container.valid():
                 continue
+            if self.loaded_editors is not None and container not in self.loaded_editors:
+                continue
 
             c = EditorContainer(container)
             self.tabs.addTab(c, tr("MainWindow", lbl))
+            # stay on the same editor as tabs appear while loading
+            if container is current:
+                self.tabs.setCurrentWidget(c)
+        self.tabs.blockSignals(False)
+        if self.tabs.currentWidget() is not self.current_tab:
+            self.on_tab_changed(self.tabs.currentIndex())
 
     def load_via_stack_json(self):
         from urllib.request import urlopen
@@ -385,6 +526,8 @@ class MainWindow(QMainWindow):
         if self.ui_lock_count == 1:
             self.autorefresh._lock()
             self.tabs.setEnabled(False)
+            for act in self.keyboard_actions:
+                act.setEnabled(False)
             self.combobox_devices.setEnabled(False)
             self.btn_refresh_devices.setEnabled(False)
 
@@ -393,6 +536,8 @@ class MainWindow(QMainWindow):
         if self.ui_lock_count == 0:
             self.autorefresh._unlock()
             self.tabs.setEnabled(True)
+            for act in self.keyboard_actions:
+                act.setEnabled(True)
             self.combobox_devices.setEnabled(True)
             self.btn_refresh_devices.setEnabled(True)
 
@@ -411,7 +556,7 @@ class MainWindow(QMainWindow):
 
     def change_keyboard_layout(self, index):
         self.settings.setValue("keymap", KEYMAPS[index][0])
-        KeycodeDisplay.set_keymap_override(KEYMAPS[index][1])
+        KeycodeDisplay.set_keymap_override(load_keymap(index))
 
     def get_theme(self):
         return self.settings.value("theme", "Dark")
@@ -464,4 +609,6 @@ class MainWindow(QMainWindow):
         self.settings.setValue("pos", self.pos())
         self.settings.setValue("maximized", self.isMaximized())
 
+        self.autorefresh.stop_loading()
+
         e.accept()
@@ -5,6 +5,7 @@ from keycodes.keycodes import Keycode, RESET_KEYCODE
 from protocol.base_protocol import BaseProtocol
 from protocol.constants import DYNAMIC_VIAL_ALT_REPEAT_KEY_GET, CMD_VIA_VIAL_PREFIX, CMD_VIAL_DYNAMIC_ENTRY_OP, \
     DYNAMIC_VIAL_ALT_REPEAT_KEY_SET
+from protocol.trace import traced
 from unlocker import Unlocker
 
 
@@ -69,6 +70,7 @@ class AltRepeatKeyEntry:
 
 class ProtocolAltRepeatKey(BaseProtocol):
 
+    @traced
     def reload_alt_repeat_key(self):
         entries = self._retrieve_dynamic_entries(DYNAMIC_VIAL_ALT_REPEAT_KEY_GET,
                                                  self.alt_repeat_key_count, "<HHBB")
@@ -92,9 +94,17 @@ class ProtocolAltRepeatKey(BaseProtocol):
     def save_alt_repeat_key(self):
         return [e.save() for e in self.alt_repeat_key_entries]
 
-    def restore_alt_repeat_key(self, data):
+    def restore_alt_repeat_key_entries(self, data):
+        """ Returns (index, entry) pairs of saved entries which differ from the keyboard """
+        out = []
         for x, e in enumerate(data):
             if x < self.alt_repeat_key_count:
                 ko = AltRepeatKeyEntry()
                 ko.restore(e)
-                self.alt_repeat_key_set(x, ko)
+                if ko != self.alt_repeat_key_entries[x]:
+                    out.append((x, ko))
+        return out
+
+    def restore_alt_repeat_key(self, data):
+        for x, ko in self.restore_alt_repeat_key_entries(data):
+            self.alt_repeat_key_set(x, ko)
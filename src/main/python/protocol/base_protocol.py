@@ -7,12 +7,17 @@ from protocol.constants import CMD_VIA_VIAL_PREFIX, CMD_VIAL_DYNAMIC_ENTRY_OP
 class BaseProtocol:
     vial_protocol = None
     usb_send = NotImplemented
+    usb_send_batch = NotImplemented
     dev = None
 
     macro_count = 0
     macro_memory = 0
     macro = b""
 
+    def _usb_send_sequential(self, dev, msgs, retries=1, echo=0, fifo=False):
+        """ Fallback for usb_send_batch when the transport can't pipeline, sends messages one by one """
+        return [self.usb_send(dev, msg, retries=retries) for msg in msgs]
+
     def _retrieve_dynamic_entries(self, cmd, count, fmt):
         out = []
         for x in range(count):
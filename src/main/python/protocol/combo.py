@@ -5,11 +5,13 @@ from keycodes.keycodes import Keycode, RESET_KEYCODE
 from protocol.base_protocol import BaseProtocol
 from protocol.constants import CMD_VIA_VIAL_PREFIX, CMD_VIAL_DYNAMIC_ENTRY_OP, DYNAMIC_VIAL_COMBO_GET, \
     DYNAMIC_VIAL_COMBO_SET
+from protocol.trace import traced
 from unlocker import Unlocker
 
 
 class ProtocolCombo(BaseProtocol):
 
+    @traced
     def reload_combo(self):
         self.combo_entries = self._retrieve_dynamic_entries(DYNAMIC_VIAL_COMBO_GET,
                                                             self.combo_count, "<HHHHH")
@@ -40,7 +42,17 @@ class ProtocolCombo(BaseProtocol):
             combo.append((entry[0], entry[1], entry[2], entry[3], entry[4]))
         return combo
 
-    def restore_combo(self, data):
+    def restore_combo_entries(self, data):
+        """ Returns (index, entry) pairs of saved entries which differ from the keyboard """
+        out = []
         for x, e in enumerate(data):
             if x < self.combo_count:
-                self.combo_set(x, e)
+                # saved layouts come as JSON lists, entries are kept as tuples of normalized keycodes
+                e = tuple(Keycode.normalize(kc) for kc in e[:5])
+                if e != self.combo_entries[x]:
+                    out.append((x, e))
+        return out
+
+    def restore_combo(self, data):
+        for x, e in self.restore_combo_entries(data):
+            self.combo_set(x, e)
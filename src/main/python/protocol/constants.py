@@ -8,12 +8,14 @@ CMD_VIA_SET_KEYCODE = 0x05
 CMD_VIA_LIGHTING_SET_VALUE = 0x07
 CMD_VIA_LIGHTING_GET_VALUE = 0x08
 CMD_VIA_LIGHTING_SAVE = 0x09
+CMD_VIA_BOOTLOADER_JUMP = 0x0B
 CMD_VIA_MACRO_GET_COUNT = 0x0C
 CMD_VIA_MACRO_GET_BUFFER_SIZE = 0x0D
 CMD_VIA_MACRO_GET_BUFFER = 0x0E
 CMD_VIA_MACRO_SET_BUFFER = 0x0F
 CMD_VIA_GET_LAYER_COUNT = 0x11
 CMD_VIA_KEYMAP_GET_BUFFER = 0x12
+CMD_VIA_KEYMAP_SET_BUFFER = 0x13
 CMD_VIA_VIAL_PREFIX = 0xFE
 VIA_LAYOUT_OPTIONS = 0x02
 VIA_SWITCH_MATRIX_STATE = 0x03
@@ -53,6 +55,13 @@ DYNAMIC_VIAL_ALT_REPEAT_KEY_SET = 0x08
 
 # how much of a macro/keymap buffer we can read/write per packet
 BUFFER_FETCH_CHUNK = 28
+# how many keycodes fit into a single CMD_VIA_KEYMAP_SET_BUFFER packet
+KEYMAP_BUFFER_KEYCODES = BUFFER_FETCH_CHUNK // 2
+# how many bytes of switch matrix state fit into a VIA_SWITCH_MATRIX_STATE response which starts at a given row
+MATRIX_STATE_CHUNK = 29
+
+# When did VIA get support for writing keymap buffer in bulk
+VIA_PROTOCOL_KEYMAP_SET_BUFFER = 9
 
 # When did we get support for advanced macros (including delays in macros)
 VIAL_PROTOCOL_ADVANCED_MACROS = 2
@@ -0,0 +1,143 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+import hashlib
+import json
+import logging
+import os
+import pathlib
+
+from kle_serial import Key, KeyDefaults
+
+# bump whenever the format of cache entries, or what kle_serial produces, changes
+CACHE_VERSION = 1
+
+# how many keyboard definitions to keep around, least recently used ones are evicted first
+CACHE_MAX_ENTRIES = 32
+
+
+def key_to_json(key):
+    out = dict(key.__dict__)
+    out["default"] = dict(key.default.__dict__)
+    return out
+
+
+def key_from_json(data):
+    key = Key()
+    key.__dict__.update(data)
+    key.default = KeyDefaults()
+    key.default.__dict__.update(data["default"])
+    return key
+
+
+class DefinitionCache:
+
+    """
+    Persistent cache of keyboard definitions, so that reconnecting a keyboard doesn't require
+    downloading and parsing the whole vial.json again.
+
+    Entries are keyed by keyboard UID, size of the compressed definition and hash of its first block,
+    and store both the decompressed definition and the KLE keys parsed out of it.
+    """
+
+    instance = None
+
+    def __init__(self, path, max_entries=CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+
+    @classmethod
+    def get(cls):
+        """ Returns the cache stored in the application data location """
+        if cls.instance is None:
+            from PyQt5.QtCore import QStandardPaths
+
+            directory = QStandardPaths.writableLocation(QStandardPaths.AppLocalDataLocation)
+            cls.instance = DefinitionCache(os.path.join(directory, "definitions"))
+        return cls.instance
+
+    @staticmethod
+    def make_key(keyboard_id, size, first_block):
+        return "{:016X}-{}-{}".format(keyboard_id, size, hashlib.sha256(first_block).hexdigest()[:16])
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key + ".json")
+
+    def load(self, key):
+        """ Returns (definition, keys) for a cache key, or None if there's no valid entry """
+
+        path = self.entry_path(key)
+        if not os.path.isfile(path):
+            return None
+
+        try:
+            with open(path, "r", encoding="utf-8") as inf:
+                data = json.load(inf)
+            if data.get("version") != CACHE_VERSION or data.get("key") != key:
+                raise ValueError("stale cache entry")
+            definition = data["definition"]
+            keys = [key_from_json(x) for x in data["keys"]]
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            logging.warning("Discarding invalid definition cache entry {}: {}".format(path, e))
+            self.remove(key)
+            return None
+
+        # refresh mtime so that eviction keeps recently used keyboards
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        return definition, keys
+
+    def store(self, key, definition, keys):
+        data = {
+            "version": CACHE_VERSION,
+            "key": key,
+            "definition": definition,
+            "keys": [key_to_json(x) for x in keys],
+        }
+
+        path = self.entry_path(key)
+        try:
+            pathlib.Path(self.path).mkdir(parents=True, exist_ok=True)
+            # write to a temporary file first so that a crash doesn't leave a truncated entry
+            with open(path + ".tmp", "w", encoding="utf-8") as outf:
+                json.dump(data, outf)
+            os.replace(path + ".tmp", path)
+        except (OSError, TypeError, ValueError) as e:
+            logging.warning("Failed to store definition cache entry {}: {}".format(path, e))
+            return
+
+        self.evict()
+
+    def remove(self, key):
+        try:
+            os.remove(self.entry_path(key))
+        except OSError:
+            pass
+
+    def evict(self):
+        """ Removes least recently used entries beyond max_entries """
+
+        try:
+            entries = [os.path.join(self.path, f) for f in os.listdir(self.path) if f.endswith(".json")]
+            entries.sort(key=os.path.getmtime, reverse=True)
+        except OSError:
+            return
+
+        for path in entries[self.max_entries:]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def clear(self):
+        try:
+            entries = os.listdir(self.path)
+        except OSError:
+            return
+        for f in entries:
+            if f.endswith(".json"):
+                try:
+                    os.remove(os.path.join(self.path, f))
+                except OSError:
+                    pass
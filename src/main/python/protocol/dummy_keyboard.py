@@ -1,4 +1,5 @@
 from protocol.keyboard_comm import Keyboard
+from protocol.keymap_store import KeymapStore
 
 
 class DummyKeyboard(Keyboard):
@@ -11,14 +12,10 @@ class DummyKeyboard(Keyboard):
         self.layers = 4
 
     def reload_keymap(self):
-        for layer in range(self.layers):
-            for row, col in self.rowcol.keys():
-                self.layout[(layer, row, col)] = "KC_NO"
-
-        for layer in range(self.layers):
-            for idx in self.encoderpos:
-                self.encoder_layout[(layer, idx, 0)] = "KC_NO"
-                self.encoder_layout[(layer, idx, 1)] = "KC_NO"
+        # every key starts out as KC_NO
+        self.layout = KeymapStore(self.layers, self.rows, self.cols, self.rowcol.keys())
+        self.encoder_layout = KeymapStore(self.layers, self.encoder_count, 2,
+                                          [(idx, direction) for idx in self.encoderpos for direction in [0, 1]])
 
         if self.layout_labels:
             self.layout_options = 0
@@ -4,10 +4,12 @@ import struct
 from protocol.base_protocol import BaseProtocol
 from protocol.constants import CMD_VIA_VIAL_PREFIX, CMD_VIAL_DYNAMIC_ENTRY_OP, DYNAMIC_VIAL_GET_NUMBER_OF_ENTRIES, \
     VIAL_PROTOCOL_DYNAMIC, VIAL_PROTOCOL_KEY_OVERRIDE
+from protocol.trace import traced
 
 
 class ProtocolDynamic(BaseProtocol):
 
+    @traced
     def reload_dynamic(self):
         self.supported_features = set()
 
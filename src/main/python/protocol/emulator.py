@@ -0,0 +1,403 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+import json
+import lzma
+import struct
+from collections import deque
+
+from keycodes.keycodes_v5 import keycodes_v5
+from keycodes.keycodes_v6 import keycodes_v6
+from protocol.constants import CMD_VIA_GET_PROTOCOL_VERSION, CMD_VIA_GET_KEYBOARD_VALUE, CMD_VIA_SET_KEYBOARD_VALUE, \
+    CMD_VIA_GET_KEYCODE, CMD_VIA_SET_KEYCODE, CMD_VIA_LIGHTING_SET_VALUE, CMD_VIA_LIGHTING_GET_VALUE, \
+    CMD_VIA_LIGHTING_SAVE, CMD_VIA_BOOTLOADER_JUMP, CMD_VIA_MACRO_GET_COUNT, CMD_VIA_MACRO_GET_BUFFER_SIZE, CMD_VIA_MACRO_GET_BUFFER, \
+    CMD_VIA_MACRO_SET_BUFFER, CMD_VIA_GET_LAYER_COUNT, CMD_VIA_KEYMAP_GET_BUFFER, CMD_VIA_KEYMAP_SET_BUFFER, \
+    CMD_VIA_VIAL_PREFIX, VIA_LAYOUT_OPTIONS, VIA_SWITCH_MATRIX_STATE, QMK_BACKLIGHT_BRIGHTNESS, QMK_BACKLIGHT_EFFECT, \
+    QMK_RGBLIGHT_BRIGHTNESS, QMK_RGBLIGHT_EFFECT, QMK_RGBLIGHT_EFFECT_SPEED, QMK_RGBLIGHT_COLOR, VIALRGB_GET_INFO, \
+    VIALRGB_GET_MODE, VIALRGB_GET_SUPPORTED, VIALRGB_SET_MODE, CMD_VIAL_GET_KEYBOARD_ID, CMD_VIAL_GET_SIZE, \
+    CMD_VIAL_GET_DEFINITION, CMD_VIAL_GET_ENCODER, CMD_VIAL_SET_ENCODER, CMD_VIAL_GET_UNLOCK_STATUS, \
+    CMD_VIAL_UNLOCK_START, CMD_VIAL_UNLOCK_POLL, CMD_VIAL_LOCK, CMD_VIAL_QMK_SETTINGS_QUERY, \
+    CMD_VIAL_QMK_SETTINGS_GET, CMD_VIAL_QMK_SETTINGS_SET, CMD_VIAL_QMK_SETTINGS_RESET, CMD_VIAL_DYNAMIC_ENTRY_OP, \
+    DYNAMIC_VIAL_GET_NUMBER_OF_ENTRIES, DYNAMIC_VIAL_TAP_DANCE_GET, DYNAMIC_VIAL_TAP_DANCE_SET, \
+    DYNAMIC_VIAL_COMBO_GET, DYNAMIC_VIAL_COMBO_SET, DYNAMIC_VIAL_KEY_OVERRIDE_GET, DYNAMIC_VIAL_KEY_OVERRIDE_SET, \
+    DYNAMIC_VIAL_ALT_REPEAT_KEY_GET, DYNAMIC_VIAL_ALT_REPEAT_KEY_SET, VIAL_PROTOCOL_MATRIX_TESTER, MATRIX_STATE_CHUNK
+from util import MSG_LEN
+
+# response to commands the firmware doesn't know about
+ID_UNHANDLED = 0xFF
+
+# how many unlock polls with all unlock keys held it takes to unlock the keyboard
+UNLOCK_COUNTER_MAX = 50
+
+# maximum number of unlock keys reported in CMD_VIAL_GET_UNLOCK_STATUS
+UNLOCK_KEYS_MAX = 15
+
+# binary layout of dynamic entries, as stored in the firmware
+TAP_DANCE_FMT = "<HHHHH"
+COMBO_FMT = "<HHHHH"
+KEY_OVERRIDE_FMT = "<HHHBBBB"
+ALT_REPEAT_KEY_FMT = "<HHBB"
+
+
+def make_definition(rows, cols, encoders=0, lighting="none"):
+    """ Generates a vial.json for a rectangular board of rows x cols keys, plus encoders below it """
+
+    keymap = []
+    for row in range(rows):
+        keymap.append(["{},{}".format(row, col) for col in range(cols)])
+    if encoders:
+        keymap.append([{"y": 0.5}])
+        for idx in range(encoders):
+            keymap[-1].append("{},0\n\n\n\n\n\n\n\n\ne".format(idx))
+            keymap[-1].append("{},1\n\n\n\n\n\n\n\n\ne".format(idx))
+
+    return {
+        "name": "Emulated {}x{}".format(rows, cols),
+        "vendorId": "0xFEED",
+        "productId": "0x0000",
+        "lighting": lighting,
+        "matrix": {"rows": rows, "cols": cols},
+        "layouts": {"keymap": keymap},
+    }
+
+
+class VialEmulator:
+
+    """
+    Stateful in-memory emulation of a Vial keyboard firmware, speaking the same packets as vial-qmk.
+
+    Plug it in as a transport, e.g. Keyboard(emulator, usb_send=emulator.send), or use it directly as a
+    hidapi device with write()/read(), e.g. Keyboard(emulator), which also exercises pipelined transfers.
+
+    Like the firmware, a locked keyboard refuses macro writes, QK_BOOT keycodes, matrix state reads and
+    bootloader jumps; unlocking requires holding unlock_keys (see press/release) while polling.
+
+    With matrix_state_offset, matrix state is read starting at a row given in the request, so that matrices
+    which don't fit into one report can be read in several; otherwise only the first rows which fit are returned.
+    No firmware reports supporting this yet, so a Keyboard only uses it when its matrix_state_offset is set.
+    """
+
+    def __init__(self, definition, layers=4, keyboard_id=0x1234567890ABCDEF, vial_protocol=6, via_protocol=9,
+                 macro_count=16, macro_memory=900, tap_dance_count=0, combo_count=0, key_override_count=0,
+                 alt_repeat_key_count=0, settings=None, locked=False, unlock_keys=((0, 0),),
+                 rgb_supported_effects=range(1, 45), matrix_state_offset=False):
+        self.definition = definition
+        self.compressed_definition = lzma.compress(json.dumps(definition).encode("utf-8"))
+
+        self.keyboard_id = keyboard_id
+        self.vial_protocol = vial_protocol
+        self.via_protocol = via_protocol
+
+        self.rows = definition["matrix"]["rows"]
+        self.cols = definition["matrix"]["cols"]
+        self.layers = layers
+        self.keymap = bytearray(layers * self.rows * self.cols * 2)
+        self.layout_options = 0
+
+        self.encoder_count = 0
+        for row in definition["layouts"]["keymap"]:
+            for key in row:
+                if isinstance(key, str) and key.endswith("e"):
+                    self.encoder_count = max(self.encoder_count, int(key.split(",")[0]) + 1)
+        self.encoders = bytearray(layers * self.encoder_count * 2 * 2)
+
+        self.macro_count = macro_count
+        self.macro_buffer = bytearray(macro_memory)
+
+        self.tap_dance = [(0,) * 5 for x in range(tap_dance_count)]
+        self.combos = [(0,) * 5 for x in range(combo_count)]
+        self.key_overrides = [(0,) * 7 for x in range(key_override_count)]
+        self.alt_repeat_keys = [(0,) * 4 for x in range(alt_repeat_key_count)]
+
+        # qsid -> raw little-endian value; settings is either a list of qsids or a dict of qsid -> default value
+        if settings is None:
+            settings = dict()
+        self.settings_defaults = dict()
+        for qsid in settings:
+            value = settings[qsid] if isinstance(settings, dict) else 0
+            self.settings_defaults[qsid] = struct.pack("<I", value)
+        self.qmk_settings_reset()
+
+        self.unlocked = not locked
+        self.unlock_in_progress = False
+        self.unlock_counter = 0
+        self.unlock_keys = list(unlock_keys)[:UNLOCK_KEYS_MAX]
+        self.pressed = set()
+        self.matrix_state_offset = matrix_state_offset
+        self.qk_boot = (keycodes_v6 if vial_protocol >= 6 else keycodes_v5).kc["QK_BOOT"]
+
+        self.rgblight_brightness = 0
+        self.rgblight_effect = 0
+        self.rgblight_effect_speed = 0
+        self.rgblight_color = (0, 0)
+        self.backlight_brightness = 0
+        self.backlight_effect = 0
+        self.rgb_maximum_brightness = 255
+        self.rgb_supported_effects = sorted(rgb_supported_effects)
+        self.rgb_mode = 0
+        self.rgb_speed = 0
+        self.rgb_hsv = (0, 0, 0)
+        self.lighting_saves = 0
+
+        self.bootloader = False
+        self.closed = False
+        self.packets = 0
+        # responses waiting to be read() when used as a hidapi device
+        self.responses = deque()
+
+    def send(self, dev, msg, retries=1):
+        """ usb_send-compatible entry point, dev is ignored """
+
+        if len(msg) > MSG_LEN:
+            raise RuntimeError("message must be less than 32 bytes")
+        return self.handle(bytes(msg))
+
+    def write(self, data):
+        """ hidapi-compatible write, data is prefixed with the report ID """
+        self.responses.append(self.handle(bytes(data[1:])))
+        return len(data)
+
+    def read(self, length, timeout_ms=0):
+        """ hidapi-compatible read, returns nothing when there's no pending response, like a timeout """
+        if not self.responses:
+            return b""
+        return self.responses.popleft()[:length]
+
+    def close(self):
+        self.closed = True
+
+    def handle(self, msg):
+        msg = msg + b"\x00" * (MSG_LEN - len(msg))
+        self.packets += 1
+        if self.unlock_in_progress and not (msg[0] == CMD_VIA_VIAL_PREFIX and msg[1] in [
+                CMD_VIAL_UNLOCK_POLL, CMD_VIAL_GET_UNLOCK_STATUS]):
+            # while unlocking the firmware only answers polls
+            resp = bytes([ID_UNHANDLED]) + msg[1:]
+        else:
+            resp = self.process(msg)
+        return resp + b"\x00" * (MSG_LEN - len(resp))
+
+    def press(self, row, col):
+        self.pressed.add((row, col))
+
+    def release(self, row, col):
+        self.pressed.discard((row, col))
+
+    def qmk_settings_reset(self):
+        self.settings = {qsid: bytearray(value) for qsid, value in self.settings_defaults.items()}
+
+    def filter_keycode(self, old, new):
+        """ A locked keyboard keeps the old keycode instead of accepting QK_BOOT """
+        if not self.unlocked and struct.unpack(">H", new)[0] == self.qk_boot:
+            return old
+        return new
+
+    def filter_keycodes(self, old, new):
+        return b"".join(self.filter_keycode(old[x:x + 2], new[x:x + 2]) for x in range(0, len(new), 2))
+
+    def keymap_offset(self, layer, row, col):
+        return ((layer * self.rows + row) * self.cols + col) * 2
+
+    def encoder_offset(self, layer, idx, direction):
+        return ((layer * self.encoder_count + idx) * 2 + direction) * 2
+
+    def matrix_state(self, first_row=0, max_rows=None):
+        row_size = (self.cols + 7) // 8
+        last_row = self.rows if max_rows is None else min(self.rows, first_row + max_rows)
+        out = b""
+        for row in range(first_row, last_row):
+            bits = 0
+            for col in range(self.cols):
+                if (row, col) in self.pressed:
+                    bits |= 1 << col
+            out += bits.to_bytes(row_size, "big")
+        return out
+
+    def process(self, msg):
+        cmd = msg[0]
+        if cmd == CMD_VIA_VIAL_PREFIX:
+            return self.process_vial(msg)
+        elif cmd == CMD_VIA_GET_PROTOCOL_VERSION:
+            return struct.pack(">BH", cmd, self.via_protocol)
+        elif cmd == CMD_VIA_GET_KEYBOARD_VALUE and msg[1] == VIA_LAYOUT_OPTIONS:
+            return msg[0:2] + struct.pack(">I", self.layout_options)
+        elif cmd == CMD_VIA_GET_KEYBOARD_VALUE and msg[1] == VIA_SWITCH_MATRIX_STATE:
+            if not self.unlocked and self.vial_protocol >= VIAL_PROTOCOL_MATRIX_TESTER:
+                return msg
+            if self.matrix_state_offset:
+                # whole rows starting at the requested one
+                return msg[0:3] + self.matrix_state(msg[2], MATRIX_STATE_CHUNK // ((self.cols + 7) // 8))
+            return (msg[0:2] + self.matrix_state())[:MSG_LEN]
+        elif cmd == CMD_VIA_SET_KEYBOARD_VALUE and msg[1] == VIA_LAYOUT_OPTIONS:
+            self.layout_options = struct.unpack_from(">I", msg, 2)[0]
+            return msg
+        elif cmd == CMD_VIA_GET_KEYCODE:
+            offset = self.keymap_offset(msg[1], msg[2], msg[3])
+            return msg[0:4] + bytes(self.keymap[offset:offset + 2])
+        elif cmd == CMD_VIA_SET_KEYCODE:
+            offset = self.keymap_offset(msg[1], msg[2], msg[3])
+            self.keymap[offset:offset + 2] = self.filter_keycode(self.keymap[offset:offset + 2], msg[4:6])
+            return msg
+        elif cmd == CMD_VIA_LIGHTING_GET_VALUE:
+            return self.process_lighting_get(msg)
+        elif cmd == CMD_VIA_LIGHTING_SET_VALUE:
+            return self.process_lighting_set(msg)
+        elif cmd == CMD_VIA_LIGHTING_SAVE:
+            self.lighting_saves += 1
+            return msg
+        elif cmd == CMD_VIA_BOOTLOADER_JUMP:
+            if self.unlocked:
+                self.bootloader = True
+            return msg
+        elif cmd == CMD_VIA_MACRO_GET_COUNT:
+            return struct.pack(">BB", cmd, self.macro_count)
+        elif cmd == CMD_VIA_MACRO_GET_BUFFER_SIZE:
+            return struct.pack(">BH", cmd, len(self.macro_buffer))
+        elif cmd == CMD_VIA_MACRO_GET_BUFFER:
+            offset, size = struct.unpack_from(">HB", msg, 1)
+            return msg[0:4] + bytes(self.macro_buffer[offset:offset + size])
+        elif cmd == CMD_VIA_MACRO_SET_BUFFER:
+            offset, size = struct.unpack_from(">HB", msg, 1)
+            if self.unlocked:
+                self.macro_buffer[offset:offset + size] = msg[4:4 + size]
+            return msg
+        elif cmd == CMD_VIA_GET_LAYER_COUNT:
+            return struct.pack(">BB", cmd, self.layers)
+        elif cmd == CMD_VIA_KEYMAP_GET_BUFFER:
+            offset, size = struct.unpack_from(">HB", msg, 1)
+            return msg[0:4] + bytes(self.keymap[offset:offset + size])
+        elif cmd == CMD_VIA_KEYMAP_SET_BUFFER:
+            offset, size = struct.unpack_from(">HB", msg, 1)
+            self.keymap[offset:offset + size] = self.filter_keycodes(self.keymap[offset:offset + size],
+                                                                     msg[4:4 + size])
+            return msg
+        return bytes([ID_UNHANDLED]) + msg[1:]
+
+    def process_lighting_get(self, msg):
+        value = msg[1]
+        if value == QMK_RGBLIGHT_BRIGHTNESS:
+            return msg[0:2] + bytes([self.rgblight_brightness])
+        elif value == QMK_RGBLIGHT_EFFECT:
+            return msg[0:2] + bytes([self.rgblight_effect])
+        elif value == QMK_RGBLIGHT_EFFECT_SPEED:
+            return msg[0:2] + bytes([self.rgblight_effect_speed])
+        elif value == QMK_RGBLIGHT_COLOR:
+            return msg[0:2] + bytes(self.rgblight_color)
+        elif value == QMK_BACKLIGHT_BRIGHTNESS:
+            return msg[0:2] + bytes([self.backlight_brightness])
+        elif value == QMK_BACKLIGHT_EFFECT:
+            return msg[0:2] + bytes([self.backlight_effect])
+        elif value == VIALRGB_GET_INFO:
+            return msg[0:2] + struct.pack("<HB", 1, self.rgb_maximum_brightness)
+        elif value == VIALRGB_GET_MODE:
+            return msg[0:2] + struct.pack("<HBBBB", self.rgb_mode, self.rgb_speed, *self.rgb_hsv)
+        elif value == VIALRGB_GET_SUPPORTED:
+            cur = struct.unpack_from("<H", msg, 2)[0]
+            effects = [x for x in self.rgb_supported_effects if x > cur][:(MSG_LEN - 2) // 2]
+            effects += [0xFFFF] * ((MSG_LEN - 2) // 2 - len(effects))
+            return msg[0:2] + struct.pack("<" + "H" * len(effects), *effects)
+        return bytes([ID_UNHANDLED]) + msg[1:]
+
+    def process_lighting_set(self, msg):
+        value = msg[1]
+        if value == QMK_RGBLIGHT_BRIGHTNESS:
+            self.rgblight_brightness = msg[2]
+        elif value == QMK_RGBLIGHT_EFFECT:
+            self.rgblight_effect = msg[2]
+        elif value == QMK_RGBLIGHT_EFFECT_SPEED:
+            self.rgblight_effect_speed = msg[2]
+        elif value == QMK_RGBLIGHT_COLOR:
+            self.rgblight_color = (msg[2], msg[3])
+        elif value == QMK_BACKLIGHT_BRIGHTNESS:
+            self.backlight_brightness = msg[2]
+        elif value == QMK_BACKLIGHT_EFFECT:
+            self.backlight_effect = msg[2]
+        elif value == VIALRGB_SET_MODE:
+            mode, speed, h, s, v = struct.unpack_from("<HBBBB", msg, 2)
+            if mode in self.rgb_supported_effects or mode == 0:
+                self.rgb_mode = mode
+            self.rgb_speed = speed
+            self.rgb_hsv = (h, s, min(v, self.rgb_maximum_brightness))
+        else:
+            return bytes([ID_UNHANDLED]) + msg[1:]
+        return msg
+
+    def process_vial(self, msg):
+        cmd = msg[1]
+        if cmd == CMD_VIAL_GET_KEYBOARD_ID:
+            return struct.pack("<IQ", self.vial_protocol, self.keyboard_id)
+        elif cmd == CMD_VIAL_GET_SIZE:
+            return struct.pack("<I", len(self.compressed_definition))
+        elif cmd == CMD_VIAL_GET_DEFINITION:
+            block = struct.unpack_from("<I", msg, 2)[0]
+            return self.compressed_definition[block * MSG_LEN:(block + 1) * MSG_LEN]
+        elif cmd == CMD_VIAL_GET_ENCODER:
+            offset = self.encoder_offset(msg[2], msg[3], 0)
+            return bytes(self.encoders[offset:offset + 4])
+        elif cmd == CMD_VIAL_SET_ENCODER:
+            offset = self.encoder_offset(msg[2], msg[3], msg[4])
+            self.encoders[offset:offset + 2] = self.filter_keycode(self.encoders[offset:offset + 2], msg[5:7])
+            return b""
+        elif cmd == CMD_VIAL_GET_UNLOCK_STATUS:
+            keys = b"".join(bytes(rowcol) for rowcol in self.unlock_keys)
+            keys += b"\xFF" * (UNLOCK_KEYS_MAX * 2 - len(keys))
+            return bytes([self.unlocked, self.unlock_in_progress]) + keys
+        elif cmd == CMD_VIAL_UNLOCK_START:
+            self.unlock_in_progress = True
+            self.unlock_counter = UNLOCK_COUNTER_MAX
+            return b""
+        elif cmd == CMD_VIAL_UNLOCK_POLL:
+            if self.unlock_in_progress:
+                if all(rowcol in self.pressed for rowcol in self.unlock_keys):
+                    self.unlock_counter -= 1
+                    if self.unlock_counter == 0:
+                        self.unlock_in_progress = False
+                        self.unlocked = True
+                else:
+                    self.unlock_counter = UNLOCK_COUNTER_MAX
+            return bytes([self.unlocked, self.unlock_in_progress, self.unlock_counter])
+        elif cmd == CMD_VIAL_LOCK:
+            self.unlocked = False
+            return b""
+        elif cmd == CMD_VIAL_QMK_SETTINGS_QUERY:
+            cur = struct.unpack_from("<H", msg, 2)[0]
+            qsids = sorted(qsid for qsid in self.settings if qsid > cur)[:MSG_LEN // 2]
+            qsids += [0xFFFF] * (MSG_LEN // 2 - len(qsids))
+            return struct.pack("<" + "H" * len(qsids), *qsids)
+        elif cmd == CMD_VIAL_QMK_SETTINGS_GET:
+            qsid = struct.unpack_from("<H", msg, 2)[0]
+            if qsid not in self.settings:
+                return b"\x01"
+            return b"\x00" + bytes(self.settings[qsid])
+        elif cmd == CMD_VIAL_QMK_SETTINGS_SET:
+            qsid = struct.unpack_from("<H", msg, 2)[0]
+            if qsid not in self.settings:
+                return b"\x01"
+            self.settings[qsid] = bytearray(msg[4:8])
+            return b"\x00"
+        elif cmd == CMD_VIAL_QMK_SETTINGS_RESET:
+            self.qmk_settings_reset()
+            return b""
+        elif cmd == CMD_VIAL_DYNAMIC_ENTRY_OP:
+            return self.process_dynamic(msg)
+        return bytes([ID_UNHANDLED]) + msg[1:]
+
+    def process_dynamic(self, msg):
+        op, idx = msg[2], msg[3]
+        if op == DYNAMIC_VIAL_GET_NUMBER_OF_ENTRIES:
+            return struct.pack("BBBB", len(self.tap_dance), len(self.combos), len(self.key_overrides),
+                               len(self.alt_repeat_keys)) + b"\x00" * 27 + b"\x03"
+
+        for get, put, entries, fmt in [
+            (DYNAMIC_VIAL_TAP_DANCE_GET, DYNAMIC_VIAL_TAP_DANCE_SET, self.tap_dance, TAP_DANCE_FMT),
+            (DYNAMIC_VIAL_COMBO_GET, DYNAMIC_VIAL_COMBO_SET, self.combos, COMBO_FMT),
+            (DYNAMIC_VIAL_KEY_OVERRIDE_GET, DYNAMIC_VIAL_KEY_OVERRIDE_SET, self.key_overrides, KEY_OVERRIDE_FMT),
+            (DYNAMIC_VIAL_ALT_REPEAT_KEY_GET, DYNAMIC_VIAL_ALT_REPEAT_KEY_SET, self.alt_repeat_keys,
+             ALT_REPEAT_KEY_FMT),
+        ]:
+            if op in [get, put] and idx >= len(entries):
+                return b"\x01"
+            if op == get:
+                return b"\x00" + struct.pack(fmt, *entries[idx])
+            elif op == put:
+                entries[idx] = struct.unpack_from(fmt, msg, 4)
+                return b"\x00"
+        return b"\x01"
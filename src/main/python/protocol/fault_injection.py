@@ -0,0 +1,102 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+import random
+import time
+from collections import deque
+
+
+class TransportMetrics:
+
+    """
+    Counters describing how well the HID transport is doing.
+
+    FaultInjectingDevice counts writes, reads, timeouts and dropped responses; hid_send reports retries,
+    failures and time spent sleeping between retries into the metrics of the device it talks to.
+    """
+
+    COUNTERS = ["writes", "short_writes", "reads", "timeouts", "dropped", "retries", "failures"]
+    TIMERS = ["backoff_time", "injected_delay"]
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        for name in self.COUNTERS:
+            setattr(self, name, 0)
+        for name in self.TIMERS:
+            setattr(self, name, 0.0)
+
+    def as_dict(self):
+        out = {name: getattr(self, name) for name in self.COUNTERS}
+        out.update({name: round(getattr(self, name), 6) for name in self.TIMERS})
+        return out
+
+
+class FaultInjectingDevice:
+
+    """
+    Wraps a hidapi device (a real hid.device or VialEmulator) and makes the link worse in a controlled way:
+    every response is delayed by latency +- jitter seconds, a fraction of responses is lost and a fraction
+    of writes comes up short.
+
+    Latency is counted from the moment a request is written, so requests pipelined by hid_send_batch
+    wait for their responses concurrently, as they would on a real link.
+    """
+
+    def __init__(self, dev, latency=0.0, jitter=0.0, drop_rate=0.0, short_write_rate=0.0, seed=None,
+                 metrics=None, clock=time.monotonic, sleep=time.sleep):
+        self.dev = dev
+        self.latency = latency
+        self.jitter = jitter
+        self.drop_rate = drop_rate
+        self.short_write_rate = short_write_rate
+        self.rng = random.Random(seed)
+        self.metrics = metrics if metrics is not None else TransportMetrics()
+        self.clock = clock
+        self.sleep = sleep
+        # times at which responses to requests written so far become available
+        self.inflight = deque()
+
+    def __getattr__(self, name):
+        # open_path, close etc. go straight to the wrapped device
+        return getattr(self.dev, name)
+
+    def wait(self, seconds):
+        if seconds > 0:
+            self.metrics.injected_delay += seconds
+            self.sleep(seconds)
+
+    def write(self, data):
+        self.metrics.writes += 1
+        if self.rng.random() < self.short_write_rate:
+            self.metrics.short_writes += 1
+            return len(data) // 2
+
+        ret = self.dev.write(data)
+        delay = max(0.0, self.latency + self.rng.uniform(-self.jitter, self.jitter))
+        self.inflight.append(self.clock() + delay)
+        return ret
+
+    def read(self, length, timeout_ms=0):
+        self.metrics.reads += 1
+        deadline = self.clock() + timeout_ms / 1000
+
+        if self.inflight:
+            ready = self.inflight[0]
+            self.wait(min(ready, deadline) - self.clock())
+            if ready > deadline:
+                # response is still on its way, it will show up as a stale one on a later read
+                self.metrics.timeouts += 1
+                return b""
+            self.inflight.popleft()
+
+        remaining = max(1, int((deadline - self.clock()) * 1000))
+        data = bytes(self.dev.read(length, timeout_ms=remaining))
+
+        if data and self.rng.random() < self.drop_rate:
+            self.metrics.dropped += 1
+            self.wait(deadline - self.clock())
+            data = b""
+
+        if not data:
+            self.metrics.timeouts += 1
+        return data
@@ -5,6 +5,7 @@ from keycodes.keycodes import Keycode, RESET_KEYCODE
 from protocol.base_protocol import BaseProtocol
 from protocol.constants import DYNAMIC_VIAL_KEY_OVERRIDE_GET, CMD_VIA_VIAL_PREFIX, CMD_VIAL_DYNAMIC_ENTRY_OP, \
     DYNAMIC_VIAL_KEY_OVERRIDE_SET
+from protocol.trace import traced
 from unlocker import Unlocker
 
 
@@ -82,6 +83,7 @@ class KeyOverrideEntry:
 
 class ProtocolKeyOverride(BaseProtocol):
 
+    @traced
     def reload_key_override(self):
         entries = self._retrieve_dynamic_entries(DYNAMIC_VIAL_KEY_OVERRIDE_GET,
                                                  self.key_override_count, "<HHHBBBB")
@@ -105,9 +107,17 @@ class ProtocolKeyOverride(BaseProtocol):
     def save_key_override(self):
         return [e.save() for e in self.key_override_entries]
 
-    def restore_key_override(self, data):
+    def restore_key_override_entries(self, data):
+        """ Returns (index, entry) pairs of saved entries which differ from the keyboard """
+        out = []
         for x, e in enumerate(data):
             if x < self.key_override_count:
                 ko = KeyOverrideEntry()
                 ko.restore(e)
-                self.key_override_set(x, ko)
+                if ko != self.key_override_entries[x]:
+                    out.append((x, ko))
+        return out
+
+    def restore_key_override(self, data):
+        for x, ko in self.restore_key_override_entries(data):
+            self.key_override_set(x, ko)
@@ -2,7 +2,9 @@
 import struct
 import json
 import lzma
+import threading
 from collections import OrderedDict
+from functools import partial
 
 from keycodes.keycodes import RESET_KEYCODE, Keycode, recreate_keyboard_keycodes
 from kle_serial import Serial as KleSerial
@@ -16,17 +18,29 @@ from protocol.constants import CMD_VIA_GET_PROTOCOL_VERSION, CMD_VIA_GET_KEYBOAR
     VIALRGB_GET_SUPPORTED, VIALRGB_SET_MODE, CMD_VIAL_GET_KEYBOARD_ID, CMD_VIAL_GET_SIZE, CMD_VIAL_GET_DEFINITION, \
     CMD_VIAL_GET_ENCODER, CMD_VIAL_SET_ENCODER, CMD_VIAL_GET_UNLOCK_STATUS, CMD_VIAL_UNLOCK_START, CMD_VIAL_UNLOCK_POLL, \
     CMD_VIAL_LOCK, CMD_VIAL_QMK_SETTINGS_QUERY, CMD_VIAL_QMK_SETTINGS_GET, CMD_VIAL_QMK_SETTINGS_SET, \
-    CMD_VIAL_QMK_SETTINGS_RESET, BUFFER_FETCH_CHUNK, VIAL_PROTOCOL_QMK_SETTINGS
+    CMD_VIAL_QMK_SETTINGS_RESET, BUFFER_FETCH_CHUNK, VIAL_PROTOCOL_QMK_SETTINGS, CMD_VIA_KEYMAP_SET_BUFFER, \
+    VIA_PROTOCOL_KEYMAP_SET_BUFFER, CMD_VIA_BOOTLOADER_JUMP, MATRIX_STATE_CHUNK, KEYMAP_BUFFER_KEYCODES
 from protocol.dynamic import ProtocolDynamic
 from protocol.key_override import ProtocolKeyOverride
+from protocol.keymap_store import KeymapStore
 from protocol.macro import ProtocolMacro
+from protocol.restore_plan import RestorePlan
 from protocol.tap_dance import ProtocolTapDance
+from protocol.trace import traced, traced_send
 from unlocker import Unlocker
-from util import MSG_LEN, hid_send
+from util import MSG_LEN, hid_send, hid_send_batch, EXAMPLE_KEYBOARDS, EXAMPLE_KEYBOARD_PREFIX
 
 SUPPORTED_VIA_PROTOCOL = [-1, 9]
 SUPPORTED_VIAL_PROTOCOL = [-1, 0, 1, 2, 3, 4, 5, 6]
 
+# subsystems which can be selected for Keyboard.reload(parts=...)
+RELOAD_PARTS = {"layout", "layers", "macros", "rgb", "settings", "dynamic", "keymap", "tap_dance", "combo",
+                "key_override", "alt_repeat_key"}
+# these determine the shape of everything else (matrix, number of layers/entries, keycodes) and require full reload
+RELOAD_PARTS_STRUCTURAL = {"layout", "layers", "dynamic"}
+# parts which hold user-editable state, i.e. what may differ after an interrupted write or unlock
+RELOAD_PARTS_USER = {"keymap", "macros", "settings", "tap_dance", "combo", "key_override", "alt_repeat_key"}
+
 
 class ProtocolError(Exception):
     pass
@@ -35,17 +49,26 @@ class ProtocolError(Exception):
 class Keyboard(ProtocolMacro, ProtocolDynamic, ProtocolTapDance, ProtocolCombo, ProtocolKeyOverride, ProtocolAltRepeatKey):
     """ Low-level communication with a vial-enabled keyboard """
 
-    def __init__(self, dev, usb_send=hid_send):
+    def __init__(self, dev, usb_send=hid_send, usb_send_batch=None, definition_cache=None):
         self.dev = dev
-        self.usb_send = usb_send
+        # keyboard may be loaded in background while editors send their own requests,
+        # so every exchange (a request and its response, or a pipelined batch) holds this lock
+        self.transport_lock = threading.RLock()
+        # custom transports (e.g. tests) get pipelined requests sent one by one unless they provide their own batch
+        if usb_send_batch is None:
+            usb_send_batch = hid_send_batch if usb_send is hid_send else self._usb_send_sequential
+        self.usb_send_batch = self.locked(usb_send_batch)
+        # hid_send traces its packets itself
+        self.usb_send = self.locked(usb_send if usb_send is hid_send else traced_send(usb_send))
+        self.definition_cache = definition_cache
         self.definition = None
 
         # n.b. using OrderedDict here to make order of layout requests consistent for tests
         self.rowcol = OrderedDict()
         self.encoderpos = OrderedDict()
         self.encoder_count = 0
-        self.layout = dict()
-        self.encoder_layout = dict()
+        self.layout = KeymapStore(0, 0, 0)
+        self.encoder_layout = KeymapStore(0, 0, 0)
         self.rows = self.cols = self.layers = 0
         self.layout_labels = None
         self.layout_options = -1
@@ -54,6 +77,10 @@ class Keyboard(ProtocolMacro, ProtocolDynamic, ProtocolTapDance, ProtocolCombo,
         self.vibl = False
         self.custom_keycodes = None
         self.midi = None
+        self.supported_features = set()
+        # reading the switch matrix from a starting row, which no firmware reports supporting yet; only set for
+        # emulated firmware which implements it, see VialEmulator
+        self.matrix_state_offset = False
 
         self.lighting_qmk_rgblight = self.lighting_qmk_backlight = self.lighting_vialrgb = False
 
@@ -69,40 +96,123 @@ class Keyboard(ProtocolMacro, ProtocolDynamic, ProtocolTapDance, ProtocolCombo,
 
         self.via_protocol = self.vial_protocol = self.keyboard_id = -1
 
-    def reload(self, sideload_json=None):
-        """ Load information about the keyboard: number of layers, physical key layout """
+    def locked(self, send):
+        def wrapper(*args, **kwargs):
+            with self.transport_lock:
+                return send(*args, **kwargs)
+        return wrapper
 
-        self.rowcol = OrderedDict()
-        self.encoderpos = OrderedDict()
-        self.layout = dict()
-        self.encoder_layout = dict()
+    @traced
+    def reload(self, sideload_json=None, parts=None, progress=None, keycodes=None):
+        """
+        Load information about the keyboard: number of layers, physical key layout
 
-        self.reload_layout(sideload_json)
-        self.reload_layers()
+        parts can be a subset of RELOAD_PARTS to only refetch these subsystems, relying on
+        previously loaded state for everything else. Returns the set of parts which changed.
 
-        self.reload_macros_early()
-        self.reload_persistent_rgb()
-        self.reload_rgb()
-        self.reload_settings()
+        progress, if given, is called as progress(part, done, total) after each part has been loaded,
+        so that a caller loading the keyboard in background can show parts which are ready.
 
-        self.reload_dynamic()
+        keycodes, if given, is called as keycodes(keyboard) instead of recreate_keyboard_keycodes to regenerate
+        the global keycode lists, e.g. to have that happen on the GUI thread which paints from them.
+        """
 
-        # based on the number of macros, tapdance, etc, this will generate global keycode arrays
-        recreate_keyboard_keycodes(self)
+        if parts is not None and self.definition is not None:
+            parts = set(parts)
+            if parts - RELOAD_PARTS:
+                raise ValueError("unknown reload parts: {}".format(", ".join(sorted(parts - RELOAD_PARTS))))
+            if not (parts & RELOAD_PARTS_STRUCTURAL):
+                return self.reload_parts(parts, progress)
 
-        # at this stage we have correct keycode info and can reload everything that depends on keycodes
-        self.reload_keymap()
-        self.reload_macros_late()
-        self.reload_tap_dance()
-        self.reload_combo()
-        self.reload_key_override()
-        self.reload_alt_repeat_key()
+        self.reload_full(sideload_json, progress, keycodes)
+        return set(RELOAD_PARTS)
 
+    @traced
+    def reload_full(self, sideload_json=None, progress=None, keycodes=None):
+        self.rowcol = OrderedDict()
+        self.encoderpos = OrderedDict()
+        self.layout = KeymapStore(0, 0, 0)
+        self.encoder_layout = KeymapStore(0, 0, 0)
+
+        steps = [
+            ("layout", partial(self.reload_layout, sideload_json)),
+            ("layers", self.reload_layers),
+            ("macro_count", self.reload_macros_early),
+            ("dynamic", self.reload_dynamic),
+            # based on the number of macros, tapdance, etc, this will generate global keycode arrays
+            ("keycodes", partial(keycodes or recreate_keyboard_keycodes, self)),
+            # at this stage we have correct keycode info and can reload everything that depends on keycodes,
+            # keymap goes first as that's what the user is most likely to look at
+            ("keymap", self.reload_keymap),
+            ("macros", self.reload_macros_late),
+            ("tap_dance", self.reload_tap_dance),
+            ("combo", self.reload_combo),
+            ("key_override", self.reload_key_override),
+            ("alt_repeat_key", self.reload_alt_repeat_key),
+            ("rgb", self.reload_all_rgb),
+            ("settings", self.reload_settings),
+        ]
+        for idx, (part, fn) in enumerate(steps):
+            fn()
+            if progress is not None:
+                progress(part, idx + 1, len(steps))
+
+    def reload_snapshot(self, part):
+        """ Returns current cached state of a reload part, used to detect what changed """
+
+        if part == "keymap":
+            return self.layout.copy(), self.encoder_layout.copy(), self.layout_options
+        elif part == "macros":
+            return self.macro
+        elif part == "rgb":
+            return (self.underglow_brightness, self.underglow_effect, self.underglow_effect_speed,
+                    self.underglow_color, self.backlight_brightness, self.backlight_effect,
+                    self.rgb_mode, self.rgb_speed, self.rgb_hsv)
+        elif part == "settings":
+            return dict(self.settings)
+        elif part == "tap_dance":
+            return list(self.tap_dance_entries)
+        elif part == "combo":
+            return list(self.combo_entries)
+        elif part == "key_override":
+            return list(self.key_override_entries)
+        elif part == "alt_repeat_key":
+            return list(self.alt_repeat_key_entries)
+        raise ValueError("part {} cannot be reloaded incrementally".format(part))
+
+    @traced
+    def reload_parts(self, parts, progress=None):
+        """ Refetches only the given non-structural parts, returns the set of parts which changed """
+
+        reloaders = {
+            "keymap": self.reload_keymap,
+            "macros": self.reload_macros_late,
+            "rgb": self.reload_rgb,
+            "settings": self.reload_settings,
+            "tap_dance": self.reload_tap_dance,
+            "combo": self.reload_combo,
+            "key_override": self.reload_key_override,
+            "alt_repeat_key": self.reload_alt_repeat_key,
+        }
+
+        changed = set()
+        # iterate in a fixed order so that device communication is deterministic
+        for idx, part in enumerate(sorted(parts)):
+            before = self.reload_snapshot(part)
+            reloaders[part]()
+            if self.reload_snapshot(part) != before:
+                changed.add(part)
+            if progress is not None:
+                progress(part, idx + 1, len(parts))
+        return changed
+
+    @traced
     def reload_layers(self):
         """ Get how many layers the keyboard has """
 
         self.layers = self.usb_send(self.dev, struct.pack("B", CMD_VIA_GET_LAYER_COUNT), retries=20)[1]
 
+    @traced
     def reload_via_protocol(self):
         data = self.usb_send(self.dev, struct.pack("B", CMD_VIA_GET_PROTOCOL_VERSION), retries=20)
         self.via_protocol = struct.unpack(">H", data[1:3])[0]
@@ -111,12 +221,14 @@ class Keyboard(ProtocolMacro, ProtocolDynamic, ProtocolTapDance, ProtocolCombo,
         if self.via_protocol not in SUPPORTED_VIA_PROTOCOL or self.vial_protocol not in SUPPORTED_VIAL_PROTOCOL:
             raise ProtocolError()
 
+    @traced
     def reload_layout(self, sideload_json=None):
         """ Requests layout data from the current device """
 
         self.reload_via_protocol()
 
         self.sideload = False
+        kle_keys = None
         if sideload_json is not None:
             self.sideload = True
             payload = sideload_json
@@ -129,19 +241,7 @@ class Keyboard(ProtocolMacro, ProtocolDynamic, ProtocolTapDance, ProtocolCombo,
             data = self.usb_send(self.dev, struct.pack("BB", CMD_VIA_VIAL_PREFIX, CMD_VIAL_GET_SIZE), retries=20)
             sz = struct.unpack("<I", data[0:4])[0]
 
-            # get the payload
-            payload = b""
-            block = 0
-            while sz > 0:
-                data = self.usb_send(self.dev, struct.pack("<BBI", CMD_VIA_VIAL_PREFIX, CMD_VIAL_GET_DEFINITION, block),
-                                     retries=20)
-                if sz < MSG_LEN:
-                    data = data[:sz]
-                payload += data
-                block += 1
-                sz -= MSG_LEN
-
-            payload = json.loads(lzma.decompress(payload))
+            payload, kle_keys = self.reload_definition(sz)
 
         self.check_protocol_version()
 
@@ -159,13 +259,13 @@ class Keyboard(ProtocolMacro, ProtocolDynamic, ProtocolTapDance, ProtocolCombo,
 
         self.custom_keycodes = payload.get("customKeycodes", None)
 
-        serial = KleSerial()
-        kb = serial.deserialize(payload["layouts"]["keymap"])
+        if kle_keys is None:
+            kle_keys = KleSerial().deserialize(payload["layouts"]["keymap"]).keys
 
         self.keys = []
         self.encoders = []
 
-        for key in kb.keys:
+        for key in kle_keys:
             key.row = key.col = None
             key.encoder_idx = key.encoder_dir = None
             if key.labels[4] == "e":
@@ -193,40 +293,88 @@ class Keyboard(ProtocolMacro, ProtocolDynamic, ProtocolTapDance, ProtocolCombo,
                 idx, opt = key.labels[8].split(",")
                 key.layout_index, key.layout_option = int(idx), int(opt)
 
+    @staticmethod
+    def decode_definition(payload, sz):
+        if len(payload) < sz:
+            raise ValueError("definition too short: got {} bytes, expected {}".format(len(payload), sz))
+        return json.loads(lzma.decompress(payload[:sz]))
+
+    @traced
+    def reload_definition(self, sz):
+        """ Retrieves and parses keyboard definition of sz bytes, returns (definition, KLE keys) """
+
+        block = self.usb_send(self.dev, struct.pack("<BBI", CMD_VIA_VIAL_PREFIX, CMD_VIAL_GET_DEFINITION, 0),
+                              retries=20)
+
+        # example keyboards are shared by many in-development firmwares, so don't trust cache for those
+        cache_key = None
+        if self.definition_cache is not None and self.keyboard_id not in EXAMPLE_KEYBOARDS and \
+                (self.keyboard_id & 0xFFFFFFFFFFFFFF) != EXAMPLE_KEYBOARD_PREFIX:
+            cache_key = self.definition_cache.make_key(self.keyboard_id, sz, block[:min(sz, MSG_LEN)])
+            cached = self.definition_cache.load(cache_key)
+            if cached is not None:
+                return cached
+
+        # get the rest of the payload; definition blocks don't echo the request so they can only be matched in
+        # order, a lost request would shift every later block - the payload is checked and refetched in lockstep
+        # if it doesn't decode
+        blocks = (sz + MSG_LEN - 1) // MSG_LEN
+        requests = [struct.pack("<BBI", CMD_VIA_VIAL_PREFIX, CMD_VIAL_GET_DEFINITION, block)
+                    for block in range(1, blocks)]
+        data = self.usb_send_batch(self.dev, requests, retries=20, fifo=True)
+        try:
+            definition = self.decode_definition(b"".join([block] + data), sz)
+        except (lzma.LZMAError, ValueError):
+            data = [self.usb_send(self.dev, msg, retries=20) for msg in requests]
+            definition = self.decode_definition(b"".join([block] + data), sz)
+        keys = KleSerial().deserialize(definition["layouts"]["keymap"]).keys
+
+        if cache_key is not None:
+            self.definition_cache.store(cache_key, definition, keys)
+
+        return definition, keys
+
+    @traced
     def reload_keymap(self):
         """ Load current key mapping from the keyboard """
 
-        keymap = b""
         # calculate what the size of keymap will be and retrieve the entire binary buffer
         size = self.layers * self.rows * self.cols * 2
-        for x in range(0, size, BUFFER_FETCH_CHUNK):
-            offset = x
-            sz = min(size - offset, BUFFER_FETCH_CHUNK)
-            data = self.usb_send(self.dev, struct.pack(">BHB", CMD_VIA_KEYMAP_GET_BUFFER, offset, sz), retries=20)
-            keymap += data[4:4+sz]
-
-        for layer in range(self.layers):
-            for row, col in self.rowcol.keys():
-                if row >= self.rows or col >= self.cols:
-                    raise RuntimeError("malformed vial.json, key references {},{} but matrix declares rows={} cols={}"
-                                       .format(row, col, self.rows, self.cols))
-                # determine where this (layer, row, col) will be located in keymap array
-                offset = layer * self.rows * self.cols * 2 + row * self.cols * 2 + col * 2
-                keycode = Keycode.serialize(struct.unpack(">H", keymap[offset:offset+2])[0])
-                self.layout[(layer, row, col)] = keycode
-
-        for layer in range(self.layers):
-            for idx in self.encoderpos:
-                data = self.usb_send(self.dev, struct.pack("BBBB", CMD_VIA_VIAL_PREFIX, CMD_VIAL_GET_ENCODER, layer, idx),
-                                     retries=20)
-                self.encoder_layout[(layer, idx, 0)] = Keycode.serialize(struct.unpack(">H", data[0:2])[0])
-                self.encoder_layout[(layer, idx, 1)] = Keycode.serialize(struct.unpack(">H", data[2:4])[0])
+        requests = [(offset, min(size - offset, BUFFER_FETCH_CHUNK)) for offset in range(0, size, BUFFER_FETCH_CHUNK)]
+        # the firmware echoes command, offset and size back so responses can be matched to requests
+        data = self.usb_send_batch(
+            self.dev, [struct.pack(">BHB", CMD_VIA_KEYMAP_GET_BUFFER, offset, sz) for offset, sz in requests],
+            retries=20, echo=4)
+        keymap = b"".join(resp[4:4+sz] for resp, (offset, sz) in zip(data, requests))
+
+        for row, col in self.rowcol.keys():
+            if row >= self.rows or col >= self.cols:
+                raise RuntimeError("malformed vial.json, key references {},{} but matrix declares rows={} cols={}"
+                                   .format(row, col, self.rows, self.cols))
+        layout = KeymapStore(self.layers, self.rows, self.cols, self.rowcol.keys())
+        layout.load(keymap)
+        self.layout = layout
+
+        encoders = [(layer, idx) for layer in range(self.layers) for idx in self.encoderpos]
+        # encoder responses carry nothing to match them to requests by, so these are sent in lockstep
+        data = [self.usb_send(self.dev, struct.pack("BBBB", CMD_VIA_VIAL_PREFIX, CMD_VIAL_GET_ENCODER, layer, idx),
+                              retries=20)
+                for layer, idx in encoders]
+        # encoders are stored as a layers x encoders x directions keymap
+        encoder_layout = KeymapStore(self.layers, self.encoder_count, 2,
+                                     [(idx, direction) for idx in self.encoderpos for direction in [0, 1]])
+        for (layer, idx), resp in zip(encoders, data):
+            cw, ccw = struct.unpack(">HH", resp[0:4])
+            encoder_layout.codes[encoder_layout.index(layer, idx, 0)] = cw
+            encoder_layout.codes[encoder_layout.index(layer, idx, 1)] = ccw
+        self.encoder_layout = encoder_layout
 
         if self.layout_labels:
             data = self.usb_send(self.dev, struct.pack("BB", CMD_VIA_GET_KEYBOARD_VALUE, VIA_LAYOUT_OPTIONS),
                                  retries=20)
             self.layout_options = struct.unpack(">I", data[2:6])[0]
 
+    @traced
     def reload_persistent_rgb(self):
         """
             Reload RGB properties which are slow, and do not change while keyboard is plugged in
@@ -258,6 +406,11 @@ class Keyboard(ProtocolMacro, ProtocolDynamic, ProtocolTapDance, ProtocolCombo,
                         self.rgb_supported_effects.add(value)
                     max_effect = max(max_effect, value)
 
+    def reload_all_rgb(self):
+        self.reload_persistent_rgb()
+        self.reload_rgb()
+
+    @traced
     def reload_rgb(self):
         if self.lighting_qmk_rgblight:
             self.underglow_brightness = self.usb_send(
@@ -284,6 +437,7 @@ class Keyboard(ProtocolMacro, ProtocolDynamic, ProtocolTapDance, ProtocolCombo,
             self.rgb_speed = data[2]
             self.rgb_hsv = (data[3], data[4], data[5])
 
+    @traced
     def reload_settings(self):
         self.settings = dict()
         self.supported_settings = set()
@@ -313,21 +467,25 @@ class Keyboard(ProtocolMacro, ProtocolDynamic, ProtocolTapDance, ProtocolCombo,
     def set_key(self, layer, row, col, code):
         key = (layer, row, col)
         if self.layout[key] != code:
-            if code == RESET_KEYCODE:
-                Unlocker.unlock(self)
+            raw = Keycode.deserialize(code)
+            # e.g. an alias of what is already there only changes how the key is shown
+            if self.layout.code(key) != raw:
+                if code == RESET_KEYCODE:
+                    Unlocker.unlock(self)
 
-            self.usb_send(self.dev, struct.pack(">BBBBH", CMD_VIA_SET_KEYCODE, layer, row, col,
-                                                Keycode.deserialize(code)), retries=20)
+                self.usb_send(self.dev, struct.pack(">BBBBH", CMD_VIA_SET_KEYCODE, layer, row, col, raw), retries=20)
             self.layout[key] = code
 
     def set_encoder(self, layer, index, direction, code):
         key = (layer, index, direction)
         if self.encoder_layout[key] != code:
-            if code == RESET_KEYCODE:
-                Unlocker.unlock(self)
+            raw = Keycode.deserialize(code)
+            if self.encoder_layout.code(key) != raw:
+                if code == RESET_KEYCODE:
+                    Unlocker.unlock(self)
 
-            self.usb_send(self.dev, struct.pack(">BBBBBH", CMD_VIA_VIAL_PREFIX, CMD_VIAL_SET_ENCODER,
-                                                layer, index, direction, Keycode.deserialize(code)), retries=20)
+                self.usb_send(self.dev, struct.pack(">BBBBBH", CMD_VIA_VIAL_PREFIX, CMD_VIAL_SET_ENCODER,
+                                                    layer, index, direction, raw), retries=20)
             self.encoder_layout[key] = code
 
     def set_layout_options(self, options):
@@ -371,29 +529,8 @@ class Keyboard(ProtocolMacro, ProtocolDynamic, ProtocolTapDance, ProtocolCombo,
 
         data = {"version": 1, "uid": self.keyboard_id}
 
-        layout = []
-        for l in range(self.layers):
-            layer = []
-            layout.append(layer)
-            for r in range(self.rows):
-                row = []
-                layer.append(row)
-                for c in range(self.cols):
-                    val = self.layout.get((l, r, c), -1)
-                    row.append(val)
-
-        encoder_layout = []
-        for l in range(self.layers):
-            layer = []
-            for e in range(self.encoder_count):
-                cw = (l, e, 0)
-                ccw = (l, e, 1)
-                layer.append([self.encoder_layout.get(cw, -1),
-                              self.encoder_layout.get(ccw, -1)])
-            encoder_layout.append(layer)
-
-        data["layout"] = layout
-        data["encoder_layout"] = encoder_layout
+        data["layout"] = self.layout.to_nested(missing=-1)
+        data["encoder_layout"] = self.encoder_layout.to_nested(missing=-1)
         data["layout_options"] = self.layout_options
         data["macro"] = self.save_macro()
         data["vial_protocol"] = self.vial_protocol
@@ -406,41 +543,122 @@ class Keyboard(ProtocolMacro, ProtocolDynamic, ProtocolTapDance, ProtocolCombo,
 
         return json.dumps(data).encode("utf-8")
 
-    def restore_layout(self, data):
-        """ Restores saved layout """
+    def keymap_index(self, layer, row, col):
+        """ Position of a keycode within the keymap buffer, in keycodes """
+        return self.layout.index(layer, row, col)
 
-        data = json.loads(data.decode("utf-8"))
+    def keymap_key(self, index):
+        """ Inverse of keymap_index """
+        return self.layout.key(index)
+
+    def set_keymap_buffer(self, keys, codes):
+        """ Writes a contiguous run of keys in a single packet, keys not in codes are rewritten with current value """
+
+        values = [Keycode.deserialize(codes[key]) if key in codes else self.layout.code(key) for key in keys]
+        if Keycode.deserialize(RESET_KEYCODE) in values:
+            Unlocker.unlock(self)
 
-        # restore keymap
-        for l, layer in enumerate(data["layout"]):
+        payload = struct.pack(">{}H".format(len(values)), *values)
+        self.usb_send(self.dev, struct.pack(">BHB", CMD_VIA_KEYMAP_SET_BUFFER, self.keymap_index(*keys[0]) * 2,
+                                            len(payload)) + payload, retries=20)
+        for key in keys:
+            if key in codes:
+                self.layout[key] = codes[key]
+
+    def coalesce_keymap_writes(self, changed):
+        """
+        Groups changed keys into runs which are contiguous in the keymap buffer and fit into a single packet.
+        Unchanged keys between changes are included in a run as long as their current value is known.
+        """
+
+        runs = []
+        for key in sorted(changed, key=lambda k: self.keymap_index(*k)):
+            idx = self.keymap_index(*key)
+            if runs:
+                first = self.keymap_index(*runs[-1][0])
+                last = self.keymap_index(*runs[-1][-1])
+                if idx - first < KEYMAP_BUFFER_KEYCODES and all(self.layout.present[last + 1:idx]):
+                    runs[-1].extend([self.keymap_key(x) for x in range(last + 1, idx)] + [key])
+                    continue
+            runs.append([key])
+        return runs
+
+    def plan_restore_keymap(self, plan, layout):
+        changed = dict()
+        for l, layer in enumerate(layout):
             for r, row in enumerate(layer):
                 for c, code in enumerate(row):
                     if (l, r, c) in self.layout:
-                        self.set_key(l, r, c, Keycode.serialize(Keycode.deserialize(code)))
+                        code = Keycode.deserialize(code)
+                        if self.layout.code((l, r, c)) != code:
+                            changed[(l, r, c)] = Keycode.serialize(code)
 
-        # restore encoders
-        for l, layer in enumerate(data["encoder_layout"]):
-            for e, encoder in enumerate(layer):
-                self.set_encoder(l, e, 0, Keycode.serialize(Keycode.deserialize(encoder[0])))
-                self.set_encoder(l, e, 1, Keycode.serialize(Keycode.deserialize(encoder[1])))
+        if self.via_protocol >= VIA_PROTOCOL_KEYMAP_SET_BUFFER:
+            runs = self.coalesce_keymap_writes(changed)
+        else:
+            runs = [[key] for key in changed]
+
+        for run in runs:
+            if len(run) == 1:
+                plan.add("keymap", 1, partial(self.set_key, *run[0], changed[run[0]]))
+            else:
+                plan.add("keymap", 1, partial(self.set_keymap_buffer, run, changed))
 
-        self.set_layout_options(data["layout_options"])
-        self.restore_macros(data.get("macro"))
+    def plan_restore_layout(self, data):
+        """ Computes which writes are needed to restore a saved layout, see RestorePlan """
 
-        self.restore_tap_dance(data.get("tap_dance", []))
-        self.restore_combo(data.get("combo", []))
-        self.restore_key_override(data.get("key_override", []))
-        self.restore_alt_repeat_key(data.get("alt_repeat_key", []))
+        data = json.loads(data.decode("utf-8"))
+        plan = RestorePlan()
+
+        self.plan_restore_keymap(plan, data["layout"])
+
+        for l, layer in enumerate(data["encoder_layout"]):
+            for e, encoder in enumerate(layer):
+                for direction in [0, 1]:
+                    code = Keycode.normalize(encoder[direction])
+                    if self.encoder_layout.code((l, e, direction)) != Keycode.deserialize(code):
+                        plan.add("encoders", 1, partial(self.set_encoder, l, e, direction, code))
+
+        if self.layout_options != -1 and self.layout_options != data["layout_options"]:
+            plan.add("layout_options", 1, partial(self.set_layout_options, data["layout_options"]))
+
+        macro = self.restore_macros_data(data.get("macro"))
+        if macro is not None and macro != self.macro:
+            plan.add("macros", (len(macro) + BUFFER_FETCH_CHUNK - 1) // BUFFER_FETCH_CHUNK,
+                     partial(self.restore_macros, data.get("macro")))
+
+        for subsystem, entries, restore in [
+            ("tap_dance", self.restore_tap_dance_entries(data.get("tap_dance", [])), self.tap_dance_set),
+            ("combo", self.restore_combo_entries(data.get("combo", [])), self.combo_set),
+            ("key_override", self.restore_key_override_entries(data.get("key_override", [])), self.key_override_set),
+            ("alt_repeat_key", self.restore_alt_repeat_key_entries(data.get("alt_repeat_key", [])),
+             self.alt_repeat_key_set),
+        ]:
+            for idx, entry in entries:
+                plan.add(subsystem, 1, partial(restore, idx, entry))
 
         for qsid, value in data.get("settings", dict()).items():
             from editor.qmk_settings import QmkSettings
 
             qsid = int(qsid)
-            if QmkSettings.is_qsid_supported(qsid):
-                self.qmk_settings_set(qsid, value)
+            if QmkSettings.is_qsid_supported(qsid) and self.settings.get(qsid) != value:
+                plan.add("settings", 1, partial(self.qmk_settings_set, qsid, value))
+
+        return plan
+
+    @traced
+    def restore_layout(self, data):
+        """
+        Restores saved layout, returns the executed plan. Use plan_restore_layout instead to let the user see what
+        is going to be written first.
+        """
+
+        plan = self.plan_restore_layout(data)
+        plan.execute()
+        return plan
 
     def reset(self):
-        self.usb_send(self.dev, struct.pack("B", 0xB))
+        self.usb_send(self.dev, struct.pack("B", CMD_VIA_BOOTLOADER_JUMP))
         self.dev.close()
 
     def get_uid(self):
@@ -509,6 +727,41 @@ class Keyboard(ProtocolMacro, ProtocolDynamic, ProtocolTapDance, ProtocolCombo,
                              retries=3)
         return data
 
+    def matrix_state_readable(self):
+        """ Whether matrix_state can read the whole switch matrix of this keyboard """
+
+        if self.matrix_state_offset:
+            return (self.cols + 7) // 8 <= MATRIX_STATE_CHUNK
+        # without a starting row the firmware only reports a matrix which fits into a single response
+        return (self.cols // 8 + 1) * self.rows <= 28
+
+    def matrix_state(self):
+        """
+        Returns the state of the whole switch matrix, each row a big-endian bitmap of ceil(cols / 8) bytes
+        where bit `col` is set while the switch is closed.
+
+        Firmware which can start at a given row is read in as many reports as the matrix needs, all in flight at
+        once; otherwise the matrix comes from the single report of matrix_poll. Raises ValueError if the firmware
+        answered for another row than requested.
+        """
+
+        row_size = (self.cols + 7) // 8
+        if not self.matrix_state_offset:
+            return self.matrix_poll()[2:2 + self.rows * row_size]
+
+        rows_per_report = MATRIX_STATE_CHUNK // row_size
+        offsets = range(0, self.rows, rows_per_report)
+        # the firmware echoes command, value id and starting row back so responses can be matched to requests
+        data = self.usb_send_batch(
+            self.dev, [struct.pack("BBB", CMD_VIA_GET_KEYBOARD_VALUE, VIA_SWITCH_MATRIX_STATE, offset)
+                       for offset in offsets],
+            retries=3, echo=3)
+        for resp, offset in zip(data, offsets):
+            if resp[2] != offset:
+                raise ValueError("matrix state for row {} answered for row {}".format(offset, resp[2]))
+        return b"".join(resp[3:3 + min(rows_per_report, self.rows - offset) * row_size]
+                        for resp, offset in zip(data, offsets))
+
     def qmk_settings_set(self, qsid, value):
         from editor.qmk_settings import QmkSettings
         self.settings[qsid] = value
@@ -0,0 +1,205 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+import sys
+from array import array
+
+from keycodes.keycodes import Keycode
+
+
+class KeymapStore:
+
+    """
+    Keycodes of a layers x rows x cols keymap, kept as raw 16-bit values in the order of the firmware's keymap
+    buffer. Matrix positions without a key are absent.
+
+    Indexed by (layer, row, col) like a dict of qmk_id strings; keycodes are only serialized to strings when
+    read this way. Loading, saving, diffing and other bulk operations work on raw keycodes.
+    """
+
+    def __init__(self, layers, rows, cols, positions=()):
+        self.layers = layers
+        self.rows = rows
+        self.cols = cols
+        self.size = layers * rows * cols
+        self.codes = array("H", bytes(2 * self.size))
+        # 1 for positions which hold a key, on every layer
+        self.present = bytearray(self.size)
+        for row, col in positions:
+            for layer in range(layers):
+                self.present[self.index(layer, row, col)] = 1
+        # values written in another form than Keycode.serialize produces (aliases such as KC_PERC, raw ints),
+        # read back as written so editors keep showing what the user picked
+        self.verbatim = dict()
+
+    def index(self, layer, row, col):
+        """ Position of a keycode within the keymap buffer, in keycodes """
+        if not (0 <= layer < self.layers and 0 <= row < self.rows and 0 <= col < self.cols):
+            raise KeyError((layer, row, col))
+        return (layer * self.rows + row) * self.cols + col
+
+    def key(self, index):
+        """ Inverse of index """
+        layer, index = divmod(index, self.rows * self.cols)
+        row, col = divmod(index, self.cols)
+        return layer, row, col
+
+    def __contains__(self, key):
+        try:
+            return bool(self.present[self.index(*key)])
+        except KeyError:
+            return False
+
+    def __getitem__(self, key):
+        idx = self.index(*key)
+        if not self.present[idx]:
+            raise KeyError(key)
+        if idx in self.verbatim:
+            return self.verbatim[idx]
+        return Keycode.serialize(self.codes[idx])
+
+    def __setitem__(self, key, value):
+        idx = self.index(*key)
+        code = Keycode.deserialize(value)
+        self.present[idx] = 1
+        self.codes[idx] = code
+        if value != Keycode.serialize(code):
+            self.verbatim[idx] = value
+        else:
+            self.verbatim.pop(idx, None)
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def code(self, key, default=None):
+        """ Raw keycode at key """
+        if key in self:
+            return self.codes[self.index(*key)]
+        return default
+
+    def __iter__(self):
+        for idx in range(self.size):
+            if self.present[idx]:
+                yield self.key(idx)
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def __len__(self):
+        return self.present.count(1)
+
+    def __eq__(self, other):
+        if not isinstance(other, KeymapStore):
+            return NotImplemented
+        return (self.layers, self.rows, self.cols) == (other.layers, other.rows, other.cols) and \
+            self.present == other.present and self.codes == other.codes
+
+    def copy(self):
+        other = KeymapStore(self.layers, self.rows, self.cols)
+        other.codes = array("H", self.codes)
+        other.present = bytearray(self.present)
+        other.verbatim = dict(self.verbatim)
+        return other
+
+    def load(self, data):
+        """ Replaces all keycodes with a big-endian keymap buffer as returned by the firmware """
+
+        codes = array("H")
+        codes.frombytes(bytes(data[:2 * self.size]))
+        if sys.byteorder == "little":
+            codes.byteswap()
+        if len(codes) != self.size:
+            raise ValueError("keymap buffer too short: got {} keycodes, expected {}".format(len(codes), self.size))
+        self.codes = codes
+        self.verbatim.clear()
+
+    def to_bytes(self):
+        """ Big-endian keymap buffer, the inverse of load """
+
+        codes = array("H", self.codes)
+        if sys.byteorder == "little":
+            codes.byteswap()
+        return codes.tobytes()
+
+    def to_nested(self, missing=-1):
+        """ Serialized keycodes as [layer][row][col] lists, with `missing` for positions without a key """
+
+        out = []
+        idx = 0
+        for layer in range(self.layers):
+            rows = []
+            for row in range(self.rows):
+                cols = []
+                for col in range(self.cols):
+                    if not self.present[idx]:
+                        cols.append(missing)
+                    elif idx in self.verbatim:
+                        cols.append(self.verbatim[idx])
+                    else:
+                        cols.append(Keycode.serialize(self.codes[idx]))
+                    idx += 1
+                rows.append(cols)
+            out.append(rows)
+        return out
+
+    def diff(self, other):
+        """ Keys present in both stores whose keycodes differ """
+
+        a, b = memoryview(self.codes), memoryview(other.codes)
+        size = min(len(a), len(b))
+        out = []
+        # compare a row at a time, only rows which differ are gone through keycode by keycode
+        for start in range(0, size, self.cols or 1):
+            end = min(start + self.cols, size)
+            if a[start:end] == b[start:end]:
+                continue
+            for idx in range(start, end):
+                if a[idx] != b[idx] and self.present[idx] and other.present[idx]:
+                    out.append(self.key(idx))
+        return out
+
+    def layer_range(self, layer):
+        if not 0 <= layer < self.layers:
+            raise KeyError(layer)
+        per_layer = self.rows * self.cols
+        return layer * per_layer, (layer + 1) * per_layer
+
+    def copy_layer(self, src, dst):
+        """ Copies all keycodes of layer src onto layer dst """
+
+        src_start, src_end = self.layer_range(src)
+        dst_start, dst_end = self.layer_range(dst)
+        self.codes[dst_start:dst_end] = self.codes[src_start:src_end]
+        for idx in range(dst_start, dst_end):
+            self.verbatim.pop(idx, None)
+        for idx in range(src_start, src_end):
+            if idx in self.verbatim:
+                self.verbatim[idx - src_start + dst_start] = self.verbatim[idx]
+
+    def fill_layer(self, layer, value):
+        """ Sets every key of a layer to the same keycode, e.g. KC_TRNS """
+
+        start, end = self.layer_range(layer)
+        self.codes[start:end] = array("H", [Keycode.deserialize(value)]) * (end - start)
+        for idx in range(start, end):
+            self.verbatim.pop(idx, None)
+
+    def find(self, value):
+        """ Keys which are set to a keycode """
+
+        needle = array("H", [Keycode.deserialize(value)]).tobytes()
+        data = self.codes.tobytes()
+        out = []
+        pos = data.find(needle)
+        while pos >= 0:
+            # a match at an odd offset spans two neighbouring keycodes
+            if pos % 2:
+                pos = data.find(needle, pos + 1)
+                continue
+            if self.present[pos // 2]:
+                out.append(self.key(pos // 2))
+            pos = data.find(needle, pos + 2)
+        return out
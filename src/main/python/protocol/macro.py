@@ -7,8 +7,9 @@ from macro.macro_action_ui import tag_to_action
 from protocol.base_protocol import BaseProtocol
 from protocol.constants import CMD_VIA_MACRO_GET_COUNT, CMD_VIA_MACRO_GET_BUFFER_SIZE, CMD_VIA_MACRO_GET_BUFFER, \
     CMD_VIA_MACRO_SET_BUFFER, BUFFER_FETCH_CHUNK, VIAL_PROTOCOL_ADVANCED_MACROS
+from protocol.trace import traced
 from unlocker import Unlocker
-from util import chunks
+from util import chunks, HID_PIPELINE_WINDOW
 
 
 def macro_deserialize_v1(data):
@@ -137,6 +138,7 @@ def macro_deserialize_v2(data):
 
 class ProtocolMacro(BaseProtocol):
 
+    @traced
     def reload_macros_early(self):
         """ Reload macro information that doesn't require any info about keycodes, i.e. number of macros """
         data = self.usb_send(self.dev, struct.pack("B", CMD_VIA_MACRO_GET_COUNT), retries=20)
@@ -144,15 +146,20 @@ class ProtocolMacro(BaseProtocol):
         data = self.usb_send(self.dev, struct.pack("B", CMD_VIA_MACRO_GET_BUFFER_SIZE), retries=20)
         self.macro_memory = struct.unpack(">H", data[1:3])[0]
 
+    @traced
     def reload_macros_late(self):
         """ Load actual keycodes """
         self.macro = b""
         if self.macro_memory:
             # now retrieve the entire buffer, MACRO_CHUNK bytes at a time, as that is what fits into a packet
-            for x in range(0, self.macro_memory, BUFFER_FETCH_CHUNK):
-                sz = min(BUFFER_FETCH_CHUNK, self.macro_memory - x)
-                data = self.usb_send(self.dev, struct.pack(">BHB", CMD_VIA_MACRO_GET_BUFFER, x, sz), retries=20)
-                self.macro += data[4:4 + sz]
+            # requests are pipelined a window at a time so that we can still stop early once all macros are seen
+            requests = [(x, min(BUFFER_FETCH_CHUNK, self.macro_memory - x))
+                        for x in range(0, self.macro_memory, BUFFER_FETCH_CHUNK)]
+            for group in chunks(requests, HID_PIPELINE_WINDOW):
+                data = self.usb_send_batch(
+                    self.dev, [struct.pack(">BHB", CMD_VIA_MACRO_GET_BUFFER, x, sz) for x, sz in group],
+                    retries=20, echo=4)
+                self.macro += b"".join(resp[4:4 + sz] for resp, (x, sz) in zip(data, group))
                 if self.macro.count(b"\x00") > self.macro_count:
                     break
             # macros are stored as NUL-separated strings, so let's clean up the buffer
@@ -182,9 +189,10 @@ class ProtocolMacro(BaseProtocol):
             out.append([act.save() for act in macro])
         return out
 
-    def restore_macros(self, macros):
+    def restore_macros_data(self, macros):
+        """ Serializes macros from a saved layout into a macro buffer, None if there is nothing to restore """
         if not isinstance(macros, list):
-            return
+            return None
 
         full_macro = []
         for macro in macros:
@@ -199,8 +207,11 @@ class ProtocolMacro(BaseProtocol):
             full_macro += [[] for x in range(self.macro_count - len(full_macro))]
         full_macro = full_macro[:self.macro_count]
         # TODO: log a warning if macro is cutoff
-        data = self.macros_serialize(full_macro)[0:self.macro_memory]
-        if data != self.macro:
+        return self.macros_serialize(full_macro)[0:self.macro_memory]
+
+    def restore_macros(self, macros):
+        data = self.restore_macros_data(macros)
+        if data is not None and data != self.macro:
             Unlocker.unlock(self)
             self.set_macro(data)
 
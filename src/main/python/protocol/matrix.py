@@ -0,0 +1,229 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+import csv
+import io
+import json
+import time
+from array import array
+from collections import OrderedDict
+
+# how many transitions to keep per key, counters cover the whole session
+MATRIX_EVENTS_PER_KEY = 256
+
+# a press which follows the previous press of the same key sooner than this counts as chatter, in milliseconds
+CHATTER_MS = 30
+
+CSV_COLUMNS = ["row", "col", "presses", "chatter", "min_hold_ms", "max_hold_ms"]
+
+
+class MatrixState:
+
+    """
+    Switch matrix state as reported by VIA_SWITCH_MATRIX_STATE: each row is a big-endian bitmap of ceil(cols / 8)
+    bytes where bit `col` is set while the switch is closed.
+
+    A whole report is decoded into a single integer, so comparing two frames is one XOR regardless of the matrix
+    size and only switches which actually changed are looked at.
+    """
+
+    def __init__(self, rows, cols):
+        self.rows = rows
+        self.cols = cols
+        self.row_size = (cols + 7) // 8
+        self.size = rows * self.row_size
+        self.row_bits = self.row_size * 8
+        # ignore padding bits past the last column of every row
+        row_mask = (1 << cols) - 1
+        self.mask = 0
+        for row in range(rows):
+            self.mask = (self.mask << self.row_bits) | row_mask
+        self.frame = 0
+
+    def decode(self, data):
+        """ Bitmap of the whole matrix from matrix state bytes (without the command header) """
+
+        data = bytes(data[:self.size])
+        if len(data) != self.size:
+            raise ValueError("matrix state too short: got {} bytes, expected {}".format(len(data), self.size))
+        return int.from_bytes(data, "big") & self.mask
+
+    def position(self, bit):
+        """ (row, col) of a bit of a decoded frame """
+
+        row, col = divmod(bit, self.row_bits)
+        return self.rows - 1 - row, col
+
+    def update(self, data):
+        """ Stores a new frame, returns (row, col, pressed) of every switch which changed since the previous one """
+
+        frame = self.decode(data)
+        changed = frame ^ self.frame
+        self.frame = frame
+        out = []
+        while changed:
+            low = changed & -changed
+            bit = low.bit_length() - 1
+            row, col = self.position(bit)
+            out.append((row, col, bool(frame & low)))
+            changed ^= low
+        return out
+
+    def pressed(self, row, col):
+        bit = (self.rows - 1 - row) * self.row_bits + col
+        return bool((self.frame >> bit) & 1)
+
+    def reset(self):
+        """ Forgets the previous frame, every closed switch shows up as changed in the next update """
+
+        self.frame = 0
+
+
+class MatrixRecorder:
+
+    """
+    Per-key statistics of switch transitions reported by the matrix tester, for qualifying switches: presses,
+    chatter (a press following the previous press of the same key within chatter_ms), shortest and longest
+    hold, and the rate at which the matrix was actually scanned.
+
+    Transitions are timestamped when the poll which found them returns, so they are only as precise as the
+    poll interval; call pause when polling stops for a while so that the gap doesn't count towards the scan
+    rate. The latest MATRIX_EVENTS_PER_KEY transitions of every key are kept in ring buffers backed
+    by flat arrays, indexed by row * cols + col.
+    """
+
+    def __init__(self, rows, cols, positions=None, chatter_ms=CHATTER_MS, events_per_key=MATRIX_EVENTS_PER_KEY,
+                 clock=time.monotonic):
+        self.rows = rows
+        self.cols = cols
+        # keys to report, whether or not they were ever pressed
+        if positions is None:
+            positions = [(row, col) for row in range(rows) for col in range(cols)]
+        self.positions = sorted(positions)
+        self.chatter_ms = chatter_ms
+        self.events_per_key = events_per_key
+        self.clock = clock
+        self.clear()
+
+    def clear(self):
+        keys = self.rows * self.cols
+        self.start = self.clock()
+        self.last_frame = None
+        self.frames = 0
+        # time between consecutive polls, for the scan rate
+        self.intervals = 0
+        self.scanned = 0.0
+        # ring buffers: seconds since start and pressed state of each transition
+        self.times = array("d", [0.0]) * (keys * self.events_per_key)
+        self.states = bytearray(keys * self.events_per_key)
+        self.heads = array("L", [0]) * keys
+        self.counts = array("L", [0]) * keys
+        # counters
+        self.presses = array("L", [0]) * keys
+        self.chatter = array("L", [0]) * keys
+        self.last_press = array("d", [-1.0]) * keys
+        self.min_hold = array("d", [float("inf")]) * keys
+        self.max_hold = array("d", [0.0]) * keys
+
+    def frame(self, changes, now=None):
+        """ Records a poll of the matrix and the (row, col, pressed) changes it found, see MatrixState.update """
+
+        if now is None:
+            now = self.clock()
+        if self.last_frame is not None:
+            self.intervals += 1
+            self.scanned += now - self.last_frame
+        self.last_frame = now
+        self.frames += 1
+        for row, col, pressed in changes:
+            if row < self.rows and col < self.cols:
+                self.record(row * self.cols + col, pressed, now - self.start)
+
+    def record(self, key, pressed, t):
+        slot = key * self.events_per_key + self.heads[key]
+        self.times[slot] = t
+        self.states[slot] = pressed
+        self.heads[key] = (self.heads[key] + 1) % self.events_per_key
+        if self.counts[key] < self.events_per_key:
+            self.counts[key] += 1
+
+        last_press = self.last_press[key]
+        if pressed:
+            if last_press >= 0 and (t - last_press) * 1000 < self.chatter_ms:
+                self.chatter[key] += 1
+            self.presses[key] += 1
+            self.last_press[key] = t
+        elif last_press >= 0:
+            # switches held when recording started have no press to measure from
+            hold = t - last_press
+            self.min_hold[key] = min(self.min_hold[key], hold)
+            self.max_hold[key] = max(self.max_hold[key], hold)
+
+    def events(self, row, col):
+        """ Latest transitions of a key as (seconds since start, pressed), oldest first """
+
+        key = row * self.cols + col
+        base = key * self.events_per_key
+        count = self.counts[key]
+        first = (self.heads[key] - count) % self.events_per_key
+        out = []
+        for x in range(count):
+            slot = base + (first + x) % self.events_per_key
+            out.append((self.times[slot], bool(self.states[slot])))
+        return out
+
+    def pause(self):
+        """ Polling stopped, the next frame starts measuring the scan rate anew """
+
+        self.last_frame = None
+
+    def scan_rate(self):
+        """ Polls per second while polling, None until there are two consecutive polls """
+
+        if not self.scanned:
+            return None
+        return self.intervals / self.scanned
+
+    def key_stats(self, row, col):
+        key = row * self.cols + col
+        held = self.min_hold[key] != float("inf")
+        return OrderedDict([
+            ("row", row),
+            ("col", col),
+            ("presses", self.presses[key]),
+            ("chatter", self.chatter[key]),
+            ("min_hold_ms", round(self.min_hold[key] * 1000, 3) if held else None),
+            ("max_hold_ms", round(self.max_hold[key] * 1000, 3) if held else None),
+        ])
+
+    def summary(self):
+        keys = [self.key_stats(row, col) for row, col in self.positions]
+        scan_rate = self.scan_rate()
+        return OrderedDict([
+            ("duration_s", round(self.clock() - self.start, 6)),
+            ("frames", self.frames),
+            ("scan_rate_hz", round(scan_rate, 1) if scan_rate is not None else None),
+            ("chatter_ms", self.chatter_ms),
+            ("presses", sum(stats["presses"] for stats in keys)),
+            ("chatter", sum(stats["chatter"] for stats in keys)),
+            ("keys", keys),
+        ])
+
+    def to_json(self):
+        data = self.summary()
+        for stats in data["keys"]:
+            stats["events"] = [[round(t, 6), int(pressed)] for t, pressed in self.events(stats["row"], stats["col"])]
+        return json.dumps(data, indent=2)
+
+    def to_csv(self):
+        out = io.StringIO()
+        writer = csv.writer(out, lineterminator="\n")
+        writer.writerow(CSV_COLUMNS)
+        for row, col in self.positions:
+            stats = self.key_stats(row, col)
+            writer.writerow(["" if stats[column] is None else stats[column] for column in CSV_COLUMNS])
+        return out.getvalue()
+
+    def export(self, path):
+        """ Writes per-key statistics as CSV if path ends with .csv, otherwise statistics and transitions as JSON """
+
+        with open(path, "w", newline="") as outf:
+            outf.write(self.to_csv() if path.lower().endswith(".csv") else self.to_json())
@@ -0,0 +1,47 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+from collections import OrderedDict
+
+# rough time a single write round trip takes, including EEPROM write on the keyboard side
+RESTORE_PACKET_TIME = 0.02
+
+
+class RestorePlan:
+
+    """
+    Sequence of writes required to bring the keyboard into the state of a saved layout.
+    Built by Keyboard.plan_restore_layout against the currently cached state, so that unchanged
+    parts of the layout cost nothing.
+    """
+
+    def __init__(self):
+        # list of (subsystem, number of packets, callable performing the writes)
+        self.steps = []
+
+    def add(self, subsystem, packets, fn):
+        if packets > 0:
+            self.steps.append((subsystem, packets, fn))
+
+    def packets(self):
+        return sum(packets for _, packets, _ in self.steps)
+
+    def estimated_time(self):
+        """ Estimated time in seconds that executing the plan takes """
+        return self.packets() * RESTORE_PACKET_TIME
+
+    def summary(self):
+        """ Number of packets per subsystem, in the order they will be sent """
+        out = OrderedDict()
+        for subsystem, packets, _ in self.steps:
+            out[subsystem] = out.get(subsystem, 0) + packets
+        return out
+
+    def describe(self):
+        if not self.steps:
+            return "nothing to restore"
+        return "{} packets (~{:.1f}s): {}".format(
+            self.packets(), self.estimated_time(),
+            ", ".join("{} {}".format(subsystem, packets) for subsystem, packets in self.summary().items()))
+
+    def execute(self):
+        for _, _, fn in self.steps:
+            fn()
@@ -0,0 +1,122 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+import time
+
+from protocol.constants import CMD_VIA_SET_KEYBOARD_VALUE, CMD_VIA_SET_KEYCODE, CMD_VIA_LIGHTING_SET_VALUE, \
+    CMD_VIA_LIGHTING_SAVE, CMD_VIA_MACRO_SET_BUFFER, CMD_VIA_KEYMAP_SET_BUFFER, CMD_VIA_VIAL_PREFIX, \
+    CMD_VIAL_SET_ENCODER, CMD_VIAL_UNLOCK_START, CMD_VIAL_LOCK, CMD_VIAL_QMK_SETTINGS_SET, \
+    CMD_VIAL_QMK_SETTINGS_RESET, CMD_VIAL_DYNAMIC_ENTRY_OP, DYNAMIC_VIAL_TAP_DANCE_SET, DYNAMIC_VIAL_COMBO_SET, \
+    DYNAMIC_VIAL_KEY_OVERRIDE_SET, DYNAMIC_VIAL_ALT_REPEAT_KEY_SET
+
+# commands which write to EEPROM
+VIA_WRITE_COMMANDS = {CMD_VIA_SET_KEYBOARD_VALUE, CMD_VIA_SET_KEYCODE, CMD_VIA_LIGHTING_SET_VALUE}
+VIAL_WRITE_COMMANDS = {CMD_VIAL_SET_ENCODER, CMD_VIAL_UNLOCK_START, CMD_VIAL_LOCK}
+DYNAMIC_WRITE_OPS = {DYNAMIC_VIAL_TAP_DANCE_SET, DYNAMIC_VIAL_COMBO_SET, DYNAMIC_VIAL_KEY_OVERRIDE_SET,
+                     DYNAMIC_VIAL_ALT_REPEAT_KEY_SET}
+
+# commands which write a whole buffer chunk to EEPROM, an order of magnitude slower than writing a single value
+VIA_BUFFER_WRITE_COMMANDS = {CMD_VIA_MACRO_SET_BUFFER, CMD_VIA_KEYMAP_SET_BUFFER}
+
+# commands which may rewrite a large part of EEPROM before answering
+VIA_SLOW_COMMANDS = {CMD_VIA_LIGHTING_SAVE}
+VIAL_SLOW_COMMANDS = {CMD_VIAL_QMK_SETTINGS_SET, CMD_VIAL_QMK_SETTINGS_RESET}
+
+# retry backoff starts here and doubles with every attempt, up to BACKOFF_MAX
+BACKOFF_BASE = 0.005
+BACKOFF_MAX = 0.25
+
+
+class TimeoutClass:
+
+    """
+    Timeouts for a group of commands with similar cost on the keyboard side.
+
+    Round trip time is estimated as in RFC 6298: the timeout is the smoothed RTT plus four times its variance,
+    clamped to [min_timeout, max_timeout]; until the first sample arrives max_timeout is used. No more
+    retries are started once a single hid_send has spent `budget` seconds.
+    """
+
+    def __init__(self, name, min_timeout, max_timeout, budget):
+        self.name = name
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.budget = budget
+        self.reset()
+
+    def reset(self):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = self.max_timeout
+
+    def observe(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(self.max_timeout, max(self.min_timeout, self.srtt + 4 * self.rttvar))
+
+    def on_timeout(self):
+        # keep the backed off timeout until the next clean sample, so a device which got slower is caught up with
+        self.rto = min(self.max_timeout, self.rto * 2)
+
+
+class RetryPolicy:
+
+    """
+    Decides how long hid_send waits for a response and how it retries, depending on the command sent.
+
+    Cheap reads get short timeouts learned from recent round trips, so a lost packet costs milliseconds;
+    EEPROM writes get more time. Every retry is preceded by an exponentially growing backoff.
+    """
+
+    instance = None
+
+    def __init__(self, clock=time.monotonic, sleep=time.sleep):
+        self.clock = clock
+        self.sleep = sleep
+        self.read = TimeoutClass("read", min_timeout=0.02, max_timeout=0.5, budget=3.0)
+        self.write = TimeoutClass("write", min_timeout=0.05, max_timeout=1.0, budget=4.0)
+        # learned apart from single value writes, which would otherwise pull the timeout below what a chunk takes
+        self.buffer_write = TimeoutClass("buffer_write", min_timeout=0.15, max_timeout=1.0, budget=4.0)
+        self.slow = TimeoutClass("slow", min_timeout=0.2, max_timeout=2.0, budget=8.0)
+
+    @classmethod
+    def get(cls):
+        """ Returns the policy shared by all hid_send calls which don't pass their own """
+        if cls.instance is None:
+            cls.instance = RetryPolicy()
+        return cls.instance
+
+    def reset(self):
+        """ Forgets learned round trip times, e.g. when a different keyboard is opened """
+        for timeout_class in [self.read, self.write, self.buffer_write, self.slow]:
+            timeout_class.reset()
+
+    def classify(self, msg):
+        cmd = msg[0]
+        if cmd == CMD_VIA_VIAL_PREFIX:
+            if msg[1] in VIAL_SLOW_COMMANDS:
+                return self.slow
+            if msg[1] in VIAL_WRITE_COMMANDS:
+                return self.write
+            if msg[1] == CMD_VIAL_DYNAMIC_ENTRY_OP and msg[2] in DYNAMIC_WRITE_OPS:
+                return self.write
+            return self.read
+        if cmd in VIA_SLOW_COMMANDS:
+            return self.slow
+        if cmd in VIA_BUFFER_WRITE_COMMANDS:
+            return self.buffer_write
+        if cmd in VIA_WRITE_COMMANDS:
+            return self.write
+        return self.read
+
+    @staticmethod
+    def timeout_ms(timeout_class):
+        # hidapi treats a timeout of 0 as "block forever"
+        return max(1, int(timeout_class.rto * 1000))
+
+    @staticmethod
+    def backoff(attempt):
+        """ How long to sleep before retry number `attempt` (starting from 1) """
+        return min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempt - 1))
@@ -5,11 +5,13 @@ from keycodes.keycodes import Keycode, RESET_KEYCODE
 from protocol.base_protocol import BaseProtocol
 from protocol.constants import DYNAMIC_VIAL_TAP_DANCE_GET, CMD_VIA_VIAL_PREFIX, DYNAMIC_VIAL_TAP_DANCE_SET, \
     CMD_VIAL_DYNAMIC_ENTRY_OP
+from protocol.trace import traced
 from unlocker import Unlocker
 
 
 class ProtocolTapDance(BaseProtocol):
 
+    @traced
     def reload_tap_dance(self):
         self.tap_dance_entries = self._retrieve_dynamic_entries(DYNAMIC_VIAL_TAP_DANCE_GET,
                                                                 self.tap_dance_count, "<HHHHH")
@@ -40,7 +42,18 @@ class ProtocolTapDance(BaseProtocol):
             tap_dance.append((entry[0], entry[1], entry[2], entry[3], entry[4]))
         return tap_dance
 
-    def restore_tap_dance(self, data):
+    def restore_tap_dance_entries(self, data):
+        """ Returns (index, entry) pairs of saved entries which differ from the keyboard """
+        out = []
         for x, e in enumerate(data):
             if x < self.tap_dance_count:
-                self.tap_dance_set(x, e)
+                # saved layouts come as JSON lists, entries are kept as tuples of normalized keycodes
+                e = (Keycode.normalize(e[0]), Keycode.normalize(e[1]), Keycode.normalize(e[2]),
+                     Keycode.normalize(e[3]), e[4])
+                if e != self.tap_dance_entries[x]:
+                    out.append((x, e))
+        return out
+
+    def restore_tap_dance(self, data):
+        for x, e in self.restore_tap_dance_entries(data):
+            self.tap_dance_set(x, e)
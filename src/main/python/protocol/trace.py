@@ -0,0 +1,260 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+import functools
+import json
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+from protocol import constants
+from protocol.constants import CMD_VIA_VIAL_PREFIX, CMD_VIAL_DYNAMIC_ENTRY_OP, CMD_VIA_GET_KEYBOARD_VALUE, \
+    CMD_VIA_SET_KEYBOARD_VALUE
+
+# how many packets to keep individual records for, aggregates cover everything
+TRACE_MAX_RECORDS = 20000
+
+# upper bounds of latency histogram buckets, in milliseconds; anything slower goes into the last bucket
+HISTOGRAM_BUCKETS_MS = [0.5, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024]
+
+
+def constant_names(prefix):
+    return {getattr(constants, name): name for name in sorted(dir(constants), reverse=True)
+            if name.startswith(prefix)}
+
+
+VIA_COMMANDS = constant_names("CMD_VIA_")
+VIAL_COMMANDS = constant_names("CMD_VIAL_")
+DYNAMIC_OPS = constant_names("DYNAMIC_VIAL_")
+KEYBOARD_VALUES = {constants.VIA_LAYOUT_OPTIONS: "VIA_LAYOUT_OPTIONS",
+                   constants.VIA_SWITCH_MATRIX_STATE: "VIA_SWITCH_MATRIX_STATE"}
+
+
+def command_name(msg):
+    """ Human readable name of the command in a request, including the sub-command where there is one """
+
+    cmd = msg[0]
+    if cmd == CMD_VIA_VIAL_PREFIX and len(msg) > 1:
+        name = VIAL_COMMANDS.get(msg[1], "CMD_VIAL_0x{:02X}".format(msg[1]))
+        if msg[1] == CMD_VIAL_DYNAMIC_ENTRY_OP and len(msg) > 2:
+            name += "/" + DYNAMIC_OPS.get(msg[2], "0x{:02X}".format(msg[2]))
+        return name
+    name = VIA_COMMANDS.get(cmd, "CMD_VIA_0x{:02X}".format(cmd))
+    if cmd in [CMD_VIA_GET_KEYBOARD_VALUE, CMD_VIA_SET_KEYBOARD_VALUE] and len(msg) > 1:
+        name += "/" + KEYBOARD_VALUES.get(msg[1], "0x{:02X}".format(msg[1]))
+    return name
+
+
+def none_as_dash(value):
+    """ For plain text output of latencies, which are None for commands which never got an answer """
+    return "-" if value is None else value
+
+
+def payload_size(msg):
+    """ Size of the request without zero padding """
+    return len(bytes(msg).rstrip(b"\x00"))
+
+
+class CommandStats:
+
+    def __init__(self):
+        self.count = 0
+        self.retries = 0
+        self.failures = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.histogram = [0] * (len(HISTOGRAM_BUCKETS_MS) + 1)
+
+    def add(self, latency, retries):
+        self.count += 1
+        self.retries += retries
+        if latency is None:
+            self.failures += 1
+            return
+        self.total += latency
+        self.min = latency if self.min is None else min(self.min, latency)
+        self.max = latency if self.max is None else max(self.max, latency)
+        ms = latency * 1000
+        for idx, bound in enumerate(HISTOGRAM_BUCKETS_MS):
+            if ms <= bound:
+                self.histogram[idx] += 1
+                break
+        else:
+            self.histogram[-1] += 1
+
+    def as_dict(self):
+        answered = self.count - self.failures
+        labels = ["<={}ms".format(bound) for bound in HISTOGRAM_BUCKETS_MS] + [">{}ms".format(HISTOGRAM_BUCKETS_MS[-1])]
+        return OrderedDict([
+            ("count", self.count),
+            ("retries", self.retries),
+            ("failures", self.failures),
+            ("total_ms", round(self.total * 1000, 3)),
+            ("mean_ms", round(self.total * 1000 / answered, 3) if answered else None),
+            ("min_ms", round(self.min * 1000, 3) if self.min is not None else None),
+            ("max_ms", round(self.max * 1000, 3) if self.max is not None else None),
+            ("histogram", OrderedDict((label, n) for label, n in zip(labels, self.histogram) if n)),
+        ])
+
+
+class PacketTrace:
+
+    """
+    Opt-in record of keyboard communication, for finding out where time goes when talking to a keyboard.
+
+    hid_send and hid_send_batch record every packet: command and sub-command, payload size, send and receive
+    times and retries. Keyboard methods decorated with @traced record how long they took and how many
+    packets they sent, so a slow Keyboard.reload can be broken down into its reload_* phases. Phases are tracked
+    per thread, so that e.g. the matrix tester polling while another device loads in background doesn't get its
+    packets attributed to the loader's phases.
+    """
+
+    instance = None
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.enabled = False
+        self.lock = threading.Lock()
+        # phase stack and packet count of each thread, these survive clear so that phases in progress can end
+        self.local = threading.local()
+        self.clear()
+
+    @classmethod
+    def get(cls):
+        if cls.instance is None:
+            cls.instance = PacketTrace()
+        return cls.instance
+
+    @classmethod
+    def active(cls):
+        """ Returns the trace if tracing is enabled, None otherwise """
+        if cls.instance is not None and cls.instance.enabled:
+            return cls.instance
+        return None
+
+    def clear(self):
+        with self.lock:
+            self.start = self.clock()
+            self.records = deque(maxlen=TRACE_MAX_RECORDS)
+            self.commands = OrderedDict()
+            self.phases = OrderedDict()
+            self.packets = 0
+
+    def thread_state(self):
+        """ Phase stack and packet count of the calling thread """
+
+        state = self.local
+        if not hasattr(state, "phase_stack"):
+            state.phase_stack = []
+            state.packets = 0
+        return state
+
+    def record(self, msg, sent, received, retries=0):
+        """ Records a request sent at `sent`; received is None if the keyboard never answered """
+
+        name = command_name(msg)
+        latency = None if received is None else received - sent
+        state = self.thread_state()
+        state.packets += 1
+        with self.lock:
+            self.packets += 1
+            self.records.append(OrderedDict([
+                ("command", msg[0]),
+                ("subcommand", msg[1] if len(msg) > 1 else None),
+                ("name", name),
+                ("size", payload_size(msg)),
+                ("sent", round(sent - self.start, 6)),
+                ("received", None if received is None else round(received - self.start, 6)),
+                ("retries", retries),
+                ("phase", state.phase_stack[-1] if state.phase_stack else None),
+            ]))
+            if name not in self.commands:
+                self.commands[name] = CommandStats()
+            self.commands[name].add(latency, retries)
+
+    @contextmanager
+    def phase(self, name):
+        state = self.thread_state()
+        state.phase_stack.append(name)
+        packets = state.packets
+        start = self.clock()
+        try:
+            yield
+        finally:
+            elapsed = self.clock() - start
+            state.phase_stack.pop()
+            with self.lock:
+                stats = self.phases.setdefault(name, {"calls": 0, "total_s": 0.0, "packets": 0})
+                stats["calls"] += 1
+                stats["total_s"] += elapsed
+                # includes packets of nested phases
+                stats["packets"] += state.packets - packets
+
+    def summary(self):
+        with self.lock:
+            return OrderedDict([
+                ("packets", self.packets),
+                ("commands", OrderedDict((name, stats.as_dict()) for name, stats in self.commands.items())),
+                ("phases", OrderedDict((name, {"calls": stats["calls"], "total_s": round(stats["total_s"], 6),
+                                               "packets": stats["packets"]})
+                                       for name, stats in self.phases.items())),
+            ])
+
+    def to_json(self):
+        data = self.summary()
+        with self.lock:
+            data["records"] = list(self.records)
+        return json.dumps(data, indent=2)
+
+    def export(self, path):
+        with open(path, "w") as outf:
+            outf.write(self.to_json())
+
+    def dump(self):
+        """ Plain text overview: phases by time spent, then commands by total latency """
+
+        summary = self.summary()
+        lines = ["{} packets traced".format(summary["packets"]), "", "Phases:"]
+        for name, stats in sorted(summary["phases"].items(), key=lambda x: -x[1]["total_s"]):
+            lines.append("  {:<28} {:>5} calls {:>10.3f}s {:>7} packets".format(
+                name, stats["calls"], stats["total_s"], stats["packets"]))
+        lines += ["", "Commands:"]
+        for name, stats in sorted(summary["commands"].items(), key=lambda x: -x[1]["total_ms"]):
+            lines.append("  {:<48} {:>7} sent {:>10.1f}ms total {:>8}ms mean {:>8}ms max {:>4} retries {:>3} failed"
+                         .format(name, stats["count"], stats["total_ms"], none_as_dash(stats["mean_ms"]),
+                                 none_as_dash(stats["max_ms"]), stats["retries"], stats["failures"]))
+        return "\n".join(lines)
+
+
+def traced(fn):
+    """ Records calls of a Keyboard method as a phase of the active trace """
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        trace = PacketTrace.active()
+        if trace is None:
+            return fn(*args, **kwargs)
+        with trace.phase(fn.__name__):
+            return fn(*args, **kwargs)
+
+    return wrapper
+
+
+def traced_send(usb_send):
+    """ Wraps a usb_send-compatible transport other than hid_send, so that its packets are traced as well """
+
+    @functools.wraps(usb_send)
+    def wrapper(dev, msg, retries=1):
+        trace = PacketTrace.active()
+        if trace is None:
+            return usb_send(dev, msg, retries=retries)
+        sent = trace.clock()
+        try:
+            data = usb_send(dev, msg, retries=retries)
+        except Exception:
+            trace.record(msg, sent, None)
+            raise
+        trace.record(msg, sent, trace.clock())
+        return data
+
+    return wrapper
@@ -18,51 +18,91 @@ from util import tr, KeycodeDisplay
 
 class AlternativeDisplay(QWidget):
 
+    """
+    One way of presenting a tab's keycodes: a keyboard drawing followed by buttons for the rest of the keycodes.
+
+    Widgets are only created once the alternative is first displayed, see build.
+    """
+
     keycode_changed = pyqtSignal(str)
 
     def __init__(self, kbdef, keycodes, prefix_buttons):
         super().__init__()
 
+        self.kbdef = kbdef
         self.kb_display = None
         self.keycodes = keycodes
+        self.prefix_buttons = prefix_buttons
+        self.keycode_filter = keycode_filter_any
+        self.built = False
+        # buttons currently in the layout, in keycode order
         self.buttons = []
+        # every button created so far by qmk_id, so they can be reused when keycodes change
+        self.button_cache = dict()
+        self.visible_keycodes = []
 
         self.key_layout = FlowLayout()
 
-        if prefix_buttons:
-            for title, code in prefix_buttons:
+        layout = QVBoxLayout()
+        layout.addLayout(self.key_layout)
+        self.setLayout(layout)
+
+    def build(self):
+        if self.built:
+            return
+        self.built = True
+
+        if self.prefix_buttons:
+            for title, code in self.prefix_buttons:
                 btn = SquareButton()
                 btn.setRelSize(KEYCODE_BTN_RATIO)
                 btn.setText(title)
                 btn.clicked.connect(lambda st, k=code: self.keycode_changed.emit(title))
                 self.key_layout.addWidget(btn)
 
-        layout = QVBoxLayout()
-        if kbdef:
-            self.kb_display = DisplayKeyboard(kbdef)
-            self.kb_display.keycode_changed.connect(self.keycode_changed)
-            layout.addWidget(self.kb_display)
-            layout.setAlignment(self.kb_display, Qt.AlignHCenter)
-        layout.addLayout(self.key_layout)
-        self.setLayout(layout)
+        self.build_kb_display()
+        self.update_buttons()
+
+    def build_kb_display(self):
+        if self.kbdef is None or self.kb_display is not None:
+            return
+        self.kb_display = DisplayKeyboard(self.kbdef)
+        self.kb_display.keycode_changed.connect(self.keycode_changed)
+        self.kb_display.relabel_buttons()
+        self.layout().insertWidget(0, self.kb_display)
+        self.layout().setAlignment(self.kb_display, Qt.AlignHCenter)
 
     def recreate_buttons(self, keycode_filter):
-        for btn in self.buttons:
-            btn.hide()
-            btn.deleteLater()
-        self.buttons = []
+        self.keycode_filter = keycode_filter
+        self.visible_keycodes = [keycode for keycode in self.keycodes
+                                 if not keycode.hidden and keycode_filter(keycode.qmk_id)]
+        if self.built:
+            self.update_buttons()
+
+    def update_buttons(self):
+        """ Makes buttons match visible_keycodes, reusing the existing ones """
+
+        qmk_ids = [keycode.qmk_id for keycode in self.visible_keycodes]
+        if [btn.keycode.qmk_id for btn in self.buttons] != qmk_ids:
+            for btn in self.buttons:
+                self.key_layout.removeWidget(btn)
+                btn.hide()
+            self.buttons = []
+            for keycode in self.visible_keycodes:
+                btn = self.button_cache.get(keycode.qmk_id)
+                if btn is None:
+                    btn = SquareButton()
+                    btn.setRelSize(KEYCODE_BTN_RATIO)
+                    btn.clicked.connect(lambda st, b=btn: self.keycode_changed.emit(b.keycode.qmk_id))
+                    self.button_cache[keycode.qmk_id] = btn
+                self.key_layout.addWidget(btn)
+                btn.show()
+                self.buttons.append(btn)
 
-        for keycode in self.keycodes:
-            if keycode.hidden or not keycode_filter(keycode.qmk_id):
-                continue
-            btn = SquareButton()
-            btn.setRelSize(KEYCODE_BTN_RATIO)
-            btn.setToolTip(Keycode.tooltip(keycode.qmk_id))
-            btn.clicked.connect(lambda st, k=keycode: self.keycode_changed.emit(k.qmk_id))
+        # same qmk_id can come with a different label, e.g. custom keycodes of another keyboard
+        for btn, keycode in zip(self.buttons, self.visible_keycodes):
             btn.keycode = keycode
-            self.key_layout.addWidget(btn)
-            self.buttons.append(btn)
-
+            btn.setToolTip(Keycode.tooltip(keycode.qmk_id))
         self.relabel_buttons()
 
     def relabel_buttons(self):
@@ -72,10 +112,11 @@ class AlternativeDisplay(QWidget):
         KeycodeDisplay.relabel_buttons(self.buttons)
 
     def required_width(self):
+        self.build_kb_display()
         return self.kb_display.sizeHint().width() if self.kb_display else 0
 
     def has_buttons(self):
-        return len(self.buttons) > 0
+        return len(self.visible_keycodes) > 0
 
 
 class Tab(QScrollArea):
@@ -86,6 +127,7 @@ class Tab(QScrollArea):
         super().__init__(parent)
 
         self.label = label
+        self.had_buttons = None
         self.layout = QVBoxLayout()
         self.layout.setContentsMargins(0, 0, 0, 0)
 
@@ -93,6 +135,7 @@ class Tab(QScrollArea):
         for kb, keys in alts:
             alt = AlternativeDisplay(kb, keys, prefix_buttons)
             alt.keycode_changed.connect(self.keycode_changed)
+            alt.hide()
             self.layout.addWidget(alt)
             self.alternatives.append(alt)
 
@@ -107,7 +150,11 @@ class Tab(QScrollArea):
     def recreate_buttons(self, keycode_filter):
         for alt in self.alternatives:
             alt.recreate_buttons(keycode_filter)
-        self.setVisible(self.has_buttons())
+        # showing/hiding relayouts the whole tab, skip it when nothing changed
+        has_buttons = self.has_buttons()
+        if has_buttons != self.had_buttons:
+            self.setVisible(has_buttons)
+            self.had_buttons = has_buttons
 
     def relabel_buttons(self):
         for alt in self.alternatives:
@@ -127,6 +174,7 @@ class Tab(QScrollArea):
         # then display first alternative which fits on screen w/o horizontal scroll
         for alt in self.alternatives:
             if self.width() - self.verticalScrollBar().width() > alt.required_width():
+                alt.build()
                 alt.show()
                 break
 
@@ -188,6 +236,7 @@ class FilteredTabbedKeycodes(QTabWidget):
         for tab in self.tabs:
             tab.keycode_changed.connect(self.on_keycode_changed)
 
+        self.shown_tabs = None
         self.recreate_keycode_buttons()
         KeycodeDisplay.notify_keymap_override(self)
 
@@ -198,16 +247,21 @@ class FilteredTabbedKeycodes(QTabWidget):
             self.keycode_changed.emit(Keycode.normalize(code))
 
     def recreate_keycode_buttons(self):
+        for tab in self.tabs:
+            tab.recreate_buttons(self.keycode_filter)
+        tabs = [tab for tab in self.tabs if tab.has_buttons()]
+        if tabs == self.shown_tabs:
+            return
+
         prev_tab = self.tabText(self.currentIndex()) if self.currentIndex() >= 0 else ""
         while self.count() > 0:
             self.removeTab(0)
 
-        for tab in self.tabs:
-            tab.recreate_buttons(self.keycode_filter)
-            if tab.has_buttons():
-                self.addTab(tab, tr("TabbedKeycodes", tab.label))
-                if tab.label == prev_tab:
-                    self.setCurrentIndex(self.count() - 1)
+        for tab in tabs:
+            self.addTab(tab, tr("TabbedKeycodes", tab.label))
+            if tab.label == prev_tab:
+                self.setCurrentIndex(self.count() - 1)
+        self.shown_tabs = tabs
 
     def on_keymap_override(self):
         for tab in self.tabs:
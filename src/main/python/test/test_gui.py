@@ -2,8 +2,10 @@ import lzma
 import os.path
 import struct
 
-from PyQt5.QtCore import QPoint
+from PyQt5.QtCore import QPoint, Qt
+from PyQt5.QtGui import QTransform
 from PyQt5.QtWidgets import QPushButton
+from kle_serial import Serial as KleSerial
 from pytestqt.qt_compat import qt_api
 
 from main_window import MainWindow
@@ -14,6 +16,8 @@ from protocol.constants import CMD_VIA_GET_PROTOCOL_VERSION, CMD_VIA_VIAL_PREFIX
     DYNAMIC_VIAL_GET_NUMBER_OF_ENTRIES, CMD_VIA_KEYMAP_GET_BUFFER, CMD_VIA_MACRO_GET_BUFFER, CMD_VIAL_GET_UNLOCK_STATUS, \
     CMD_VIA_SET_KEYCODE, DYNAMIC_VIAL_COMBO_GET, DYNAMIC_VIAL_COMBO_SET, DYNAMIC_VIAL_TAP_DANCE_GET, \
     DYNAMIC_VIAL_TAP_DANCE_SET
+from tabbed_keycodes import TabbedKeycodes
+from widgets.keyboard_widget import KeyboardWidget
 from widgets.square_button import SquareButton
 
 FAKE_KEYBOARD = """
@@ -149,17 +153,21 @@ class VirtualKeyboard:
             return struct.pack(">BH", msg[0], len(self.macro_buffer))
         elif msg[0] == CMD_VIA_MACRO_GET_BUFFER:
             offset, size = struct.unpack_from(">HB", msg[1:])
-            return msg[0:1] + self.macro_buffer[offset:offset+size]
+            return msg[0:4] + self.macro_buffer[offset:offset+size]
         elif msg[0] == CMD_VIA_GET_LAYER_COUNT:
             return struct.pack(">BB", msg[0], self.layers)
         elif msg[0] == CMD_VIA_KEYMAP_GET_BUFFER:
             offset, size = struct.unpack_from(">HB", msg[1:])
-            return msg[0:1] + self.get_keymap_buffer()[offset:offset+size]
+            return msg[0:4] + self.get_keymap_buffer()[offset:offset+size]
         raise RuntimeError("unknown command for VIA protocol 0x{:02X}".format(msg[0]))
 
 
 class MockDevice:
 
+    def __init__(self):
+        # requests which were written but not read back yet, like the hidraw report queue
+        self.msgs = []
+
     def open_path(self, path):
         assert path == "/magic/path/for/tests"
 
@@ -169,13 +177,13 @@ class MockDevice:
     def write(self, data):
         assert len(data) == 33
         assert data[0] == 0
-        self.msg = data[1:]
+        self.msgs.append(data[1:])
 
         return len(data)
 
     def read(self, sz, timeout_ms=None):
         assert sz == 32
-        resp = self.vk.process(self.msg)
+        resp = self.vk.process(self.msgs.pop(0))
         assert len(resp) <= 32
         resp += b"\x00" * (32 - len(resp))
         return resp
@@ -205,6 +213,8 @@ def prepare(qtbot, keyboard_json, combos=None, tap_dance=None):
     # keep reference to MainWindow for the duration of tests
     # when MainWindow goes out of scope some KeyWidgets are still registered within KeycodeDisplay which causes UaF
     all_mw.append(mw)
+    # keyboard is opened in background
+    qtbot.waitUntil(lambda: mw.device_loader is None)
 
     return mw, vk
 
@@ -215,6 +225,29 @@ def test_gui_startup(qtbot):
     assert mw.combobox_devices.count() == 1
 
 
+def test_keyboard_actions_locked(qtbot):
+    mw, vk = prepare(qtbot, FAKE_KEYBOARD)
+    assert all(act.isEnabled() for act in mw.keyboard_actions)
+    # e.g. while the keyboard is still loading
+    mw.lock_ui()
+    assert not any(act.isEnabled() for act in mw.keyboard_actions)
+    mw.unlock_ui()
+    assert all(act.isEnabled() for act in mw.keyboard_actions)
+
+
+def test_editors_lazy(qtbot):
+    mw, vk = prepare(qtbot, FAKE_KEYBOARD)
+    # only the keymap tab has been opened so far
+    assert mw.macro_recorder.instance is None
+
+    for x in range(mw.tabs.count()):
+        if mw.tabs.tabText(x) == "Macros":
+            mw.tabs.setCurrentIndex(x)
+
+    assert mw.macro_recorder.instance is not None
+    assert mw.macro_recorder.instance.device is mw.autorefresh.current_device
+
+
 def test_about_keyboard(qtbot):
     mw, vk = prepare(qtbot, FAKE_KEYBOARD)
 
@@ -279,6 +312,7 @@ def test_key_change(qtbot):
 
     # check the new keycode is KC_B
     assert vk.keymap[0][0][0] == 5
+    assert mw.keymap_editor.container.widgets[0].text == "B"
 
     # check that we moved to the next key after setting the first key
     assert mw.keymap_editor.container.active_key == mw.keymap_editor.container.widgets[1]
@@ -299,6 +333,7 @@ def test_key_change(qtbot):
 
     # check the new keycode is LCTL()
     assert vk.keymap[0][0][1] == 0x100
+    assert mw.keymap_editor.container.widgets[1].masked
 
     # check that we moved to the next key after setting the second key
     assert mw.keymap_editor.container.active_key == mw.keymap_editor.container.widgets[2]
@@ -334,6 +369,7 @@ def test_key_change(qtbot):
 
     # check the new keycode is LCTL(KC_C)
     assert vk.keymap[0][0][1] == 0x106
+    assert mw.keymap_editor.container.widgets[1].mask_text == "C"
 
     # and we should have moved to the next key, setting the full key and not the inner
     assert mw.keymap_editor.container.active_key == mw.keymap_editor.container.widgets[2]
@@ -371,6 +407,95 @@ def test_keymap_zoom(qtbot):
     assert mw.keymap_editor.container.scale < scale_initial
 
 
+def test_keymap_render(qtbot):
+    """ Tests that keys are rendered once and repainted only when their appearance changes """
+    mw, vk = prepare(qtbot, FAKE_KEYBOARD)
+    container = mw.keymap_editor.container
+
+    container.grab()
+    key = container.widgets[0]
+    assert len(key.pixmaps) == 1
+    # repaint area of a key covers all of its shape
+    assert container.key_rect(key).contains(
+        QTransform.fromScale(container.scale, container.scale).mapRect(key.polygon.boundingRect()).toRect())
+
+    # unchanged keys reuse their rendering
+    pixmaps = list(key.pixmaps.values())
+    container.grab()
+    assert list(key.pixmaps.values()) == pixmaps
+
+    # changing a key renders it again, going back reuses the earlier rendering
+    key.setPressed(True)
+    container.grab()
+    assert len(key.pixmaps) == 2
+    key.setPressed(False)
+    container.grab()
+    assert len(key.pixmaps) == 2
+
+
+class FakeLayoutEditor:
+
+    def get_choice(self, idx):
+        return 0
+
+
+def test_keyboard_widget_hit_test(qtbot):
+    """ Tests that hit testing through the key grid finds the same keys as checking every key """
+    keys = KleSerial().deserialize([
+        ["0,0", "0,1", {"w": 2}, "0,2"],
+        [{"r": 15, "rx": 1, "ry": 1}, "1,0", "1,1"],
+        [{"r": -30, "rx": 4, "ry": 1.5, "h": 2}, "1,2"],
+    ]).keys
+    for key in keys:
+        key.layout_index = -1
+    widget = KeyboardWidget(FakeLayoutEditor())
+    qtbot.addWidget(widget)
+    widget.set_keys(keys, [])
+    widget.widgets[1].masked = True
+
+    def brute_force(pos):
+        for key in widget.widgets:
+            if key.masked and key.mask_polygon.containsPoint(pos / widget.scale, Qt.OddEvenFill):
+                return key, True
+            if key.polygon.containsPoint(pos / widget.scale, Qt.OddEvenFill):
+                return key, False
+        return None, False
+
+    hits = 0
+    for scale in [1, 1.7]:
+        widget.set_scale(scale)
+        widget.update_layout()
+        for x in range(0, widget.width, 3):
+            for y in range(0, widget.height, 3):
+                expected = brute_force(QPoint(x, y))
+                assert widget.hit_test(QPoint(x, y)) == expected
+                hits += expected[0] is not None
+    assert hits > 0
+
+
+def test_keycode_picker_lazy(qtbot):
+    """ Tests that keycode picker tabs are built when first displayed and keep their buttons across rebuilds """
+    picker = TabbedKeycodes()
+    qtbot.addWidget(picker)
+    picker.show()
+    qtbot.waitExposed(picker)
+
+    ak = picker.all_keycodes
+    assert ak.currentIndex() == 0
+    assert any(alt.built for alt in ak.widget(0).alternatives)
+    assert not any(alt.built for tab in ak.tabs[1:] for alt in tab.alternatives)
+
+    alt = next(alt for alt in ak.widget(0).alternatives if alt.built)
+    buttons = list(alt.buttons)
+    assert buttons
+    picker.recreate_keycode_buttons()
+    assert alt.buttons == buttons
+
+    # switching to a tab builds it
+    ak.setCurrentIndex(1)
+    assert any(alt.built and alt.buttons for alt in ak.widget(1).alternatives)
+
+
 def find_key_btn(start, text):
     for w in start.findChildren(SquareButton):
         if w.isVisible() and w.text == text:
@@ -1,10 +1,28 @@
+import json
+import os
+import tempfile
+import threading
 import unittest
+from unittest import mock
 import lzma
 import struct
+import sys
 
+from autorefresh.autorefresh_thread import AutorefreshThread
+from autorefresh.autorefresh_thread_linux import parse_uevent
+from autorefresh.device_loader import DeviceLoader, LoadCancelled
 from keycodes.keycodes import Keycode
+from protocol.constants import CMD_VIA_VIAL_PREFIX, CMD_VIAL_GET_ENCODER, CMD_VIAL_GET_DEFINITION
+from protocol.definition_cache import DefinitionCache
+from protocol.fault_injection import FaultInjectingDevice
+from protocol.retry_policy import RetryPolicy
+from protocol.trace import PacketTrace, command_name
+from protocol.emulator import VialEmulator, make_definition, UNLOCK_COUNTER_MAX
 from protocol.keyboard_comm import Keyboard
-from util import chunks, MSG_LEN
+from protocol.keymap_store import KeymapStore
+from protocol.matrix import MatrixState, MatrixRecorder
+import util
+from util import chunks, MSG_LEN, hid_send, hid_send_batch, find_vial_devices, RawHidProbes
 
 LAYOUT_2x2 = """
 {"name":"test","vendorId":"0x0000","productId":"0x1111","lighting":"none","matrix":{"rows":2,"cols":2},"layouts":{"keymap":[["0,0","0,1"],["1,0","1,1"]]}}
@@ -41,10 +59,13 @@ class SimulatedDevice:
     def expect_keyboard_id(self, kbid):
         self.expect("FE00", struct.pack("<IQ", 0, kbid))
 
-    def expect_layout(self, layout):
+    def expect_layout(self, layout, cached=False):
         compressed = lzma.compress(layout.encode("utf-8"))
         self.expect("FE01", struct.pack("<I", len(compressed)))
         for idx, chunk in enumerate(chunks(compressed, 32)):
+            # with a cache hit, only the first block is retrieved to validate the cache entry
+            if cached and idx > 0:
+                break
             self.expect(
                 struct.pack("<BBI", 0xFE, 0x02, idx),
                 chunk
@@ -95,14 +116,70 @@ class SimulatedDevice:
             ))
 
 
+class QueuedDevice:
+    """ hidapi-like device which queues requests and answers them in order, echoing the request header """
+
+    def __init__(self, stale=None, drop=None):
+        self.pending = []
+        # responses to inject before the first real one, e.g. left over from a previous command
+        self.stale = list(stale or [])
+        # indices of requests which never get a response
+        self.drop = set(drop or [])
+        self.writes = 0
+
+    def write(self, data):
+        if self.writes not in self.drop:
+            self.pending.append(data[1:])
+        self.writes += 1
+        return len(data)
+
+    def read(self, length, timeout_ms=0):
+        if self.stale:
+            return self.stale.pop(0)
+        if not self.pending:
+            return b""
+        msg = self.pending.pop(0)
+        return msg[:4] + bytes([msg[1] ^ 0xFF]) + b"\x00" * (length - 5)
+
+
+class TestHidSendBatch(unittest.TestCase):
+
+    @staticmethod
+    def requests(count):
+        return [struct.pack(">BHB", 0x12, x * 28, 28) for x in range(count)]
+
+    def test_batch_in_order(self):
+        dev = QueuedDevice()
+        data = hid_send_batch(dev, self.requests(20), echo=4, window=4)
+        self.assertEqual(len(data), 20)
+        for x, resp in enumerate(data):
+            self.assertEqual(resp[:4], struct.pack(">BHB", 0x12, x * 28, 28))
+        self.assertEqual(dev.writes, 20)
+
+    def test_batch_skips_stale(self):
+        """ Responses not matching any request in flight are discarded """
+        dev = QueuedDevice(stale=[b"\xFE" + b"\x00" * 31])
+        data = hid_send_batch(dev, self.requests(5), echo=4, window=4)
+        for x, resp in enumerate(data):
+            self.assertEqual(resp[:4], struct.pack(">BHB", 0x12, x * 28, 28))
+
+    def test_batch_retries_lost(self):
+        """ A request which never got a response is resent in lockstep """
+        dev = QueuedDevice(drop=[2])
+        data = hid_send_batch(dev, self.requests(6), echo=4, window=4)
+        for x, resp in enumerate(data):
+            self.assertEqual(resp[:4], struct.pack(">BHB", 0x12, x * 28, 28))
+        self.assertEqual(dev.writes, 7)
+
+
 class TestKeyboard(unittest.TestCase):
 
     @staticmethod
-    def prepare_keyboard(layout, keymap, encoders=None):
+    def prepare_keyboard(layout, keymap, encoders=None, kbid=0, cache=None, cached=False):
         dev = SimulatedDevice()
         dev.expect_via_protocol(9)
-        dev.expect_keyboard_id(0)
-        dev.expect_layout(layout)
+        dev.expect_keyboard_id(kbid)
+        dev.expect_layout(layout, cached)
         dev.expect_layers(len(keymap))
 
         # macro count
@@ -114,7 +191,7 @@ class TestKeyboard(unittest.TestCase):
         if encoders is not None:
             dev.expect_encoders(encoders)
 
-        kb = Keyboard(dev, dev.sim_send)
+        kb = Keyboard(dev, dev.sim_send, definition_cache=cache)
         kb.reload()
 
         return kb, dev
@@ -171,6 +248,46 @@ class TestKeyboard(unittest.TestCase):
         self.assertEqual(kb.layout[(1, 1, 0)], Keycode.serialize(10))
         dev.finish()
 
+    def test_layout_restore_coalesced(self):
+        """ Tests that restoring several nearby keys is done with a single keymap buffer write """
+
+        kb, dev = self.prepare_keyboard(LAYOUT_2x2, [[[1, 2], [3, 4]], [[5, 6], [7, 8]]])
+        data = kb.save_layout()
+        dev.finish()
+
+        kb, dev = self.prepare_keyboard(LAYOUT_2x2, [[[9, 2], [3, 10]], [[5, 6], [7, 8]]])
+        plan = kb.plan_restore_layout(data)
+        self.assertEqual(plan.packets(), 1)
+        self.assertEqual(plan.summary(), {"keymap": 1})
+        dev.expect("130000080001000200030004", "")
+        plan.execute()
+        self.assertEqual(kb.layout[(0, 0, 0)], s(1))
+        self.assertEqual(kb.layout[(0, 1, 1)], s(4))
+        dev.finish()
+
+    def test_layout_restore_unchanged(self):
+        """ Tests that restoring the same layout doesn't communicate with the keyboard """
+
+        kb, dev = self.prepare_keyboard(LAYOUT_2x2, [[[1, 2], [3, 4]], [[5, 6], [7, 8]]])
+        data = kb.save_layout()
+        self.assertEqual(kb.plan_restore_layout(data).packets(), 0)
+        self.assertEqual(kb.restore_layout(data).describe(), "nothing to restore")
+        dev.finish()
+
+    def test_reload_parts(self):
+        """ Tests that partial reload only refetches selected parts and reports what changed """
+
+        kb, dev = self.prepare_keyboard(LAYOUT_2x2, [[[1, 2], [3, 4]], [[5, 6], [7, 8]]])
+        dev.expect_keymap([[[1, 2], [3, 4]], [[5, 6], [7, 8]]])
+        self.assertEqual(kb.reload(parts={"keymap"}), set())
+        dev.expect_keymap([[[1, 2], [3, 4]], [[5, 6], [7, 9]]])
+        self.assertEqual(kb.reload(parts={"keymap", "macros"}), {"keymap"})
+        self.assertEqual(kb.layout[(1, 1, 1)], s(9))
+        dev.finish()
+
+        with self.assertRaises(ValueError):
+            kb.reload(parts={"bogus"})
+
     def test_encoder_simple(self):
         """ Tests that we try to retrieve encoder layout """
 
@@ -194,3 +311,715 @@ class TestKeyboard(unittest.TestCase):
         dev.expect("FE040100010020", "")
         kb.set_encoder(1, 0, 1, Keycode.serialize(0x20))
         self.assertEqual(kb.encoder_layout[(1, 0, 1)], Keycode.serialize(0x20))
+
+
+class TestKeymapStore(unittest.TestCase):
+
+    @staticmethod
+    def prepare_store():
+        # 2 layers of 2x3, without a key at 1,2
+        store = KeymapStore(2, 2, 3, [(0, 0), (0, 1), (0, 2), (1, 0), (1, 1)])
+        store.load(struct.pack(">12H", 1, 2, 3, 4, 5, 0, 6, 7, 8, 9, 10, 0))
+        return store
+
+    def test_mapping(self):
+        store = self.prepare_store()
+        self.assertEqual(len(store), 10)
+        self.assertEqual(store[(0, 0, 1)], s(2))
+        self.assertEqual(store[(1, 1, 1)], s(10))
+        self.assertIn((1, 1, 0), store)
+        self.assertNotIn((1, 1, 2), store)
+        self.assertNotIn((2, 0, 0), store)
+        self.assertIsNone(store.get((1, 1, 2)))
+        with self.assertRaises(KeyError):
+            store[(0, 1, 2)]
+        with self.assertRaises(KeyError):
+            store[(0, 0, 3)] = "KC_A"
+        self.assertEqual(store.keys()[:4], [(0, 0, 0), (0, 0, 1), (0, 0, 2), (0, 1, 0)])
+
+        store[(0, 0, 0)] = "KC_A"
+        self.assertEqual(store.code((0, 0, 0)), 4)
+        # aliases are read back as written
+        store[(0, 0, 1)] = "KC_PERC"
+        self.assertEqual(store[(0, 0, 1)], "KC_PERC")
+        self.assertEqual(store.code((0, 0, 1)), Keycode.deserialize("LSFT(KC_5)"))
+
+    def test_bytes_roundtrip(self):
+        store = self.prepare_store()
+        self.assertEqual(store.to_bytes(), struct.pack(">12H", 1, 2, 3, 4, 5, 0, 6, 7, 8, 9, 10, 0))
+        self.assertEqual(store.to_nested(missing=-1)[1][1], [s(9), s(10), -1])
+
+    def test_bulk(self):
+        store = self.prepare_store()
+        other = store.copy()
+        self.assertEqual(store, other)
+        other[(1, 0, 2)] = s(2)
+        self.assertNotEqual(store, other)
+        self.assertEqual(store.diff(other), [(1, 0, 2)])
+
+        store.copy_layer(0, 1)
+        self.assertEqual(store.find(s(2)), [(0, 0, 1), (1, 0, 1)])
+        self.assertEqual(store[(1, 1, 1)], s(5))
+
+        store.fill_layer(1, "KC_Z")
+        self.assertEqual(store.find("KC_Z"), [(1, 0, 0), (1, 0, 1), (1, 0, 2), (1, 1, 0), (1, 1, 1)])
+
+    def test_bulk_unaligned(self):
+        store = KeymapStore(1, 2, 2, [(0, 0), (0, 1), (1, 0), (1, 1)])
+        store.load(struct.pack(">4H", 0x0100, 0x0001, 0x0101, 0x0101))
+        # the bytes of 0x0101 also appear across the first two keycodes, in either byte order
+        self.assertEqual(store.find(s(0x0101)), [(0, 1, 0), (0, 1, 1)])
+
+        other = store.copy()
+        other[(0, 1, 1)] = "KC_A"
+        self.assertEqual(store.diff(other), [(0, 1, 1)])
+        self.assertEqual(other.diff(store), [(0, 1, 1)])
+
+
+class TestDefinitionCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = DefinitionCache(self.tmp.name, max_entries=2)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_cache_hit(self):
+        """ Second reload of the same keyboard only retrieves the first definition block """
+
+        keymap = [[[1, 2], [3, 4]], [[5, 6], [7, 8]]]
+        kb, dev = TestKeyboard.prepare_keyboard(LAYOUT_ENCODER, [[[1]]], [[(10, 11)]], kbid=0x1234, cache=self.cache)
+        dev.finish()
+        kb, dev = TestKeyboard.prepare_keyboard(LAYOUT_2x2, keymap, kbid=0x1234, cache=self.cache)
+        dev.finish()
+        kb, dev = TestKeyboard.prepare_keyboard(LAYOUT_2x2, keymap, kbid=0x1234, cache=self.cache, cached=True)
+        self.assertEqual(kb.rows, 2)
+        self.assertEqual(kb.cols, 2)
+        self.assertEqual([(k.row, k.col) for k in kb.keys], [(0, 0), (0, 1), (1, 0), (1, 1)])
+        self.assertEqual(kb.layout[(1, 1, 1)], s(8))
+        dev.finish()
+
+    def test_invalid_entry(self):
+        """ Corrupted entries are discarded """
+
+        key = self.cache.make_key(1, 2, b"\x00")
+        with open(self.cache.entry_path(key), "w") as outf:
+            outf.write("{garbage")
+        self.assertIsNone(self.cache.load(key))
+        self.assertFalse(os.path.exists(self.cache.entry_path(key)))
+
+    def test_eviction(self):
+        for x in range(3):
+            self.cache.store(self.cache.make_key(x, 1, b"\x00"), {"x": x}, [])
+            os.utime(self.cache.entry_path(self.cache.make_key(x, 1, b"\x00")), (x, x))
+        self.cache.evict()
+        self.assertIsNone(self.cache.load(self.cache.make_key(0, 1, b"\x00")))
+        self.assertEqual(self.cache.load(self.cache.make_key(2, 1, b"\x00"))[0], {"x": 2})
+
+
+class TestEmulator(unittest.TestCase):
+
+    @staticmethod
+    def prepare_emulator(**kwargs):
+        emulator = VialEmulator(make_definition(3, 10, encoders=2), **kwargs)
+        for x in range(0, len(emulator.keymap), 2):
+            emulator.keymap[x:x + 2] = struct.pack(">H", 4 + x // 2 % 100)
+        return emulator
+
+    def test_reload(self):
+        """ Keyboard reads the same state through both usb_send and the pipelined hidapi path """
+
+        emulator = self.prepare_emulator()
+        kb = Keyboard(emulator, usb_send=emulator.send)
+        kb.reload()
+        pipelined = Keyboard(emulator)
+        pipelined.reload()
+
+        self.assertEqual(kb.rows, 3)
+        self.assertEqual(kb.cols, 10)
+        self.assertEqual(len(kb.encoders), 4)
+        self.assertEqual(kb.layout[(0, 0, 1)], s(5))
+        self.assertEqual(kb.layout, pipelined.layout)
+        self.assertEqual(kb.encoder_layout, pipelined.encoder_layout)
+
+    def test_reload_progress(self):
+        """ Parts are reported as they become available, keymap before anything that is not needed to show it """
+
+        emulator = self.prepare_emulator()
+        kb = Keyboard(emulator)
+        reported = []
+        kb.reload(progress=lambda part, done, total: reported.append((part, done, total)))
+
+        parts = [part for part, done, total in reported]
+        self.assertEqual([done for part, done, total in reported], list(range(1, len(reported) + 1)))
+        self.assertTrue(all(total == len(reported) for part, done, total in reported))
+        self.assertLess(parts.index("keymap"), parts.index("macros"))
+        self.assertLess(parts.index("keymap"), parts.index("rgb"))
+        self.assertLess(parts.index("keymap"), parts.index("settings"))
+        self.assertEqual(kb.layout[(0, 0, 1)], s(5))
+
+    def test_save_restore(self):
+        """ Layout saved from one keyboard restores onto another """
+
+        src = self.prepare_emulator(combo_count=4)
+        src.combos[1] = (4, 5, 0, 0, 6)
+        kb = Keyboard(src, usb_send=src.send)
+        kb.reload()
+        kb.set_key(2, 1, 1, s(0x20))
+        data = kb.save_layout()
+
+        dst = VialEmulator(make_definition(3, 10, encoders=2), combo_count=4)
+        kb = Keyboard(dst, usb_send=dst.send)
+        kb.reload()
+        kb.restore_layout(data)
+        self.assertEqual(dst.keymap, src.keymap)
+        self.assertEqual(dst.combos, src.combos)
+
+    def test_locked(self):
+        """ Locked keyboard refuses QK_BOOT and macro writes until unlock keys are held """
+
+        emulator = self.prepare_emulator(locked=True, unlock_keys=[(0, 1), (2, 3)])
+        kb = Keyboard(emulator, usb_send=emulator.send)
+        kb.reload()
+        self.assertEqual(kb.get_unlock_status(), 0)
+        self.assertEqual(kb.get_unlock_keys(), [(0, 1), (2, 3)])
+
+        set_boot = struct.pack(">BBBBH", 0x05, 0, 0, 0, emulator.qk_boot)
+        kb.usb_send(kb.dev, set_boot)
+        self.assertEqual(emulator.keymap[0:2], struct.pack(">H", 4))
+        emulator.macro_buffer[0:2] = b"\x00\x00"
+        kb.usb_send(kb.dev, struct.pack(">BHB", 0x0F, 0, 1) + b"A")
+        self.assertEqual(emulator.macro_buffer[0:1], b"\x00")
+
+        kb.unlock_start()
+        self.assertEqual(kb.get_unlock_in_progress(), 1)
+        emulator.press(0, 1)
+        self.assertEqual(kb.unlock_poll()[2], UNLOCK_COUNTER_MAX)
+        emulator.press(2, 3)
+        for x in range(UNLOCK_COUNTER_MAX):
+            data = kb.unlock_poll()
+        self.assertEqual(data[0], 1)
+        self.assertEqual(kb.get_unlock_status(), 1)
+
+        kb.usb_send(kb.dev, set_boot)
+        self.assertEqual(emulator.keymap[0:2], struct.pack(">H", emulator.qk_boot))
+
+        kb.lock()
+        self.assertEqual(kb.get_unlock_status(), 0)
+
+    def test_matrix_state(self):
+        emulator = self.prepare_emulator()
+        kb = Keyboard(emulator, usb_send=emulator.send)
+        kb.reload()
+        emulator.press(1, 9)
+        data = kb.matrix_poll()
+        # two bytes per row, big-endian column bitmap
+        self.assertEqual(data[2:8], b"\x00\x00\x02\x00\x00\x00")
+
+    def test_matrix_state_changes(self):
+        emulator = self.prepare_emulator()
+        kb = Keyboard(emulator, usb_send=emulator.send)
+        kb.reload()
+        matrix = MatrixState(kb.rows, kb.cols)
+        self.assertEqual(matrix.update(kb.matrix_poll()[2:]), [])
+
+        emulator.press(0, 0)
+        emulator.press(1, 9)
+        emulator.press(2, 3)
+        self.assertEqual(sorted(matrix.update(kb.matrix_poll()[2:])), [(0, 0, True), (1, 9, True), (2, 3, True)])
+        self.assertTrue(matrix.pressed(1, 9))
+        self.assertFalse(matrix.pressed(1, 8))
+
+        # only switches which changed are reported
+        emulator.release(1, 9)
+        self.assertEqual(matrix.update(kb.matrix_poll()[2:]), [(1, 9, False)])
+        self.assertEqual(matrix.update(kb.matrix_poll()[2:]), [])
+
+        # closed switches are reported again after a reset
+        matrix.reset()
+        self.assertEqual(sorted(matrix.update(kb.matrix_poll()[2:])), [(0, 0, True), (2, 3, True)])
+
+        # padding bits past the last column are ignored
+        self.assertEqual(sorted(matrix.update(b"\xFC\x00" * 3)), [(0, 0, False), (2, 3, False)])
+        with self.assertRaises(ValueError):
+            matrix.update(b"\x00" * 5)
+
+    def test_matrix_recorder(self):
+        recorder = MatrixRecorder(2, 3, positions=[(0, 0), (1, 2)], chatter_ms=30, events_per_key=4,
+                                  clock=lambda: 0.0)
+        # a bouncing press: press, release and press again within 20ms
+        recorder.frame([(0, 0, True)], 0.000)
+        recorder.frame([(0, 0, False)], 0.010)
+        recorder.frame([(0, 0, True)], 0.020)
+        recorder.frame([(0, 0, False)], 0.200)
+        # released without a press since recording started
+        recorder.frame([(1, 2, False)], 0.300)
+        recorder.pause()
+        for x in range(3):
+            recorder.frame([(0, 0, True)], 1 + x)
+            recorder.frame([(0, 0, False)], 1.5 + x)
+
+        stats = recorder.key_stats(0, 0)
+        self.assertEqual((stats["presses"], stats["chatter"]), (5, 1))
+        self.assertEqual((stats["min_hold_ms"], stats["max_hold_ms"]), (10.0, 500.0))
+        self.assertEqual(recorder.key_stats(1, 2)["min_hold_ms"], None)
+        # only the latest transitions are kept
+        self.assertEqual(recorder.events(0, 0), [(2.0, True), (2.5, False), (3.0, True), (3.5, False)])
+        # the pause doesn't count towards the scan rate: 9 intervals over 0.3 + 2.5 seconds
+        self.assertAlmostEqual(recorder.scan_rate(), 9 / 2.8)
+
+        self.assertEqual(recorder.to_csv(), "row,col,presses,chatter,min_hold_ms,max_hold_ms\n"
+                                            "0,0,5,1,10.0,500.0\n"
+                                            "1,2,0,0,,\n")
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "analytics.json")
+            recorder.export(path)
+            with open(path) as inf:
+                data = json.load(inf)
+        self.assertEqual((data["frames"], data["presses"], data["chatter"]), (11, 5, 1))
+        self.assertEqual(data["keys"][0]["events"][0], [2.0, 1])
+
+        recorder.clear()
+        self.assertEqual(recorder.summary()["presses"], 0)
+        self.assertEqual(recorder.events(0, 0), [])
+
+    def test_matrix_state_multiple_reports(self):
+        """ Matrices larger than one report are read from a starting row, through both transports """
+
+        for offset in [False, True]:
+            emulator = VialEmulator(make_definition(12, 24), matrix_state_offset=offset)
+            for kb in [Keyboard(emulator, usb_send=emulator.send), Keyboard(emulator)]:
+                kb.reload()
+                # never turned on by what the firmware reports
+                self.assertFalse(kb.matrix_state_readable())
+                kb.matrix_state_offset = offset
+                self.assertEqual(kb.matrix_state_readable(), offset)
+                if not offset:
+                    continue
+                emulator.press(0, 23)
+                emulator.press(8, 0)
+                emulator.press(9, 1)
+                emulator.press(11, 16)
+                matrix = MatrixState(kb.rows, kb.cols)
+                packets = emulator.packets
+                self.assertEqual(sorted(matrix.update(kb.matrix_state())),
+                                 [(0, 23, True), (8, 0, True), (9, 1, True), (11, 16, True)])
+                # 9 rows of 3 bytes per report
+                self.assertEqual(emulator.packets - packets, 2)
+                emulator.pressed.clear()
+
+        # an answer for another row than requested must not be taken as that row
+        emulator = VialEmulator(make_definition(12, 24), matrix_state_offset=True)
+        kb = Keyboard(emulator, usb_send=emulator.send)
+        kb.reload()
+        kb.matrix_state_offset = True
+        process = emulator.process
+        emulator.process = lambda msg: process(msg[:2] + b"\x00" + msg[3:])
+        with self.assertRaises(ValueError):
+            kb.matrix_state()
+
+        # a small matrix still fits into a single report without a starting row
+        emulator = VialEmulator(make_definition(3, 10))
+        kb = Keyboard(emulator, usb_send=emulator.send)
+        kb.reload()
+        self.assertTrue(kb.matrix_state_readable())
+        emulator.press(2, 9)
+        self.assertEqual(kb.matrix_state(), b"\x00\x00\x00\x00\x02\x00")
+
+    def test_vialrgb(self):
+        emulator = VialEmulator(make_definition(1, 1, lighting="vialrgb"), rgb_supported_effects=range(1, 20))
+        kb = Keyboard(emulator, usb_send=emulator.send)
+        kb.reload()
+        self.assertEqual(kb.rgb_supported_effects, set(range(20)))
+        kb.set_vialrgb_mode(5)
+        kb.set_vialrgb_color(10, 20, 30)
+        kb.reload_rgb()
+        self.assertEqual(kb.rgb_mode, 5)
+        self.assertEqual(kb.rgb_hsv, (10, 20, 30))
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class TestFaultInjection(unittest.TestCase):
+
+    def prepare_device(self, **kwargs):
+        self.clock = FakeClock()
+        self.policy = RetryPolicy(clock=self.clock.time, sleep=self.clock.sleep)
+        self.emulator = VialEmulator(make_definition(2, 2))
+        return FaultInjectingDevice(self.emulator, seed=0, clock=self.clock.time, sleep=self.clock.sleep, **kwargs)
+
+    def test_latency_pipelined(self):
+        """ Pipelined requests wait out their latency concurrently """
+
+        dev = self.prepare_device(latency=0.01)
+        requests = [struct.pack(">BHB", 0x12, x * 28, 28) for x in range(8)]
+        hid_send_batch(dev, requests, echo=4, window=8, policy=self.policy)
+        self.assertAlmostEqual(self.clock.now, 0.01)
+
+        hid_send_batch(dev, requests, echo=4, window=1, policy=self.policy)
+        self.assertAlmostEqual(self.clock.now, 0.09)
+        self.assertEqual(dev.metrics.timeouts, 0)
+
+    def test_latency_timeout(self):
+        """ Response slower than the read timeout arrives as a stale one """
+
+        dev = self.prepare_device(latency=0.6)
+        data = hid_send(dev, b"\x11", retries=2, policy=self.policy)
+        self.assertEqual(data[0:2], b"\x11\x04")
+        self.assertEqual(dev.metrics.retries, 1)
+
+    def test_dropped(self):
+        dev = self.prepare_device(drop_rate=1.0)
+        with self.assertRaises(RuntimeError):
+            hid_send(dev, b"\x11", retries=3, policy=self.policy)
+        self.assertEqual(dev.metrics.dropped, 3)
+        self.assertEqual(dev.metrics.retries, 2)
+        self.assertEqual(dev.metrics.failures, 1)
+        self.assertAlmostEqual(self.clock.now, 1.515)
+
+    def test_short_write(self):
+        dev = self.prepare_device(short_write_rate=1.0)
+        with self.assertRaises(RuntimeError):
+            hid_send(dev, b"\x11", retries=2, policy=self.policy)
+        self.assertEqual(dev.metrics.short_writes, 2)
+        self.assertEqual(self.emulator.packets, 0)
+
+    def test_reload(self):
+        """ Keyboard copes with a lossy link """
+
+        dev = self.prepare_device(latency=0.002, jitter=0.001, drop_rate=0.05)
+        with mock.patch("util.RetryPolicy.instance", self.policy):
+            kb = Keyboard(dev)
+            kb.reload()
+        self.assertEqual(kb.rows, 2)
+        self.assertEqual(kb.layout[(3, 1, 1)], s(0))
+
+
+    def test_lost_request_without_echo(self):
+        """ A lost request whose response doesn't echo it doesn't shift the responses to later ones """
+
+        for command in [CMD_VIAL_GET_ENCODER, CMD_VIAL_GET_DEFINITION]:
+            self.prepare_device()
+            emulator = VialEmulator(make_definition(2, 2, encoders=4), layers=4)
+            for x in range(0, len(emulator.encoders), 2):
+                emulator.encoders[x:x + 2] = struct.pack(">H", 256 + x)
+            expected = Keyboard(emulator, usb_send=emulator.send)
+            expected.reload()
+
+            dropped = []
+            write = emulator.write
+
+            def lossy_write(data):
+                # the 3rd request of the command never reaches the device
+                if data[1] == CMD_VIA_VIAL_PREFIX and data[2] == command:
+                    dropped.append(data)
+                    if len(dropped) == 3:
+                        return len(data)
+                return write(data)
+
+            emulator.write = lossy_write
+            with mock.patch("util.RetryPolicy.instance", self.policy):
+                kb = Keyboard(emulator)
+                kb.reload()
+            self.assertGreater(len(dropped), 3)
+            self.assertEqual(kb.definition, expected.definition)
+            self.assertEqual(kb.encoder_layout, expected.encoder_layout)
+
+
+class TestRetryPolicy(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.policy = RetryPolicy(clock=self.clock.time, sleep=self.clock.sleep)
+        self.emulator = VialEmulator(make_definition(2, 2))
+
+    def prepare_device(self, **kwargs):
+        return FaultInjectingDevice(self.emulator, seed=0, clock=self.clock.time, sleep=self.clock.sleep, **kwargs)
+
+    def test_classify(self):
+        self.assertIs(self.policy.classify(b"\x11"), self.policy.read)
+        self.assertIs(self.policy.classify(b"\x05\x00\x00\x00\x00\x04"), self.policy.write)
+        self.assertIs(self.policy.classify(b"\xFE\x0D\x03\x00"), self.policy.read)
+        self.assertIs(self.policy.classify(b"\xFE\x0D\x04\x00"), self.policy.write)
+        self.assertIs(self.policy.classify(b"\xFE\x0B\x01\x00"), self.policy.slow)
+        self.assertIs(self.policy.classify(b"\x13\x00\x00\x1C"), self.policy.buffer_write)
+        self.assertIs(self.policy.classify(b"\x0F\x00\x00\x1C"), self.policy.buffer_write)
+
+    def test_buffer_write_timeout(self):
+        """ Fast single key writes don't shrink the timeout of buffer writes below what an EEPROM chunk takes """
+
+        dev = self.prepare_device(latency=0.004)
+        for x in range(20):
+            hid_send(dev, b"\x05\x00\x00\x00\x00\x04", policy=self.policy)
+        self.assertEqual(self.policy.write.rto, 0.05)
+        self.assertEqual(self.policy.buffer_write.rto, 1.0)
+
+        dev.latency = 0.095
+        for x in range(20):
+            hid_send(dev, b"\x13\x00\x00\x1C" + b"\x00" * 28, policy=self.policy)
+        self.assertEqual(dev.metrics.retries, 0)
+        self.assertGreater(self.policy.buffer_write.rto, 0.095)
+
+    def test_rtt_estimate(self):
+        """ Timeout follows the round trip time, within limits of the class """
+
+        dev = self.prepare_device(latency=0.004)
+        self.assertEqual(self.policy.read.rto, 0.5)
+        for x in range(20):
+            hid_send(dev, b"\x11", policy=self.policy)
+        self.assertAlmostEqual(self.policy.read.srtt, 0.004)
+        self.assertEqual(self.policy.read.rto, 0.02)
+        # other classes are learned separately
+        self.assertEqual(self.policy.write.rto, 1.0)
+
+    def test_flaky_read_is_cheap(self):
+        """ Once RTT is known, a lost response costs milliseconds """
+
+        dev = self.prepare_device(latency=0.004)
+        for x in range(20):
+            hid_send(dev, b"\x11", policy=self.policy)
+        dev.drop_rate = 1.0
+        dev.rng.seed(0)
+        start = self.clock.now
+        with self.assertRaises(RuntimeError):
+            hid_send(dev, b"\x11", retries=2, policy=self.policy)
+        self.assertLess(self.clock.now - start, 0.1)
+
+    def test_late_response_drained(self):
+        """ Response to a timed out attempt doesn't get mistaken for the reply to the next request """
+
+        dev = self.prepare_device(latency=0.004)
+        for x in range(20):
+            hid_send(dev, b"\x11", policy=self.policy)
+        dev.latency = 0.03
+        self.assertEqual(hid_send(dev, b"\x11", retries=5, policy=self.policy)[0:2], b"\x11\x04")
+        self.assertEqual(dev.metrics.retries, 1)
+        self.assertEqual(hid_send(dev, b"\x01", retries=5, policy=self.policy)[0:3], b"\x01\x00\x09")
+
+    def test_dead_device_fails_fast(self):
+        dev = self.prepare_device(drop_rate=1.0)
+        with self.assertRaises(RuntimeError):
+            hid_send(dev, b"\x11", retries=20, policy=self.policy)
+        self.assertLessEqual(self.clock.now, self.policy.read.budget)
+
+
+class TestPacketTrace(unittest.TestCase):
+
+    def setUp(self):
+        self.trace = PacketTrace()
+        self.trace.enabled = True
+        patcher = mock.patch("protocol.trace.PacketTrace.instance", self.trace)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_command_name(self):
+        self.assertEqual(command_name(b"\x12\x00\x00\x1C"), "CMD_VIA_KEYMAP_GET_BUFFER")
+        self.assertEqual(command_name(b"\x02\x03"), "CMD_VIA_GET_KEYBOARD_VALUE/VIA_SWITCH_MATRIX_STATE")
+        self.assertEqual(command_name(b"\xFE\x0D\x03\x00"), "CMD_VIAL_DYNAMIC_ENTRY_OP/DYNAMIC_VIAL_COMBO_GET")
+        self.assertEqual(command_name(b"\xFE\x7F"), "CMD_VIAL_0x7F")
+
+    def test_reload_phases(self):
+        """ Packets of a reload are attributed to its phases, through both hidapi and custom transports """
+
+        for pipelined in [True, False]:
+            self.trace.clear()
+            emulator = VialEmulator(make_definition(3, 10, encoders=2), combo_count=2)
+            kb = Keyboard(emulator) if pipelined else Keyboard(emulator, usb_send=emulator.send)
+            kb.reload()
+
+            summary = self.trace.summary()
+            self.assertEqual(summary["packets"], emulator.packets)
+            self.assertEqual(summary["phases"]["reload"]["packets"], emulator.packets)
+            self.assertEqual(summary["phases"]["reload_keymap"]["packets"], 4 * 3 * 10 * 2 // 28 + 1 + 4 * 2)
+            self.assertEqual(summary["phases"]["reload_combo"]["packets"], 2)
+            stats = summary["commands"]["CMD_VIA_KEYMAP_GET_BUFFER"]
+            self.assertEqual(stats["count"], 9)
+            self.assertEqual(sum(stats["histogram"].values()), 9)
+
+            records = [r for r in self.trace.records if r["phase"] == "reload_keymap"]
+            self.assertEqual(records[0]["name"], "CMD_VIA_KEYMAP_GET_BUFFER")
+            self.assertEqual(records[0]["size"], 4)
+            self.assertIn("reload_layout", self.trace.dump())
+
+    def test_phases_per_thread(self):
+        """ Packets sent by another thread don't count towards a phase in progress """
+
+        emulator = VialEmulator(make_definition(1, 1))
+        with self.trace.phase("loading"):
+            hid_send(emulator, b"\x11")
+            thread = threading.Thread(target=lambda: hid_send(emulator, b"\x11"))
+            thread.start()
+            thread.join()
+
+        self.assertEqual(self.trace.summary()["phases"]["loading"]["packets"], 1)
+        self.assertEqual([r["phase"] for r in self.trace.records], ["loading", None])
+
+    def test_failure(self):
+        dev = FaultInjectingDevice(VialEmulator(make_definition(1, 1)), drop_rate=1.0, sleep=lambda x: None)
+        policy = RetryPolicy(sleep=lambda x: None)
+        with self.assertRaises(RuntimeError):
+            hid_send(dev, b"\x11", retries=2, policy=policy)
+        stats = self.trace.summary()["commands"]["CMD_VIA_GET_LAYER_COUNT"]
+        self.assertEqual((stats["count"], stats["failures"], stats["retries"]), (1, 1, 1))
+
+        # a command which never got an answer has no latency to show
+        self.trace.record(b"\x11", 1.0, None)
+        self.assertIn("CMD_VIA_GET_LAYER_COUNT", self.trace.dump())
+
+    def test_disabled(self):
+        self.trace.enabled = False
+        emulator = VialEmulator(make_definition(1, 1))
+        Keyboard(emulator).reload()
+        self.assertEqual(self.trace.packets, 0)
+        self.assertEqual(len(self.trace.phases), 0)
+
+
+class ProbedDevice:
+
+    # paths which can't be opened
+    denied = set()
+    opens = []
+
+    def open_path(self, path):
+        ProbedDevice.opens.append(path)
+        if path in self.denied:
+            raise OSError("permission denied")
+
+    def close(self):
+        pass
+
+
+def hid_desc(idx, serial="vial:f64c2b3c"):
+    return {"vendor_id": 0xFEED, "product_id": idx, "serial_number": serial, "usage_page": 0xFF60, "usage": 0x61,
+            "path": "/dev/hidraw{}".format(idx).encode(), "manufacturer_string": "", "product_string": ""}
+
+
+class TestDeviceDetection(unittest.TestCase):
+
+    def setUp(self):
+        RawHidProbes.instance = None
+        ProbedDevice.denied = set()
+        ProbedDevice.opens = []
+
+    def tearDown(self):
+        RawHidProbes.instance = None
+
+    @unittest.skipUnless(sys.platform.startswith("linux"), "devices are only probed by opening them on Linux")
+    def test_probe_cache(self):
+        descs = [hid_desc(0), hid_desc(1), hid_desc(2)]
+        ProbedDevice.denied = {b"/dev/hidraw2"}
+        with mock.patch.object(util.hid, "enumerate", lambda: list(descs)), \
+                mock.patch.object(util.hid, "device", ProbedDevice):
+            def refresh():
+                return [dev.desc["path"] for dev in find_vial_devices({"definitions": {}}, quiet=True)]
+
+            self.assertEqual(refresh(), [b"/dev/hidraw0", b"/dev/hidraw1"])
+            self.assertEqual(len(ProbedDevice.opens), 3)
+
+            # steady state, positive and negative results are remembered
+            self.assertEqual(refresh(), [b"/dev/hidraw0", b"/dev/hidraw1"])
+            self.assertEqual(len(ProbedDevice.opens), 3)
+
+            # a device coming back is probed again, as is another device at a reused path
+            removed = descs.pop(1)
+            self.assertEqual(refresh(), [b"/dev/hidraw0"])
+            descs.append(removed)
+            descs[0] = hid_desc(0, serial="vial:f64c2b3c other")
+            ProbedDevice.opens = []
+            self.assertEqual(sorted(refresh()), [b"/dev/hidraw0", b"/dev/hidraw1"])
+            self.assertEqual(sorted(ProbedDevice.opens), [b"/dev/hidraw0", b"/dev/hidraw1"])
+
+            # so is a node which changed, and everything when refreshing verbosely
+            ProbedDevice.opens = []
+            ProbedDevice.denied = set()
+            RawHidProbes.get().forget("/dev/hidraw2")
+            self.assertEqual(len(refresh()), 3)
+            self.assertEqual(ProbedDevice.opens, [b"/dev/hidraw2"])
+            find_vial_devices({"definitions": {}}, quiet=False)
+            self.assertEqual(len(ProbedDevice.opens), 4)
+
+    def test_update_while_locked(self):
+        """ An update skipped while locked is remembered, so that hotplug backends can catch up once unlocked """
+
+        thread = AutorefreshThread()
+        updates = []
+        thread.devices_updated.connect(lambda devices, changed: updates.append(devices))
+        devices = [mock.Mock(desc=hid_desc(0))]
+        with mock.patch("autorefresh.autorefresh_thread.find_vial_devices", lambda *args, **kwargs: devices):
+            thread.lock()
+            thread.update()
+            self.assertTrue(thread.dirty)
+            self.assertEqual(updates, [])
+
+            thread.unlock()
+            self.assertTrue(thread.dirty)
+            thread.update()
+            self.assertFalse(thread.dirty)
+        self.assertEqual(len(updates), 1)
+
+    def test_cancel_loading(self):
+        """ A cancelled loader stops before the next part and closes the device itself """
+
+        parts = []
+
+        def open_device(override_json, progress, keycodes):
+            for part in ["layout", "layers", "keycodes", "keymap"]:
+                parts.append(part)
+                if part == "keycodes":
+                    keycodes(device)
+                progress(part, len(parts), 4)
+
+        device = mock.Mock()
+        device.open.side_effect = open_device
+        loader = DeviceLoader(device, None, threading.Lock())
+        results = []
+        loader.progress.connect(lambda device, part, done, total: self.assertTrue(loader.cancel()))
+        loader.loaded.connect(lambda device, error: results.append(error))
+        loader.run()
+        self.assertEqual(parts, ["layout", "layers"])
+        self.assertIsInstance(results[0], LoadCancelled)
+        device.close.assert_called_once_with()
+
+        # once loading finished, the device is the caller's to close
+        self.assertFalse(loader.cancel())
+        device = mock.Mock()
+        loader = DeviceLoader(device, None, threading.Lock())
+        loader.run()
+        self.assertFalse(loader.cancel())
+        device.close.assert_not_called()
+
+        # keycodes are regenerated by whoever receives the signal, loading goes on once it's done
+        device = mock.Mock()
+        device.open.side_effect = open_device
+        parts = []
+        loader = DeviceLoader(device, None, threading.Lock())
+        regenerated = []
+        loader.keycodes.connect(lambda keyboard: (regenerated.append(list(parts)), loader.keycodes_done()))
+        loader.run()
+        self.assertEqual(regenerated, [["layout", "layers", "keycodes"]])
+        self.assertEqual(parts, ["layout", "layers", "keycodes", "keymap"])
+
+    def test_parse_uevent(self):
+        kernel = b"add@/devices/pci0000:00/usb1/1-1/1-1:1.1/0003:FEED:0000.0001/hidraw/hidraw3\x00ACTION=add\x00" \
+                 b"SUBSYSTEM=hidraw\x00DEVNAME=hidraw3\x00SEQNUM=4242\x00"
+        self.assertEqual(parse_uevent(kernel)["DEVNAME"], "hidraw3")
+        self.assertEqual(parse_uevent(kernel)["SUBSYSTEM"], "hidraw")
+
+        properties = b"ACTION=remove\x00SUBSYSTEM=hidraw\x00DEVNAME=/dev/hidraw3\x00"
+        udev = b"libudev\x00" + struct.pack(">I", 0xFEEDCAFE) + struct.pack("=III", 40, 40, len(properties)) + \
+            b"\x00" * 16 + properties
+        self.assertEqual(parse_uevent(udev), {"ACTION": "remove", "SUBSYSTEM": "hidraw", "DEVNAME": "/dev/hidraw3"})
+
+        self.assertIsNone(parse_uevent(b"libudev\x00"))
+        self.assertIsNone(parse_uevent(b"not an event\x00"))
@@ -1,4 +1,5 @@
 import unittest
+from unittest import mock
 
 from keycodes.keycodes import Keycode, recreate_keyboard_keycodes
 
@@ -21,6 +22,26 @@ class FakeKeyboard:
             self.supported_features = set()
 
 
+class FakeKeyWidget:
+
+    masked = False
+
+    def setText(self, text):
+        self.text = text
+
+    def setMaskText(self, text):
+        self.mask_text = text
+
+    def setToolTip(self, tooltip):
+        self.tooltip = tooltip
+
+    def setColor(self, color):
+        self.color = color
+
+    def setMaskColor(self, color):
+        self.mask_color = color
+
+
 class TestKeycode(unittest.TestCase):
 
     def _test_serialize_protocol(self, protocol):
@@ -41,3 +62,111 @@ class TestKeycode(unittest.TestCase):
 
     def test_serialize_v6(self):
         self._test_serialize_protocol(6)
+
+    def test_caches_follow_keycodes(self):
+        """ Memoized conversions and the AnyKeycode name table are dropped when keycodes are regenerated """
+
+        from any_keycode import AnyKeycode
+
+        recreate_keyboard_keycodes(FakeKeyboard(5))
+        v5 = Keycode.deserialize("QK_BOOT")
+        anykc = AnyKeycode.get()
+        self.assertIs(AnyKeycode.get(), anykc)
+        self.assertEqual(Keycode.deserialize("LT(1, KC_A)"), Keycode.deserialize("LT(1, KC_A)"))
+
+        recreate_keyboard_keycodes(FakeKeyboard(6))
+        self.assertNotEqual(Keycode.deserialize("QK_BOOT"), v5)
+        self.assertEqual(Keycode.serialize(Keycode.deserialize("QK_BOOT")), "QK_BOOT")
+        self.assertIsNot(AnyKeycode.get(), anykc)
+
+        # custom keycode names only resolve while the keyboard defining them is loaded
+        keyboard = FakeKeyboard(6)
+        keyboard.custom_keycodes = [{"name": "CUSTOM_KEY"}]
+        recreate_keyboard_keycodes(keyboard)
+        self.assertEqual(Keycode.deserialize("CUSTOM_KEY"), Keycode.deserialize("USER00"))
+        recreate_keyboard_keycodes(FakeKeyboard(6))
+        self.assertEqual(Keycode.deserialize("CUSTOM_KEY"), 0)
+
+        with self.assertRaises(Exception):
+            Keycode.deserialize("LT(", reraise=True)
+
+    def test_any_keycode_evaluator(self):
+        """ The keycode expression evaluator agrees with simpleeval, and defers to it for anything else """
+
+        import simpleeval
+        from any_keycode import AnyKeycode, functions
+
+        recreate_keyboard_keycodes(FakeKeyboard(6))
+        anykc = AnyKeycode.get()
+        for expr in ["KC_A", "LSFT(KC_A)", "LT1(KC_ESC)", "LSFT_T(KC_ESC)", "MO(3)", "TD(0x1F)", "LT(2, KC_B)",
+                     " LCTL( LSFT(KC_ENTER) ) ", "KC_A | 0x200", "0x7000 | 3 & ~1 ^ 0b10", "(1 << 8) + 2 * 3 - 1",
+                     "LM(1, MOD_LSFT | MOD_LCTL)", "-1 + 0o17 // 2 % 5", "MT(MOD_MEH, KC_SPC)"]:
+            self.assertEqual(anykc.decode(expr),
+                             simpleeval.simple_eval(expr, names=anykc.names, functions=functions, operators=anykc.ops),
+                             expr)
+
+        self.assertEqual(anykc.decode("1 / 2"), 0.5)
+        self.assertEqual(anykc.decode("3 if 1 > 2 else 4"), 4)
+        for expr in ["LT(", "KC_DOES_NOT_EXIST", "LSFT(KC_A", "01", "LSFT(KC_A, KC_B)"]:
+            with self.assertRaises(Exception):
+                anykc.decode(expr)
+
+    def test_keycode_tables(self):
+        """ Fixed keycodes are looked up once per protocol, keyboard keycodes are added on every recreate """
+
+        from keycodes.keycodes import KeycodeTable, KEYCODES, KEYCODES_MAP, RAWCODES_MAP
+
+        for protocol in [5, 6, 5]:
+            recreate_keyboard_keycodes(FakeKeyboard(protocol))
+            table = KeycodeTable.get(protocol)
+            recreate_keyboard_keycodes(FakeKeyboard(protocol))
+            self.assertIs(KeycodeTable.get(protocol), table)
+
+            expected_names, expected_codes = dict(), dict()
+            for kc in KEYCODES:
+                expected_names[kc.qmk_id.replace("(kc)", "")] = kc
+                expected_codes[Keycode.resolve(kc.qmk_id)] = kc
+            self.assertEqual(KEYCODES_MAP, expected_names)
+            self.assertEqual(RAWCODES_MAP, expected_codes)
+            self.assertEqual(Keycode.serialize(Keycode.deserialize("M3")), "M3")
+            self.assertEqual(Keycode.serialize(Keycode.deserialize("LT2(KC_A)")), "LT2(KC_A)")
+
+    def test_display_records(self):
+        """ Display records are reused until keycodes, the keymap override or the theme change """
+
+        from util import KeycodeDisplay
+
+        recreate_keyboard_keycodes(FakeKeyboard(6))
+        original = KeycodeDisplay.keymap_override
+        try:
+            widget = FakeKeyWidget()
+            KeycodeDisplay.display_keycode(widget, "LSFT_T(KC_A)")
+            self.assertTrue(widget.masked)
+            self.assertEqual(widget.mask_text, "A")
+            self.assertIsNone(widget.mask_color)
+            self.assertIs(KeycodeDisplay.display_record("LSFT_T(KC_A)"), KeycodeDisplay.display_record("LSFT_T(KC_A)"))
+
+            # leave out clients, set_keymap_override would relabel widgets of other tests
+            with mock.patch.object(KeycodeDisplay, "clients", []):
+                KeycodeDisplay.set_keymap_override({"KC_A": "Q"})
+            KeycodeDisplay.display_keycode(widget, "LSFT_T(KC_A)")
+            self.assertEqual(widget.mask_text, "Q")
+            self.assertIsNotNone(widget.mask_color)
+
+            # records are rebuilt whenever keycodes are regenerated
+            record = KeycodeDisplay.display_record("M3")
+            recreate_keyboard_keycodes(FakeKeyboard(6))
+            self.assertIsNot(KeycodeDisplay.display_record("M3"), record)
+        finally:
+            with mock.patch.object(KeycodeDisplay, "clients", []):
+                KeycodeDisplay.set_keymap_override(original)
+
+    def test_keymaps(self):
+        """ Every keymap override loads and only uses known keycodes """
+
+        from keymaps import KEYMAPS, load_keymap
+
+        recreate_keyboard_keycodes(FakeKeyboard(6))
+        self.assertEqual(load_keymap(0), dict())
+        for index, (name, location) in enumerate(KEYMAPS[1:], 1):
+            self.assertTrue(load_keymap(index), name)
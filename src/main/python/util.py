@@ -3,7 +3,9 @@ import logging
 import os
 import pathlib
 import sys
+import threading
 import time
+from collections import deque
 from logging.handlers import RotatingFileHandler
 
 from PyQt5.QtCore import QCoreApplication, QStandardPaths
@@ -12,7 +14,9 @@ from PyQt5.QtWidgets import QApplication, QWidget, QScrollArea, QFrame
 
 from hidproxy import hid
 from keycodes.keycodes import Keycode
-from keymaps import KEYMAPS
+from protocol.retry_policy import RetryPolicy
+from protocol.trace import PacketTrace
+from themes import Theme
 
 tr = QCoreApplication.translate
 
@@ -24,6 +28,13 @@ VIBL_SERIAL_NUMBER_MAGIC = "vibl:d4f8159c"
 
 MSG_LEN = 32
 
+# how many keycodes KeycodeDisplay keeps display records for
+DISPLAY_CACHE_SIZE = 4096
+
+# how many requests hid_send_batch keeps in flight before waiting for a response
+# webhid bridge is strictly request-response so don't pipeline there
+HID_PIPELINE_WINDOW = 1 if sys.platform == "emscripten" else 8
+
 # these should match what we have in vial-qmk/keyboards/vial_example
 # so that people don't accidentally reuse a sample keyboard UID
 EXAMPLE_KEYBOARDS = [
@@ -37,36 +48,162 @@ EXAMPLE_KEYBOARDS = [
 EXAMPLE_KEYBOARD_PREFIX = 0xA6867BDFD3B00F
 
 
-def hid_send(dev, msg, retries=1):
+def hid_send(dev, msg, retries=1, policy=None):
     if len(msg) > MSG_LEN:
         raise RuntimeError("message must be less than 32 bytes")
     msg += b"\x00" * (MSG_LEN - len(msg))
 
-    data = b""
-    first = True
+    if policy is None:
+        policy = RetryPolicy.get()
+    timeout_class = policy.classify(msg)
+    # devices wrapped for fault injection collect transport metrics
+    metrics = getattr(dev, "metrics", None)
+    trace = PacketTrace.active()
+    if trace is not None:
+        trace_sent = trace.clock()
 
-    while retries > 0:
-        retries -= 1
-        if not first:
-            time.sleep(0.5)
-        first = False
+    data = b""
+    attempts = 0
+    start = policy.clock()
+    # attempts which were written but timed out, their responses may still show up
+    outstanding = 0
+
+    for attempt in range(retries):
+        if attempt > 0:
+            backoff = policy.backoff(attempt)
+            if policy.clock() - start + backoff + timeout_class.rto > timeout_class.budget:
+                break
+            policy.sleep(backoff)
+            if metrics is not None:
+                metrics.retries += 1
+                metrics.backoff_time += backoff
+        attempts += 1
         try:
+            sent = policy.clock()
             # add 00 at start for hidapi report id
             if dev.write(b"\x00" + msg) != MSG_LEN + 1:
                 continue
 
-            data = bytes(dev.read(MSG_LEN, timeout_ms=500))
+            data = bytes(dev.read(MSG_LEN, timeout_ms=policy.timeout_ms(timeout_class)))
             if not data:
+                outstanding += 1
+                timeout_class.on_timeout()
                 continue
         except OSError:
             continue
+        # a response after a retry could belong to either attempt, so it says nothing about round trip time
+        if attempt == 0:
+            timeout_class.observe(policy.clock() - sent)
         break
 
+    if trace is not None:
+        trace.record(msg, trace_sent, trace.clock() if data else None, max(0, attempts - 1))
+
     if not data:
+        if metrics is not None:
+            metrics.failures += 1
         raise RuntimeError("failed to communicate with the device")
+
+    # don't let a late response to an earlier attempt be taken as the reply to the next request
+    for x in range(outstanding):
+        try:
+            if not dev.read(MSG_LEN, timeout_ms=policy.timeout_ms(timeout_class)):
+                break
+        except OSError:
+            break
+
     return data
 
 
+def hid_send_batch(dev, msgs, retries=1, echo=0, window=HID_PIPELINE_WINDOW, policy=None, fifo=False):
+    """
+    Sends a list of messages keeping up to `window` of them in flight, returns responses in the order of `msgs`.
+
+    If `echo` is set, the device is expected to echo the first `echo` bytes of a request in its response
+    (e.g. command, offset and size for buffer reads); responses are matched to requests by that header
+    and stale responses are discarded.
+
+    Responses without such a header can only be matched in FIFO order, where a single lost request shifts every
+    later response into the wrong slot without an error. They are only pipelined if `fifo` is set, by callers
+    which verify what they got; otherwise they are sent in lockstep through hid_send.
+
+    Anything which did not get a response while pipelining is retried one by one through hid_send.
+    """
+    for msg in msgs:
+        if len(msg) > MSG_LEN:
+            raise RuntimeError("message must be less than 32 bytes")
+    msgs = [msg + b"\x00" * (MSG_LEN - len(msg)) for msg in msgs]
+    if not msgs:
+        return []
+    if not echo and not fifo:
+        return [hid_send(dev, msg, retries=retries, policy=policy) for msg in msgs]
+
+    if policy is None:
+        policy = RetryPolicy.get()
+    # responses to pipelined requests come one round trip apart at most
+    timeout_class = policy.classify(msgs[0])
+
+    responses = [None] * len(msgs)
+    inflight = deque()
+    pos = 0
+    trace = PacketTrace.active()
+    if trace is not None:
+        sent = [None] * len(msgs)
+        received = [None] * len(msgs)
+
+    try:
+        while pos < len(msgs) or inflight:
+            while pos < len(msgs) and len(inflight) < window:
+                # add 00 at start for hidapi report id
+                if trace is not None:
+                    sent[pos] = trace.clock()
+                if dev.write(b"\x00" + msgs[pos]) != MSG_LEN + 1:
+                    raise OSError("short write")
+                inflight.append(pos)
+                pos += 1
+
+            data = bytes(dev.read(MSG_LEN, timeout_ms=policy.timeout_ms(timeout_class)))
+            if not data:
+                break
+
+            idx = None
+            if echo:
+                for x in inflight:
+                    if data[:echo] == msgs[x][:echo]:
+                        idx = x
+                        inflight.remove(idx)
+                        break
+            else:
+                idx = inflight.popleft()
+
+            if idx is not None:
+                responses[idx] = data
+                if trace is not None:
+                    received[idx] = trace.clock()
+    except OSError:
+        pass
+
+    if inflight:
+        # drop late responses to requests we gave up on, so they aren't taken as replies in lockstep mode
+        for x in range(window):
+            try:
+                if not dev.read(MSG_LEN, timeout_ms=policy.timeout_ms(timeout_class)):
+                    break
+            except OSError:
+                break
+
+    if trace is not None:
+        for idx, data in enumerate(responses):
+            if data is not None:
+                trace.record(msgs[idx], sent[idx], received[idx])
+
+    for idx, data in enumerate(responses):
+        if data is None:
+            responses[idx] = hid_send(dev, msgs[idx], retries=retries, policy=policy)
+
+    return responses
+
+
 def is_rawhid(desc, quiet):
     if desc["usage_page"] != 0xFF60 or desc["usage"] != 0x61:
         if not quiet:
@@ -93,24 +230,83 @@ def is_rawhid(desc, quiet):
     return True
 
 
+class RawHidProbes:
+
+    """
+    Results of is_rawhid by device, kept for as long as the device keeps being enumerated, so that refreshing the
+    device list doesn't open every keyboard again (on Linux), including the one currently in use.
+
+    Devices are told apart by path, IDs, serial number and usage, so a different device showing up under a reused
+    path is probed anew. Verbose (not quiet) lookups, e.g. a manual refresh, always probe.
+    """
+
+    instance = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.results = dict()
+
+    @classmethod
+    def get(cls):
+        if cls.instance is None:
+            cls.instance = RawHidProbes()
+        return cls.instance
+
+    @staticmethod
+    def key(desc):
+        return (desc["path"], desc["vendor_id"], desc["product_id"], desc["serial_number"],
+                desc["usage_page"], desc["usage"])
+
+    def is_rawhid(self, desc, quiet):
+        key = self.key(desc)
+        with self.lock:
+            if quiet and key in self.results:
+                return self.results[key]
+        result = is_rawhid(desc, quiet)
+        with self.lock:
+            self.results[key] = result
+        return result
+
+    def retain(self, descs):
+        """ Forgets devices which are not in descs, i.e. are no longer enumerated """
+
+        keys = set(self.key(desc) for desc in descs)
+        with self.lock:
+            for key in list(self.results):
+                if key not in keys:
+                    del self.results[key]
+
+    def forget(self, path):
+        """ Forgets whatever was probed at path, e.g. once its device node was removed or added """
+
+        # hidapi reports paths as bytes
+        path = os.fsdecode(path)
+        with self.lock:
+            for key in list(self.results):
+                if os.fsdecode(key[0]) == path:
+                    del self.results[key]
+
+
 def find_vial_devices(via_stack_json, sideload_vid=None, sideload_pid=None, quiet=False):
     from vial_device import VialBootloader, VialKeyboard, VialDummyKeyboard
 
+    probes = RawHidProbes.get()
+    descs = hid.enumerate()
     filtered = []
-    for dev in hid.enumerate():
+    for dev in descs:
         if dev["vendor_id"] == sideload_vid and dev["product_id"] == sideload_pid:
             if not quiet:
                 logging.info("Trying VID={:04X}, PID={:04X}, serial={}, path={} - sideload".format(
                     dev["vendor_id"], dev["product_id"], dev["serial_number"], dev["path"]
                 ))
-            if is_rawhid(dev, quiet):
+            if probes.is_rawhid(dev, quiet):
                 filtered.append(VialKeyboard(dev, sideload=True))
         elif VIAL_SERIAL_NUMBER_MAGIC in dev["serial_number"]:
             if not quiet:
                 logging.info("Matching VID={:04X}, PID={:04X}, serial={}, path={} - vial serial magic".format(
                     dev["vendor_id"], dev["product_id"], dev["serial_number"], dev["path"]
                 ))
-            if is_rawhid(dev, quiet):
+            if probes.is_rawhid(dev, quiet):
                 filtered.append(VialKeyboard(dev))
         elif VIBL_SERIAL_NUMBER_MAGIC in dev["serial_number"]:
             if not quiet:
@@ -123,9 +319,11 @@ def find_vial_devices(via_stack_json, sideload_vid=None, sideload_pid=None, quie
                 logging.info("Matching VID={:04X}, PID={:04X}, serial={}, path={} - VIA stack".format(
                     dev["vendor_id"], dev["product_id"], dev["serial_number"], dev["path"]
                 ))
-            if is_rawhid(dev, quiet):
+            if probes.is_rawhid(dev, quiet):
                 filtered.append(VialKeyboard(dev, via_stack=True))
 
+    probes.retain(descs)
+
     if sideload_vid == sideload_pid == 0:
         filtered.append(VialDummyKeyboard())
 
@@ -167,11 +365,30 @@ def make_scrollable(layout):
     return scroll
 
 
+class KeycodeDisplayRecord:
+
+    """ Everything a key widget shows for a keycode """
+
+    def __init__(self, text, mask_text, tooltip, masked, color, mask_color):
+        self.text = text
+        self.mask_text = mask_text
+        self.tooltip = tooltip
+        self.masked = masked
+        self.color = color
+        self.mask_color = mask_color
+
+
 class KeycodeDisplay:
 
-    keymap_override = KEYMAPS[0][1]
+    keymap_override = dict()
+    # bumped by set_keymap_override, so that display records know the override changed
+    keymap_override_generation = 0
     clients = []
 
+    # display records by qmk_id, valid for records_state, see display_record
+    records = dict()
+    records_state = None
+
     @classmethod
     def get_label(cls, code):
         """ Get label for a specific keycode """
@@ -186,7 +403,7 @@ class KeycodeDisplay:
         return key is not None and key.qmk_id in cls.keymap_override
 
     @classmethod
-    def display_keycode(cls, widget, code):
+    def make_record(cls, code):
         text = cls.get_label(code)
         tooltip = Keycode.tooltip(code)
         mask = Keycode.is_mask(code)
@@ -196,22 +413,46 @@ class KeycodeDisplay:
             mask_text = cls.get_label(inner.qmk_id)
         if mask:
             text = text.split("\n")[0]
-        widget.masked = mask
-        widget.setText(text)
-        widget.setMaskText(mask_text)
-        widget.setToolTip(tooltip)
+        color = mask_color = None
         if cls.code_is_overriden(code):
-            widget.setColor(QApplication.palette().color(QPalette.Link))
-        else:
-            widget.setColor(None)
+            color = QApplication.palette().color(QPalette.Link)
         if inner and mask and cls.code_is_overriden(inner.qmk_id):
-            widget.setMaskColor(QApplication.palette().color(QPalette.Link))
-        else:
-            widget.setMaskColor(None)
+            mask_color = QApplication.palette().color(QPalette.Link)
+        return KeycodeDisplayRecord(text, mask_text, tooltip, mask, color, mask_color)
+
+    @classmethod
+    def display_record(cls, code):
+        """ Cached KeycodeDisplayRecord for a qmk_id, for the current keycodes, keymap override and theme """
+
+        state = (Keycode.generation, cls.keymap_override_generation, Theme.get_theme())
+        if state != cls.records_state or len(cls.records) >= DISPLAY_CACHE_SIZE:
+            cls.invalidate_records()
+            cls.records_state = state
+        record = cls.records.get(code)
+        if record is None:
+            record = cls.records[code] = cls.make_record(code)
+        return record
+
+    @classmethod
+    def invalidate_records(cls):
+        cls.records = dict()
+        cls.records_state = None
+
+    @classmethod
+    def display_keycode(cls, widget, code):
+        record = cls.display_record(code)
+        widget.masked = record.masked
+        widget.setText(record.text)
+        widget.setMaskText(record.mask_text)
+        widget.setToolTip(record.tooltip)
+        widget.setColor(record.color)
+        widget.setMaskColor(record.mask_color)
 
     @classmethod
     def set_keymap_override(cls, override):
         cls.keymap_override = override
+        cls.keymap_override_generation += 1
+        cls.invalidate_records()
         for client in cls.clients:
             client.on_keymap_override()
 
@@ -2,7 +2,9 @@
 import time
 
 from hidproxy import hid
+from protocol.definition_cache import DefinitionCache
 from protocol.keyboard_comm import Keyboard
+from protocol.retry_policy import RetryPolicy
 from protocol.dummy_keyboard import DummyKeyboard
 from util import MSG_LEN, pad_for_vibl
 
@@ -15,7 +17,7 @@ class VialDevice:
         self.sideload = False
         self.via_stack = False
 
-    def open(self, override_json=None):
+    def open(self, override_json=None, progress=None, keycodes=None):
         self.dev = hid.device()
         for x in range(10):
             try:
@@ -45,10 +47,12 @@ class VialKeyboard(VialDevice):
         self.via_stack = via_stack
         self.keyboard = None
 
-    def open(self, override_json=None):
+    def open(self, override_json=None, progress=None, keycodes=None):
         super().open(override_json)
-        self.keyboard = Keyboard(self.dev)
-        self.keyboard.reload(override_json)
+        # round trip times learned from a previously opened keyboard don't apply to this one
+        RetryPolicy.get().reset()
+        self.keyboard = Keyboard(self.dev, definition_cache=DefinitionCache.get())
+        self.keyboard.reload(override_json, progress=progress, keycodes=keycodes)
 
     def title(self):
         s = "{} {}".format(self.desc["manufacturer_string"], self.desc["product_string"]).strip()
@@ -91,9 +95,9 @@ class VialDummyKeyboard(VialKeyboard):
         self.sideload = True
         self.desc = {"path": "/dummy/keyboard"}
 
-    def open(self, override_json=None):
+    def open(self, override_json=None, progress=None, keycodes=None):
         self.keyboard = DummyKeyboard(None, usb_send=self.raise_usb_send)
-        self.keyboard.reload(override_json)
+        self.keyboard.reload(override_json, progress=progress, keycodes=keycodes)
 
     def title(self):
         return "[Dummy Keyboard]"
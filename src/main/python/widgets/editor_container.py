@@ -2,17 +2,62 @@ from PyQt5.QtWidgets import QWidget
 from PyQt5.QtCore import pyqtSignal
 
 
+class LazyEditor:
+
+    """
+    Stands in for an editor until its tab is first opened, only then the editor is constructed
+    and rebuilt for the device it has missed.
+    """
+
+    def __init__(self, cls, *args):
+        self.cls = cls
+        self.args = args
+        self.instance = None
+        self.device = None
+
+    @classmethod
+    def constructed(cls, editor):
+        slot = cls(type(editor))
+        slot.instance = editor
+        return slot
+
+    def get(self):
+        if self.instance is None:
+            self.instance = self.cls(*self.args)
+            self.instance.rebuild(self.device)
+        return self.instance
+
+    def valid(self):
+        return self.cls.valid_for(self.device)
+
+    def rebuild(self, device):
+        self.device = device
+        if self.instance is not None:
+            self.instance.rebuild(device)
+
+
 class EditorContainer(QWidget):
 
     clicked = pyqtSignal()
 
-    def __init__(self, editor):
+    def __init__(self, slot):
         super().__init__()
 
-        self.editor = editor
+        self.slot = slot
+        self.attached = None
+        if slot.instance is not None:
+            self.attach()
+
+    def attach(self):
+        self.attached = self.slot.get()
+        self.setLayout(self.attached)
+        self.clicked.connect(self.attached.on_container_clicked)
 
-        self.setLayout(editor)
-        self.clicked.connect(editor.on_container_clicked)
+    @property
+    def editor(self):
+        if self.attached is None:
+            self.attach()
+        return self.attached
 
     def mousePressEvent(self, ev):
         self.clicked.emit()
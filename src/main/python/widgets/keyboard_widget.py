@@ -1,6 +1,8 @@
+import math
 from collections import defaultdict
 
-from PyQt5.QtGui import QPainter, QColor, QPainterPath, QTransform, QBrush, QPolygonF, QPalette
+from PyQt5.QtGui import QPainter, QColor, QPainterPath, QTransform, QBrush, QPolygonF, QPalette, QPen, QFont, \
+    QPixmap
 from PyQt5.QtWidgets import QWidget, QToolTip, QApplication
 from PyQt5.QtCore import Qt, QSize, QRect, QPointF, pyqtSignal, QEvent, QRectF
 
@@ -9,6 +11,12 @@ from constants import KEY_SIZE_RATIO, KEY_SPACING_RATIO, KEYBOARD_WIDGET_PADDING
     KEYBOARD_WIDGET_NONMASK_PADDING
 from themes import Theme
 
+# how many renderings of a key to keep, enough for a key being pressed and released in the matrix tester
+KEY_PIXMAP_CACHE_SIZE = 4
+
+# extra space around a key's shape in its cached pixmap and repaint rect, covers the active outline and antialiasing
+KEY_PAINT_MARGIN = 2
+
 
 class KeyWidget:
 
@@ -24,6 +32,8 @@ class KeyWidget:
         self.color = None
         self.mask_color = None
         self.scale = 0
+        # rendered appearances of the key, by what they were rendered from, see KeyboardWidget.draw_cached
+        self.pixmaps = dict()
 
         self.rotation_angle = desc.rotation_angle
 
@@ -72,6 +82,7 @@ class KeyWidget:
                 round(self.h2)
             )
 
+            self.transform = self.calculate_transform()
             self.bbox = self.calculate_bbox(self.rect)
             self.bbox2 = self.calculate_bbox(self.rect2)
             self.polygon = QPolygonF(self.bbox + [self.bbox[0]])
@@ -100,22 +111,28 @@ class KeyWidget:
             self.mask_bbox = self.calculate_bbox(self.mask_rect)
             self.mask_polygon = QPolygonF(self.mask_bbox + [self.mask_bbox[0]])
 
+            # area which is painted, in key coordinates (before shift and rotation) and in widget coordinates
+            self.local_rect = self.background_draw_path.boundingRect().united(
+                self.extra_draw_path.boundingRect()).adjusted(-KEY_PAINT_MARGIN, -KEY_PAINT_MARGIN,
+                                                              KEY_PAINT_MARGIN, KEY_PAINT_MARGIN)
+            self.paint_rect = self.transform.mapRect(self.local_rect)
+            self.pixmaps = dict()
+
+    def calculate_transform(self):
+        t = QTransform()
+        t.translate(self.shift_x, self.shift_y)
+        t.translate(self.rotation_x, self.rotation_y)
+        t.rotate(self.rotation_angle)
+        t.translate(-self.rotation_x, -self.rotation_y)
+        return t
+
     def calculate_bbox(self, rect):
         x1 = rect.topLeft().x()
         y1 = rect.topLeft().y()
         x2 = rect.bottomRight().x()
         y2 = rect.bottomRight().y()
         points = [(x1, y1), (x1, y2), (x2, y2), (x2, y1)]
-        bbox = []
-        for p in points:
-            t = QTransform()
-            t.translate(self.shift_x, self.shift_y)
-            t.translate(self.rotation_x, self.rotation_y)
-            t.rotate(self.rotation_angle)
-            t.translate(-self.rotation_x, -self.rotation_y)
-            p = t.map(QPointF(p[0], p[1]))
-            bbox.append(p)
-        return bbox
+        return [self.transform.map(QPointF(p[0], p[1])) for p in points]
 
     def calculate_background_draw_path(self):
         path = QPainterPath()
@@ -248,8 +265,81 @@ class EncoderWidget(KeyWidget):
         return "EncoderWidget"
 
 
+class PaintStyle:
+
+    """ Pens, brushes and fonts KeyboardWidget paints with, derived from the palette, theme and font """
+
+    def __init__(self, font):
+        palette = QApplication.palette()
+        self.key = self.cache_key(font)
+
+        button = palette.color(QPalette.Button)
+        highlight = palette.color(QPalette.Highlight)
+        text = palette.color(QPalette.ButtonText)
+
+        # for regular keycaps
+        self.regular_pen = QPen(text)
+        self.background_brush = QBrush(button)
+        self.foreground_brush = QBrush(button.lighter(120))
+        self.mask_brush = QBrush(button.lighter(Theme.mask_light_factor()))
+
+        # for currently selected keycap
+        self.active_pen = QPen(highlight)
+        self.active_pen.setWidthF(1.5)
+
+        # for the encoder arrow
+        self.extra_pen = self.regular_pen
+        self.extra_brush = QBrush(text)
+
+        # for pressed keycaps
+        self.background_pressed_brush = QBrush(highlight)
+        self.foreground_pressed_brush = QBrush(highlight.lighter(120))
+        self.background_on_brush = QBrush(highlight.darker(150))
+        self.foreground_on_brush = QBrush(highlight.darker(120))
+
+        self.font = QFont(font)
+        self.mask_font = QFont(font)
+        self.mask_font.setPointSize(round(self.mask_font.pointSize() * 0.8))
+
+    @staticmethod
+    def cache_key(font):
+        return QApplication.palette().cacheKey(), Theme.mask_light_factor(), font.key()
+
+
+def color_key(color):
+    return None if color is None else QColor(color).rgba()
+
+
+class KeyGrid:
+
+    """
+    Uniform grid over bounding boxes of keys, in unscaled widget coordinates. Each cell lists the keys
+    overlapping it in their original order, so a hit test only checks the few keys near a point.
+    """
+
+    def __init__(self, keys, cell_size):
+        self.cell_size = max(cell_size, 1)
+        self.cells = defaultdict(list)
+        for key in keys:
+            rect = key.polygon.boundingRect().united(key.mask_polygon.boundingRect())
+            for cx in range(self.cell(rect.left()), self.cell(rect.right()) + 1):
+                for cy in range(self.cell(rect.top()), self.cell(rect.bottom()) + 1):
+                    self.cells[(cx, cy)].append(key)
+
+    def cell(self, coord):
+        return math.floor(coord / self.cell_size)
+
+    def candidates(self, pos):
+        """ Keys which might contain pos """
+        return self.cells.get((self.cell(pos.x()), self.cell(pos.y())), [])
+
+
 class KeyboardWidget(QWidget):
 
+    # keys are rendered into pixmaps which are reused until their appearance changes;
+    # rotated keys are always painted directly
+    cache_pixmaps = True
+
     clicked = pyqtSignal()
     deselected = pyqtSignal()
     anykey = pyqtSignal()
@@ -278,6 +368,9 @@ class KeyboardWidget(QWidget):
         self.active_key = None
         self.active_mask = False
 
+        self.paint_style = None
+        self.key_grid = KeyGrid([], 1)
+
     def set_keys(self, keys, encoders):
         self.common_widgets = []
         self.widgets_for_layout = []
@@ -345,6 +438,9 @@ class KeyboardWidget(QWidget):
         self.widgets = list(filter(lambda w: not w.desc.decal, self.widgets))
 
         self.widgets.sort(key=lambda w: (w.y, w.x))
+        # cells the size of a 1u key including spacing, as placed by place_widgets
+        scale_factor = self.fontMetrics().height()
+        self.key_grid = KeyGrid(self.widgets, scale_factor * (KEY_SIZE_RATIO + KEY_SPACING_RATIO))
 
         # determine maximum width and height of container
         max_w = max_h = 0
@@ -359,118 +455,127 @@ class KeyboardWidget(QWidget):
         self.update()
         self.updateGeometry()
 
+    def get_paint_style(self, font):
+        if self.paint_style is None or self.paint_style.key != PaintStyle.cache_key(font):
+            self.paint_style = PaintStyle(font)
+        return self.paint_style
+
+    def key_rect(self, key):
+        """ Area of the widget a key paints to """
+        return QTransform.fromScale(self.scale, self.scale).mapRect(key.paint_rect).toAlignedRect()
+
+    def update_key(self, key):
+        """ Schedules a repaint of a single key, e.g. after its state or text changed """
+        if key is not None:
+            self.update(self.key_rect(key))
+
     def paintEvent(self, event):
         qp = QPainter()
         qp.begin(self)
         qp.setRenderHint(QPainter.Antialiasing)
 
-        # for regular keycaps
-        regular_pen = qp.pen()
-        regular_pen.setColor(QApplication.palette().color(QPalette.ButtonText))
-        qp.setPen(regular_pen)
-
-        background_brush = QBrush()
-        background_brush.setColor(QApplication.palette().color(QPalette.Button))
-        background_brush.setStyle(Qt.SolidPattern)
-
-        foreground_brush = QBrush()
-        foreground_brush.setColor(QApplication.palette().color(QPalette.Button).lighter(120))
-        foreground_brush.setStyle(Qt.SolidPattern)
-
-        mask_brush = QBrush()
-        mask_brush.setColor(QApplication.palette().color(QPalette.Button).lighter(Theme.mask_light_factor()))
-        mask_brush.setStyle(Qt.SolidPattern)
-
-        # for currently selected keycap
-        active_pen = qp.pen()
-        active_pen.setColor(QApplication.palette().color(QPalette.Highlight))
-        active_pen.setWidthF(1.5)
-
-        # for the encoder arrow
-        extra_pen = regular_pen
-        extra_brush = QBrush()
-        extra_brush.setColor(QApplication.palette().color(QPalette.ButtonText))
-        extra_brush.setStyle(Qt.SolidPattern)
-
-        # for pressed keycaps
-        background_pressed_brush = QBrush()
-        background_pressed_brush.setColor(QApplication.palette().color(QPalette.Highlight))
-        background_pressed_brush.setStyle(Qt.SolidPattern)
+        style = self.get_paint_style(qp.font())
+        region = event.region()
+        scale = QTransform.fromScale(self.scale, self.scale)
 
-        foreground_pressed_brush = QBrush()
-        foreground_pressed_brush.setColor(QApplication.palette().color(QPalette.Highlight).lighter(120))
-        foreground_pressed_brush.setStyle(Qt.SolidPattern)
-
-        background_on_brush = QBrush()
-        background_on_brush.setColor(QApplication.palette().color(QPalette.Highlight).darker(150))
-        background_on_brush.setStyle(Qt.SolidPattern)
-
-        foreground_on_brush = QBrush()
-        foreground_on_brush.setColor(QApplication.palette().color(QPalette.Highlight).darker(120))
-        foreground_on_brush.setStyle(Qt.SolidPattern)
-
-        mask_font = qp.font()
-        mask_font.setPointSize(round(mask_font.pointSize() * 0.8))
-
-        for idx, key in enumerate(self.widgets):
-            qp.save()
-
-            qp.scale(self.scale, self.scale)
-            qp.translate(key.shift_x, key.shift_y)
-            qp.translate(key.rotation_x, key.rotation_y)
-            qp.rotate(key.rotation_angle)
-            qp.translate(-key.rotation_x, -key.rotation_y)
+        for key in self.widgets:
+            if not region.intersects(self.key_rect(key)):
+                continue
 
             active = key.active or (self.active_key == key and not self.active_mask)
+            mask_active = self.active_key == key and self.active_mask
 
-            # draw keycap background/drop-shadow
-            qp.setPen(active_pen if active else Qt.NoPen)
-            brush = background_brush
-            if key.pressed:
-                brush = background_pressed_brush
-            elif key.on:
-                brush = background_on_brush
-            qp.setBrush(brush)
-            qp.drawPath(key.background_draw_path)
-
-            # draw keycap foreground
-            qp.setPen(Qt.NoPen)
-            brush = foreground_brush
-            if key.pressed:
-                brush = foreground_pressed_brush
-            elif key.on:
-                brush = foreground_on_brush
-            qp.setBrush(brush)
-            qp.drawPath(key.foreground_draw_path)
-
-            # draw key text
-            if key.masked:
-                # draw the outer legend
-                qp.setFont(mask_font)
-                qp.setPen(key.color if key.color else regular_pen)
-                qp.drawText(key.nonmask_rect, Qt.AlignCenter, key.text)
-
-                # draw the inner highlight rect
-                qp.setPen(active_pen if self.active_key == key and self.active_mask else Qt.NoPen)
-                qp.setBrush(mask_brush)
-                qp.drawRoundedRect(key.mask_rect, key.corner, key.corner)
-
-                # draw the inner legend
-                qp.setPen(key.mask_color if key.mask_color else regular_pen)
-                qp.drawText(key.mask_rect, Qt.AlignCenter, key.mask_text)
+            if self.cache_pixmaps and key.rotation_angle == 0:
+                self.draw_cached(qp, key, style, active, mask_active)
             else:
-                # draw the legend
-                qp.setPen(key.color if key.color else regular_pen)
-                qp.drawText(key.text_rect, Qt.AlignCenter, key.text)
-
-            # draw the extra shape (encoder arrow)
-            qp.setPen(extra_pen)
-            qp.setBrush(extra_brush)
-            qp.drawPath(key.extra_draw_path)
+                qp.setTransform(key.transform * scale)
+                self.draw_key(qp, key, style, active, mask_active)
 
-            qp.restore()
+        qp.end()
 
+    def draw_cached(self, qp, key, style, active, mask_active):
+        ratio = self.devicePixelRatioF()
+        # pixmap is placed on whole pixels, fractional part of the key's position is rendered into it
+        x = (key.local_rect.x() + key.shift_x) * self.scale
+        y = (key.local_rect.y() + key.shift_y) * self.scale
+        ix, iy = math.floor(x), math.floor(y)
+        fx, fy = round(x - ix, 2), round(y - iy, 2)
+
+        pixmap_key = (style.key, self.scale, ratio, fx, fy, active, mask_active, key.pressed, key.on, key.masked,
+                      key.text, key.mask_text, color_key(key.color), color_key(key.mask_color))
+        pixmap = key.pixmaps.get(pixmap_key)
+        if pixmap is None:
+            if len(key.pixmaps) >= KEY_PIXMAP_CACHE_SIZE:
+                key.pixmaps.clear()
+            pixmap = key.pixmaps[pixmap_key] = self.render_key(key, style, active, mask_active, fx, fy, ratio)
+
+        qp.resetTransform()
+        qp.drawPixmap(ix, iy, pixmap)
+
+    def render_key(self, key, style, active, mask_active, fx, fy, ratio):
+        rect = key.local_rect
+        pixmap = QPixmap(math.ceil((rect.width() * self.scale + 1) * ratio),
+                         math.ceil((rect.height() * self.scale + 1) * ratio))
+        pixmap.setDevicePixelRatio(ratio)
+        pixmap.fill(Qt.transparent)
+
+        qp = QPainter(pixmap)
+        qp.setRenderHint(QPainter.Antialiasing)
+        qp.translate(fx, fy)
+        qp.scale(self.scale, self.scale)
+        qp.translate(-rect.x(), -rect.y())
+        self.draw_key(qp, key, style, active, mask_active)
         qp.end()
+        return pixmap
+
+    def draw_key(self, qp, key, style, active, mask_active):
+        """ Paints a key in its own coordinates, the painter is expected to be transformed already """
+
+        # draw keycap background/drop-shadow
+        qp.setPen(style.active_pen if active else Qt.NoPen)
+        brush = style.background_brush
+        if key.pressed:
+            brush = style.background_pressed_brush
+        elif key.on:
+            brush = style.background_on_brush
+        qp.setBrush(brush)
+        qp.drawPath(key.background_draw_path)
+
+        # draw keycap foreground
+        qp.setPen(Qt.NoPen)
+        brush = style.foreground_brush
+        if key.pressed:
+            brush = style.foreground_pressed_brush
+        elif key.on:
+            brush = style.foreground_on_brush
+        qp.setBrush(brush)
+        qp.drawPath(key.foreground_draw_path)
+
+        # draw key text
+        if key.masked:
+            # draw the outer legend
+            qp.setFont(style.mask_font)
+            qp.setPen(key.color if key.color else style.regular_pen)
+            qp.drawText(key.nonmask_rect, Qt.AlignCenter, key.text)
+
+            # draw the inner highlight rect
+            qp.setPen(style.active_pen if mask_active else Qt.NoPen)
+            qp.setBrush(style.mask_brush)
+            qp.drawRoundedRect(key.mask_rect, key.corner, key.corner)
+
+            # draw the inner legend
+            qp.setPen(key.mask_color if key.mask_color else style.regular_pen)
+            qp.drawText(key.mask_rect, Qt.AlignCenter, key.mask_text)
+        else:
+            # draw the legend
+            qp.setFont(style.font)
+            qp.setPen(key.color if key.color else style.regular_pen)
+            qp.drawText(key.text_rect, Qt.AlignCenter, key.text)
+
+        # draw the extra shape (encoder arrow)
+        qp.setPen(style.extra_pen)
+        qp.setBrush(style.extra_brush)
+        qp.drawPath(key.extra_draw_path)
 
     def minimumSizeHint(self):
         return QSize(self.width, self.height)
@@ -478,10 +583,11 @@ class KeyboardWidget(QWidget):
     def hit_test(self, pos):
         """ Returns key, hit_masked_part """
 
-        for key in self.widgets:
-            if key.masked and key.mask_polygon.containsPoint(pos/self.scale, Qt.OddEvenFill):
+        pos = pos / self.scale
+        for key in self.key_grid.candidates(pos):
+            if key.masked and key.mask_polygon.containsPoint(pos, Qt.OddEvenFill):
                 return key, True
-            if key.polygon.containsPoint(pos/self.scale, Qt.OddEvenFill):
+            if key.polygon.containsPoint(pos, Qt.OddEvenFill):
                 return key, False
 
         return None, False
@@ -490,12 +596,15 @@ class KeyboardWidget(QWidget):
         if not self.enabled:
             return
 
+        previous = self.active_key
         self.active_key, self.active_mask = self.hit_test(ev.pos())
         if self.active_key is not None:
             self.clicked.emit()
         else:
             self.deselected.emit()
-        self.update()
+        # only the keys whose outline changed need repainting
+        self.update_key(previous)
+        self.update_key(self.active_key)
 
     def resizeEvent(self, ev):
         if self.isEnabled():
@@ -509,6 +618,8 @@ class KeyboardWidget(QWidget):
             if key == self.active_key:
                 self.active_key = keys_looped[x + 1]
                 self.active_mask = False
+                self.update_key(key)
+                self.update_key(self.active_key)
                 self.clicked.emit()
                 return
 
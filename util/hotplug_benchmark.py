@@ -0,0 +1,132 @@
+"""
+Measures what device detection costs while nothing is being plugged in, as JSON, e.g.:
+
+    python util/hotplug_benchmark.py --seconds 10 --devices 3
+
+Runs each autorefresh backend available on this machine against a fake HID enumeration of the given number of
+keyboards and reports, over the idle period, how many enumerations and device opens it did, the voluntary
+context switches of the process (a count of wakeups, Linux only) and the CPU time spent.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.append("src/main/python")
+
+from PyQt5.QtCore import QCoreApplication
+
+import util
+from autorefresh import autorefresh_thread
+from autorefresh.autorefresh_thread import AutorefreshThread
+
+
+class FakeDevice:
+
+    opens = 0
+
+    def open_path(self, path):
+        FakeDevice.opens += 1
+
+    def close(self):
+        pass
+
+
+def fake_enumerate(count):
+    return [{
+        "vendor_id": 0xFEED,
+        "product_id": idx,
+        "serial_number": "vial:f64c2b3c",
+        "usage_page": 0xFF60,
+        "usage": 0x61,
+        "path": "/dev/hidraw{}".format(idx).encode(),
+        "manufacturer_string": "Emulated",
+        "product_string": "Keyboard {}".format(idx),
+    } for idx in range(count)]
+
+
+def context_switches():
+    """ Voluntary context switches of all threads of this process, None where /proc isn't available """
+
+    total = 0
+    try:
+        for tid in os.listdir("/proc/self/task"):
+            with open("/proc/self/task/{}/status".format(tid)) as inf:
+                for line in inf:
+                    if line.startswith("voluntary_ctxt_switches:"):
+                        total += int(line.split()[1])
+    except OSError:
+        return None
+    return total
+
+
+def measure(thread, args):
+    enumerations = [0]
+    find_vial_devices = autorefresh_thread.find_vial_devices
+
+    def counting_find(*a, **kw):
+        enumerations[0] += 1
+        return find_vial_devices(*a, **kw)
+
+    autorefresh_thread.find_vial_devices = counting_find
+    thread.start()
+    # let the initial enumeration happen
+    time.sleep(0.5)
+
+    enumerations[0] = FakeDevice.opens = 0
+    switches = context_switches()
+    cpu = time.process_time()
+    time.sleep(args.seconds)
+    cpu = time.process_time() - cpu
+    if switches is not None:
+        # minus the main thread waking up from sleep
+        switches = context_switches() - switches - 1
+
+    thread.terminate()
+    thread.wait()
+    autorefresh_thread.find_vial_devices = find_vial_devices
+    return {
+        "enumerations": enumerations[0],
+        "device_opens": FakeDevice.opens,
+        "wakeups": switches,
+        "cpu_ms": round(cpu * 1000, 3),
+    }
+
+
+def run(args):
+    util.hid.enumerate = lambda: fake_enumerate(args.devices)
+    util.hid.device = FakeDevice
+
+    backends = {"polling": AutorefreshThread}
+    if sys.platform.startswith("linux"):
+        from autorefresh.autorefresh_thread_linux import AutorefreshThreadLinux
+
+        backends["hotplug"] = AutorefreshThreadLinux
+
+    return {
+        "seconds": args.seconds,
+        "devices": args.devices,
+        "results": {name: measure(cls(), args) for name, cls in backends.items()},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--devices", type=int, default=3)
+    parser.add_argument("--output", help="write JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    app = QCoreApplication(sys.argv)
+
+    data = json.dumps(run(args), indent=2)
+    if args.output:
+        with open(args.output, "w") as outf:
+            outf.write(data + "\n")
+    else:
+        print(data)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Measures per-call cost of keycode conversions, as JSON, e.g.:
+
+    python util/keycode_benchmark.py --protocol 6 --calls 20000
+
+For every conversion reports the mean cost of a call in microseconds, both for the first conversion of each
+value after keycodes were regenerated (cold) and for values which were converted before (warm).
+"""
+import argparse
+import json
+import random
+import sys
+import time
+
+sys.path.append("src/main/python")
+
+from keycodes.keycodes import Keycode, recreate_keyboard_keycodes
+
+
+class FakeKeyboard:
+
+    layers = 16
+    macro_count = 64
+    custom_keycodes = None
+    tap_dance_count = 32
+    midi = None
+    supported_features = {"persistent_default_layer", "caps_word", "layer_lock", "repeat_key"}
+
+    def __init__(self, protocol):
+        self.vial_protocol = protocol
+
+
+def per_call(fn, values):
+    start = time.perf_counter()
+    for value in values:
+        fn(value)
+    return round((time.perf_counter() - start) * 1e6 / len(values), 3)
+
+
+def measure(keyboard, fn, values):
+    recreate_keyboard_keycodes(keyboard)
+    cold = per_call(fn, values)
+    warm = per_call(fn, values)
+    return {"cold_us": cold, "warm_us": warm}
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    keyboard = FakeKeyboard(args.protocol)
+    recreate_keyboard_keycodes(keyboard)
+
+    # a keymap-like mix: mostly basic keys, some modifiers, layer taps and mod taps
+    codes = [rng.choice([rng.randrange(0x04, 0xE8), rng.randrange(0x04, 0x74) | 0x0200,
+                         Keycode.deserialize("LT(1, KC_A)") + rng.randrange(0x04, 0x74) - 0x04,
+                         rng.randrange(0x10000)])
+             for x in range(args.calls)]
+    names = [Keycode.serialize(code) for code in codes]
+    expressions = ["LT({}, KC_{})".format(rng.randrange(16), rng.choice("ABCDEFGHIJ")) for x in range(args.calls)]
+
+    return {
+        "protocol": args.protocol,
+        "calls": args.calls,
+        "results": {
+            "serialize": measure(keyboard, Keycode.serialize, codes),
+            "deserialize_names": measure(keyboard, Keycode.deserialize, names),
+            "deserialize_expressions": measure(keyboard, Keycode.deserialize, expressions),
+            "normalize": measure(keyboard, Keycode.normalize, names),
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--protocol", type=int, default=6)
+    parser.add_argument("--calls", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    data = json.dumps(run(args), indent=2)
+    if args.output:
+        with open(args.output, "w") as outf:
+            outf.write(data + "\n")
+    else:
+        print(data)
+
+
+if __name__ == "__main__":
+    main()
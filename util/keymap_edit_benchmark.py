@@ -0,0 +1,96 @@
+"""
+Measures the cost of editing a keymap in KeymapEditor, as JSON, e.g.:
+
+    QT_QPA_PLATFORM=offscreen python util/keymap_edit_benchmark.py --rows 8 --cols 15
+
+Reports the mean time in milliseconds to remap a key the way a user does by picking keycodes one after
+another (the next key gets selected after each one), to switch layers and to change the scale, each
+including repainting the keyboard.
+"""
+import argparse
+import json
+import sys
+import time
+
+sys.path.append("src/main/python")
+
+from PyQt5.QtWidgets import QApplication, QWidget
+
+from editor.keymap_editor import KeymapEditor
+from editor.layout_editor import LayoutEditor
+from protocol.emulator import VialEmulator, make_definition
+from protocol.keyboard_comm import Keyboard
+from tabbed_keycodes import TabbedKeycodes
+from vial_device import VialKeyboard
+
+
+def per_call(app, fn, calls):
+    start = time.perf_counter()
+    for call in range(calls):
+        fn(call)
+        # paint whatever the call scheduled
+        app.processEvents()
+    return round((time.perf_counter() - start) * 1000 / calls, 4)
+
+
+def run(app, args):
+    device = VialKeyboard({"vendor_id": 0xFEED, "product_id": 0, "manufacturer_string": "",
+                           "product_string": "Emulated", "path": b""})
+    device.keyboard = Keyboard(VialEmulator(make_definition(args.rows, args.cols, args.encoders), layers=args.layers))
+    device.keyboard.reload()
+
+    tray = TabbedKeycodes()
+    tray.make_tray()
+    layout_editor = LayoutEditor()
+    editor = KeymapEditor(layout_editor)
+    window = QWidget()
+    window.setLayout(editor)
+    window.show()
+    layout_editor.rebuild(device)
+    editor.rebuild(device)
+    app.processEvents()
+
+    keys = editor.container.widgets
+    keycodes = ["KC_A", "KC_B", "LT(1, KC_C)", "LSFT_T(KC_D)"]
+
+    def remap(call):
+        editor.set_key(keycodes[call % len(keycodes)])
+
+    editor.container.active_key = keys[0]
+    results = {
+        "remap_key_ms": per_call(app, remap, len(keys) * args.passes),
+        "switch_layer_ms": per_call(app, lambda call: editor.switch_layer(call % args.layers), args.layers * 4),
+        "adjust_size_ms": per_call(app, lambda call: editor.adjust_size(call % 2), 10),
+    }
+
+    editor.deleteLater()
+    window.deleteLater()
+    return {
+        "board": {"rows": args.rows, "cols": args.cols, "encoders": args.encoders, "layers": args.layers,
+                  "keys": len(keys)},
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=8)
+    parser.add_argument("--cols", type=int, default=15)
+    parser.add_argument("--encoders", type=int, default=0)
+    parser.add_argument("--layers", type=int, default=4)
+    parser.add_argument("--passes", type=int, default=2, help="how many times to remap every key")
+    parser.add_argument("--output", help="write JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    app = QApplication(sys.argv)
+
+    data = json.dumps(run(app, args), indent=2)
+    if args.output:
+        with open(args.output, "w") as outf:
+            outf.write(data + "\n")
+    else:
+        print(data)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Measures the cost of a matrix tester poll, as JSON, e.g.:
+
+    QT_QPA_PLATFORM=offscreen python util/matrix_test_benchmark.py --rows 8 --cols 15 --polls 2000
+
+Polls an emulated keyboard, so there is no USB latency: reports the mean time in milliseconds the GUI thread
+spends on a poll including repainting, the poll rate this allows and how many messages every poll sends. A few
+keys change state between polls, as when typing. With --matrix-state-offset the emulated firmware can read
+the matrix starting at a given row, which is needed for matrices larger than a single report, e.g. 12x24; no
+real firmware supports this yet.
+"""
+import argparse
+import json
+import random
+import sys
+import time
+
+sys.path.append("src/main/python")
+
+from PyQt5.QtWidgets import QApplication, QWidget
+
+from editor.layout_editor import LayoutEditor
+from editor.matrix_test import MatrixTest
+from protocol.emulator import VialEmulator, make_definition
+from protocol.keyboard_comm import Keyboard
+from vial_device import VialKeyboard
+
+
+def run(app, args):
+    rng = random.Random(args.seed)
+    emulator = VialEmulator(make_definition(args.rows, args.cols), matrix_state_offset=args.matrix_state_offset)
+    device = VialKeyboard({"vendor_id": 0xFEED, "product_id": 0, "manufacturer_string": "",
+                           "product_string": "Emulated", "path": b""})
+    # talk to the emulator as to a hidapi device, so that multiple reports are pipelined like on hardware
+    device.keyboard = Keyboard(emulator)
+    device.keyboard.matrix_state_offset = args.matrix_state_offset
+    device.keyboard.reload()
+
+    layout_editor = LayoutEditor()
+    editor = MatrixTest(layout_editor)
+    window = QWidget()
+    window.setLayout(editor)
+    window.show()
+    layout_editor.rebuild(device)
+    editor.rebuild(device)
+    app.processEvents()
+    if not editor.valid():
+        raise SystemExit("matrix tester can't read a {}x{} matrix".format(args.rows, args.cols))
+
+    positions = [(row, col) for row in range(args.rows) for col in range(args.cols)]
+    typed = rng.sample(positions, min(len(positions), 10))
+    packets = emulator.packets
+    start = time.perf_counter()
+    for poll in range(args.polls):
+        for row, col in rng.sample(typed, min(len(typed), args.changed)):
+            if (row, col) in emulator.pressed:
+                emulator.release(row, col)
+            else:
+                emulator.press(row, col)
+        editor.matrix_poller()
+        app.processEvents()
+    elapsed = time.perf_counter() - start
+
+    window.deleteLater()
+    return {
+        "board": {"rows": args.rows, "cols": args.cols, "matrix_state_offset": args.matrix_state_offset},
+        "polls": args.polls,
+        "changed_keys": args.changed,
+        "results": {
+            "poll_ms": round(elapsed * 1000 / args.polls, 4),
+            "max_rate_hz": round(args.polls / elapsed),
+            "messages_per_poll": round((emulator.packets - packets) / args.polls, 3),
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=6)
+    parser.add_argument("--cols", type=int, default=16)
+    parser.add_argument("--polls", type=int, default=1000)
+    parser.add_argument("--changed", type=int, default=2, help="keys changing state between polls")
+    parser.add_argument("--matrix-state-offset", action="store_true",
+                        help="emulate firmware which reads the matrix starting at a given row")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    app = QApplication(sys.argv)
+
+    data = json.dumps(run(app, args), indent=2)
+    if args.output:
+        with open(args.output, "w") as outf:
+            outf.write(data + "\n")
+    else:
+        print(data)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+Measures communication cost of Keyboard operations against an emulated keyboard.
+
+For every operation reports wall time, Python CPU time, number of packets exchanged and transport metrics
+(timeouts, retries, time spent in backoff), as JSON, e.g.:
+
+    python util/protocol_benchmark.py --layers 16 --rows 8 --cols 24 --encoders 4 --output bench.json
+
+The emulated keyboard is reached through the regular hidapi transport, optionally over a degraded link:
+
+    python util/protocol_benchmark.py --latency 2 --jitter 1 --drop-rate 0.01
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.append("src/main/python")
+
+from PyQt5.QtCore import QCoreApplication
+
+from editor.qmk_settings import QmkSettings
+from protocol.emulator import VialEmulator, make_definition
+from protocol.fault_injection import FaultInjectingDevice
+from protocol.keyboard_comm import Keyboard
+from protocol.trace import PacketTrace
+
+
+class Appctx:
+
+    def get_resource(self, path):
+        return os.path.join("src/main/resources/base", path)
+
+
+def measure(emulator, dev, fn):
+    packets = emulator.packets
+    dev.metrics.reset()
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    fn()
+    return {
+        "wall_s": round(time.perf_counter() - wall, 6),
+        "cpu_s": round(time.process_time() - cpu, 6),
+        "packets": emulator.packets - packets,
+        "transport": dev.metrics.as_dict(),
+    }
+
+
+def randomize(emulator, rng):
+    """ Fill the emulated keyboard with a non-trivial keymap """
+    for x in range(0, len(emulator.keymap), 2):
+        emulator.keymap[x:x + 2] = rng.randrange(0x04, 0x74).to_bytes(2, "big")
+    for x in range(0, len(emulator.encoders), 2):
+        emulator.encoders[x:x + 2] = rng.randrange(0x04, 0x74).to_bytes(2, "big")
+    for idx in range(len(emulator.combos)):
+        emulator.combos[idx] = tuple(rng.randrange(0x04, 0x74) for x in range(5))
+    for idx in range(len(emulator.tap_dance)):
+        emulator.tap_dance[idx] = tuple(rng.randrange(0x04, 0x74) for x in range(4)) + (200,)
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    QmkSettings.load()
+    settings = sorted(QmkSettings.qsid_fields.keys())
+    emulator = VialEmulator(
+        make_definition(args.rows, args.cols, args.encoders),
+        layers=args.layers, macro_count=args.macros, macro_memory=args.macro_memory,
+        tap_dance_count=args.tap_dance, combo_count=args.combos, settings=settings)
+    randomize(emulator, rng)
+    dev = FaultInjectingDevice(emulator, latency=args.latency / 1000, jitter=args.jitter / 1000,
+                               drop_rate=args.drop_rate, short_write_rate=args.short_write_rate, seed=args.seed)
+
+    kb = Keyboard(dev)
+    results = dict()
+    results["reload"] = measure(emulator, dev, kb.reload)
+    results["reload_settings"] = measure(emulator, dev, kb.reload_settings)
+
+    saved = []
+    results["save_layout"] = measure(emulator, dev, lambda: saved.append(kb.save_layout()))
+
+    # restore the saved layout onto a keyboard where every key differs
+    randomize(emulator, rng)
+    kb = Keyboard(dev)
+    kb.reload()
+    results["restore_layout"] = measure(emulator, dev, lambda: kb.restore_layout(saved[0]))
+
+    macro = bytes(rng.randrange(0x20, 0x7F) for x in range(args.macro_memory - args.macros)) + b"\x00" * args.macros
+    results["set_macro"] = measure(emulator, dev, lambda: kb.set_macro(macro))
+
+    return {
+        "board": {
+            "layers": args.layers, "rows": args.rows, "cols": args.cols, "encoders": args.encoders,
+            "macros": args.macros, "macro_memory": args.macro_memory, "combos": args.combos,
+            "tap_dance": args.tap_dance, "settings": len(settings),
+        },
+        "link": {
+            "latency_ms": args.latency, "jitter_ms": args.jitter, "drop_rate": args.drop_rate,
+            "short_write_rate": args.short_write_rate,
+        },
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--layers", type=int, default=4)
+    parser.add_argument("--rows", type=int, default=6)
+    parser.add_argument("--cols", type=int, default=16)
+    parser.add_argument("--encoders", type=int, default=2)
+    parser.add_argument("--macros", type=int, default=16)
+    parser.add_argument("--macro-memory", type=int, default=900)
+    parser.add_argument("--combos", type=int, default=16)
+    parser.add_argument("--tap-dance", type=int, default=16)
+    parser.add_argument("--latency", type=float, default=0, help="added latency per packet, in ms")
+    parser.add_argument("--jitter", type=float, default=0, help="random +- variation of latency, in ms")
+    parser.add_argument("--drop-rate", type=float, default=0, help="fraction of responses which get lost")
+    parser.add_argument("--short-write-rate", type=float, default=0, help="fraction of writes which fail")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write JSON results here instead of stdout")
+    parser.add_argument("--trace", help="write a packet-level trace of the whole run here")
+    args = parser.parse_args()
+
+    app = QCoreApplication(sys.argv)
+    QmkSettings.initialize(Appctx())
+    PacketTrace.get().enabled = bool(args.trace)
+
+    data = json.dumps(run(args), indent=2)
+    if args.trace:
+        PacketTrace.get().export(args.trace)
+    if args.output:
+        with open(args.output, "w") as outf:
+            outf.write(data + "\n")
+    else:
+        print(data)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Measures the cost of painting KeyboardWidget for a board of the given size, as JSON, e.g.:
+
+    QT_QPA_PLATFORM=offscreen python util/render_benchmark.py --rows 8 --cols 24 --frames 200
+
+Reports the mean time of a frame in milliseconds for repainting the whole widget and for repainting
+only the keys which changed, as the matrix tester does while keys are being pressed, both with and
+without cached key pixmaps.
+"""
+import argparse
+import json
+import random
+import sys
+import time
+
+sys.path.append("src/main/python")
+
+from PyQt5.QtGui import QImage, QRegion
+from PyQt5.QtWidgets import QApplication
+
+from protocol.emulator import VialEmulator, make_definition
+from protocol.keyboard_comm import Keyboard
+from widgets.keyboard_widget import KeyboardWidget
+
+
+class LayoutEditor:
+
+    def get_choice(self, idx):
+        return 0
+
+
+def per_frame(widget, image, frames, region_fn):
+    start = time.perf_counter()
+    for frame in range(frames):
+        widget.render(image, sourceRegion=region_fn(frame))
+    return round((time.perf_counter() - start) * 1000 / frames, 4)
+
+
+def measure(args, cache_pixmaps):
+    rng = random.Random(args.seed)
+    kb = Keyboard(VialEmulator(make_definition(args.rows, args.cols, args.encoders)))
+    kb.reload()
+
+    KeyboardWidget.cache_pixmaps = cache_pixmaps
+    widget = KeyboardWidget(LayoutEditor())
+    widget.set_keys(kb.keys, kb.encoders)
+    for key in widget.widgets:
+        key.setText(rng.choice(["A", "Esc", "Enter", "LT 1\nSpace"]))
+    widget.resize(widget.minimumSizeHint())
+    image = QImage(widget.size(), QImage.Format_ARGB32_Premultiplied)
+
+    def full(frame):
+        return QRegion(widget.rect())
+
+    typed = rng.sample(widget.widgets, min(len(widget.widgets), 10))
+
+    def dirty(frame):
+        # a few keys being typed on change state every frame, only their area is repainted
+        region = QRegion()
+        for key in rng.sample(typed, min(len(typed), args.changed)):
+            key.setPressed(not key.pressed)
+            region += widget.key_rect(key)
+        return region
+
+    # warm up, fills the pixmap caches
+    per_frame(widget, image, 1, full)
+    return {
+        "full_ms": per_frame(widget, image, args.frames, full),
+        "dirty_ms": per_frame(widget, image, args.frames, dirty),
+    }
+
+
+def run(args):
+    return {
+        "board": {"rows": args.rows, "cols": args.cols, "encoders": args.encoders},
+        "frames": args.frames,
+        "changed_keys": args.changed,
+        "results": {
+            "direct": measure(args, False),
+            "cached": measure(args, True),
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=6)
+    parser.add_argument("--cols", type=int, default=16)
+    parser.add_argument("--encoders", type=int, default=2)
+    parser.add_argument("--frames", type=int, default=100)
+    parser.add_argument("--changed", type=int, default=2, help="keys changing state per frame")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    app = QApplication(sys.argv)
+
+    data = json.dumps(run(args), indent=2)
+    if args.output:
+        with open(args.output, "w") as outf:
+            outf.write(data + "\n")
+    else:
+        print(data)
+
+
+if __name__ == "__main__":
+    main()